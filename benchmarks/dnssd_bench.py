@@ -0,0 +1,180 @@
+'''Microbenchmarks for the DNS-SD codec in spinet.dnssd.
+
+Measures pack and parse throughput and memory allocations of the DNS-SD
+objects exchanged between the commissioner and enrolled devices over a
+corpus of realistic records. Run from the top-level directory of the
+repository:
+
+  $ python -m benchmarks.dnssd_bench -o dnssd.json
+
+The results are written in JSON so that runs from different releases can be
+compared. For each case, the output contains:
+
+  ops_per_sec      - operations per second (best of --repeat runs)
+  alloc_blocks_op  - memory blocks still allocated per operation when the
+                     results are kept alive (tracemalloc)
+  alloc_bytes_op   - peak traced memory per operation (tracemalloc)
+'''
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+from   spinet.dnssd import *
+
+
+CONSONANTS = 'bdfghjklmnprstvz'
+VOWELS     = 'aiou'
+
+
+def device_name(rnd):
+    '''Generate a Proquint-like device name, e.g., lusab-babad.
+    '''
+    def quint():
+        return ''.join([rnd.choice(CONSONANTS), rnd.choice(VOWELS),
+                        rnd.choice(CONSONANTS), rnd.choice(VOWELS),
+                        rnd.choice(CONSONANTS)])
+    return '%s-%s' % (quint(), quint())
+
+
+def corpus(size, seed=0):
+    '''Build a list of (instance name, TXT attributes) tuples as advertised
+    by enrolled devices.
+    '''
+    rnd = random.Random(seed)
+    rv = []
+    for i in range(size):
+        name = device_name(rnd)
+        attrs = {'uri': 'https://192.168.49.%d:10000/' % rnd.randint(2, 253)}
+        if i % 4 == 0:
+            attrs['fw'] = '0.0.%d' % rnd.randint(1, 99)
+        rv.append(('%s._spinet._tcp.local.' % name, attrs))
+    return rv
+
+
+def txt_response(name, attrs, tid):
+    data = ANQPData(DomainName(name), ANQPData.TYPE_TXT)
+    return ANQPResponse(ANQPResponse.SUCCESS, data, data.create_rdata(attrs), tid)
+
+
+def ptr_response(name, tid):
+    sep = name.find('.')
+    data = ANQPData(DomainName(name[sep+1:]), ANQPData.TYPE_PTR)
+    return ANQPResponse(ANQPResponse.SUCCESS, data, data.create_rdata(name), tid)
+
+
+def cases(records):
+    '''Return a list of (name, pack function, parse function, objects) tuples.
+    '''
+    names = [DomainName(n) for n, _ in records]
+    queries = [ANQPQuery(ANQPData(DomainName('_spinet._tcp.local.'), ANQPData.TYPE_TXT), i % 256)
+               for i in range(len(records))]
+    txt_resps = [txt_response(n, a, i % 256) for i, (n, a) in enumerate(records)]
+    ptr_resps = [ptr_response(n, i % 256) for i, (n, _) in enumerate(records)]
+    ptrs = [r.rdata for r in ptr_resps]
+    txts = [r.rdata for r in txt_resps]
+
+    # PTR data is compressed against the name of the ANQP query, so it needs
+    # the compressor from the enclosing response to be parsed.
+    ptr_compressor = ptr_resps[0].rdata.compressor
+
+    def ptr_parse(data, offset=0):
+        return PTRData.parse(data, offset, compressor=ptr_compressor)
+
+    return [
+        ('DomainName',          DomainName.pack,   DomainName.parse,   names),
+        ('ANQPQuery',           ANQPQuery.pack,    ANQPQuery.parse,    queries),
+        ('ANQPResponse[TXT]',   ANQPResponse.pack, ANQPResponse.parse, txt_resps),
+        ('ANQPResponse[PTR]',   ANQPResponse.pack, ANQPResponse.parse, ptr_resps),
+        ('PTRData',             PTRData.pack,      ptr_parse,          ptrs),
+        ('TXTData',             TXTData.pack,      TXTData.parse,      txts)
+    ]
+
+
+def throughput(f, inputs, min_time):
+    '''Return the number of calls of f per second over the given inputs. The
+    input list is processed repeatedly until at least min_time seconds have
+    elapsed.
+    '''
+    n = 0
+    start = time.perf_counter()
+    while True:
+        for i in inputs:
+            f(i)
+        n += len(inputs)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return n / elapsed
+
+
+def allocations(f, inputs):
+    '''Return (blocks, bytes) allocated per call of f. The results are kept
+    alive until the measurement is done so that the objects created by f are
+    included in the block count.
+    '''
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        results = [f(i) for i in inputs]
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    # Only blocks allocated after tracemalloc.start() are in the snapshot. Do
+    # not count the list that holds the results.
+    blocks = sum([s.count for s in snapshot.statistics('filename')]) - 1
+    del results
+    return blocks / len(inputs), (peak - base) / len(inputs)
+
+
+def run(size, seed, min_time, repeat):
+    records = corpus(size, seed)
+    rv = []
+    for name, pack, parse, objs in cases(records):
+        packed = [pack(o) for o in objs]
+        for op, f, inputs in (('pack', pack, objs), ('parse', parse, packed)):
+            ops = max([throughput(f, inputs, min_time) for _ in range(repeat)])
+            blocks, nbytes = allocations(f, inputs)
+            rv.append({
+                'case'            : name,
+                'op'              : op,
+                'ops_per_sec'     : round(ops, 1),
+                'alloc_blocks_op' : round(blocks, 2),
+                'alloc_bytes_op'  : round(nbytes, 1),
+                'avg_size'        : round(sum([len(p) for p in packed]) / len(packed), 1)
+            })
+    return rv
+
+
+def main():
+    p = argparse.ArgumentParser(prog='dnssd_bench', description='Benchmark the spinet DNS-SD codec')
+    p.add_argument('-n', '--size',     help='Number of records in the corpus (1000)', type=int, default=1000)
+    p.add_argument('-s', '--seed',     help='Random seed for the corpus (0)', type=int, default=0)
+    p.add_argument('-t', '--min-time', help='Minimum duration of each run in seconds (0.2)', type=float, default=0.2)
+    p.add_argument('-r', '--repeat',   help='Number of runs per case, the best one is reported (3)', type=int, default=3)
+    p.add_argument('-o', '--output',   help='Write JSON results to the given file instead of stdout')
+    args = p.parse_args()
+
+    results = {
+        'python'   : platform.python_version(),
+        'impl'     : platform.python_implementation(),
+        'platform' : platform.platform(),
+        'time'     : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'size'     : args.size,
+        'seed'     : args.seed,
+        'results'  : run(args.size, args.seed, args.min_time, args.repeat)
+    }
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
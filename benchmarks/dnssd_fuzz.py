@@ -0,0 +1,168 @@
+'''Property-based round-trip fuzzer for the DNS-SD codec in spinet.dnssd.
+
+Generates random DNS-SD objects, packs them, parses the result and checks
+that packing the parsed object again yields the same bytes. It also feeds
+truncated and randomly mutated packets to the parsers and checks that they
+fail only with the expected exceptions. Run from the top-level directory of
+the repository:
+
+  $ python -m benchmarks.dnssd_fuzz -n 10000 -s 42
+
+A summary is printed in JSON. The first failing example of each property is
+included in the output (hex encoded) and the exit status is non-zero if any
+property failed. Runs are reproducible for a given seed.
+'''
+import sys
+import json
+import struct
+import random
+import argparse
+import traceback
+from   binascii     import hexlify
+from   spinet.dnssd import *
+
+
+LABEL_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_'
+SUFFIXES = [(), ('local',), ('_tcp', 'local'), ('_udp', 'local'), ('_spinet', '_tcp', 'local')]
+
+# Exceptions that the parsers may raise on malformed input
+PARSE_ERRORS = (SDError, struct.error, KeyError, UnicodeDecodeError)
+
+
+def gen_label(rnd):
+    return ''.join([rnd.choice(LABEL_CHARS) for _ in range(rnd.randint(1, 63))])
+
+
+def gen_name(rnd):
+    labels = [gen_label(rnd) for _ in range(rnd.randint(0, 4))]
+    return DomainName(labels + list(rnd.choice(SUFFIXES)))
+
+
+def gen_txt(rnd):
+    attrs = {}
+    seen = set()
+    for _ in range(rnd.randint(0, 8)):
+        k = ''.join([rnd.choice(LABEL_CHARS) for _ in range(rnd.randint(1, 9))])
+        if k.lower() in seen:
+            continue
+        seen.add(k.lower())
+        if rnd.random() < 0.2:
+            v = None
+        else:
+            v = bytes([rnd.randint(0, 255) for _ in range(rnd.randint(0, 254 - len(k)))])
+        attrs[k] = v
+    return TXTData(attrs)
+
+
+def gen_query(rnd):
+    type_ = rnd.choice([ANQPData.TYPE_PTR, ANQPData.TYPE_TXT])
+    return ANQPQuery(ANQPData(gen_name(rnd), type_), rnd.randint(0, 255))
+
+
+def gen_response(rnd):
+    tid = rnd.randint(0, 255)
+    if rnd.random() < 0.1:
+        code = rnd.choice([ANQPResponse.PROTO_UNAVAILABLE, ANQPResponse.INFO_UNAVAILABLE,
+                           ANQPResponse.BAD_REQUEST])
+        return ANQPResponse(code, None, None, tid)
+
+    if rnd.random() < 0.5:
+        data = ANQPData(gen_name(rnd), ANQPData.TYPE_TXT)
+        rdata = gen_txt(rnd)
+    else:
+        data = ANQPData(gen_name(rnd), ANQPData.TYPE_PTR)
+        rdata = data.create_rdata([gen_label(rnd)] + data.name.as_list)
+    return ANQPResponse(ANQPResponse.SUCCESS, data, rdata, tid)
+
+
+GENERATORS = [
+    ('DomainName',   gen_name,     DomainName.parse),
+    ('TXTData',      gen_txt,      TXTData.parse),
+    ('ANQPQuery',    gen_query,    ANQPQuery.parse),
+    ('ANQPResponse', gen_response, ANQPResponse.parse)
+]
+
+
+def mutate(rnd, data):
+    data = bytearray(data)
+    choice = rnd.randint(0, 2)
+    if choice == 0 and len(data):
+        del data[rnd.randint(0, len(data) - 1):]
+    elif choice == 1 and len(data):
+        for _ in range(rnd.randint(1, 4)):
+            data[rnd.randint(0, len(data) - 1)] = rnd.randint(0, 255)
+    else:
+        data += bytes([rnd.randint(0, 255) for _ in range(rnd.randint(1, 8))])
+    return bytes(data)
+
+
+def check_roundtrip(obj, parse):
+    data = obj.pack()
+    obj2, offset = parse(data)
+    if offset != len(data):
+        raise AssertionError('Parser consumed %d of %d bytes' % (offset, len(data)))
+    data2 = obj2.pack()
+    if data2 != data:
+        raise AssertionError('Repacked data differs: %s' % hexlify(data2).decode('ascii'))
+    if isinstance(obj, TXTData) and obj.as_dict() != obj2.as_dict():
+        raise AssertionError('TXT attributes differ')
+    return data
+
+
+def check_malformed(data, parse):
+    try:
+        parse(data)
+    except PARSE_ERRORS:
+        pass
+
+
+def fuzz(iterations, seed):
+    rnd = random.Random(seed)
+    stats = {}
+    for name, gen, parse in GENERATORS:
+        for prop, check in (('roundtrip', check_roundtrip), ('malformed', check_malformed)):
+            stats['%s.%s' % (name, prop)] = {'runs': 0, 'failures': 0, 'example': None}
+
+    for i in range(iterations):
+        name, gen, parse = GENERATORS[i % len(GENERATORS)]
+
+        s = stats['%s.roundtrip' % name]
+        s['runs'] += 1
+        data = None
+        try:
+            obj = gen(rnd)
+            data = check_roundtrip(obj, parse)
+        except Exception:
+            s['failures'] += 1
+            if s['example'] is None:
+                s['example'] = {'object': repr(obj), 'error': traceback.format_exc()}
+            continue
+
+        s = stats['%s.malformed' % name]
+        s['runs'] += 1
+        bad = mutate(rnd, data)
+        try:
+            check_malformed(bad, parse)
+        except Exception:
+            s['failures'] += 1
+            if s['example'] is None:
+                s['example'] = {'data': hexlify(bad).decode('ascii'), 'error': traceback.format_exc()}
+    return stats
+
+
+def main():
+    p = argparse.ArgumentParser(prog='dnssd_fuzz', description='Round-trip fuzzer for the spinet DNS-SD codec')
+    p.add_argument('-n', '--iterations', help='Number of generated objects (10000)', type=int, default=10000)
+    p.add_argument('-s', '--seed',       help='Random seed (0)', type=int, default=0)
+    args = p.parse_args()
+
+    stats = fuzz(args.iterations, args.seed)
+    failed = sum([s['failures'] for s in stats.values()])
+    json.dump({'seed': args.seed, 'iterations': args.iterations, 'failed': failed, 'properties': stats},
+              sys.stdout, indent=2)
+    print()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
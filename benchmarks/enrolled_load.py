@@ -0,0 +1,211 @@
+'''Load test for the enrolled HTTPS API.
+
+Sends GET requests to the enrolled API from a number of client threads and
+reports throughput, latency percentiles, the number of TLS handshakes and
+how many of them resumed a previous TLS session. Run from the top-level
+directory of the repository, either against a running enrolled:
+
+  $ python -m benchmarks.enrolled_load --url https://192.168.49.10:10000
+
+or against a local server started by the benchmark itself with a temporary
+database and certificate:
+
+  $ python -m benchmarks.enrolled_load --serve cheroot
+  $ python -m benchmarks.enrolled_load --serve flask --no-keepalive
+
+Results are printed in JSON.
+'''
+import os
+import ssl
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import http.client
+from   urllib.parse import urlparse
+
+
+class Connection(http.client.HTTPSConnection):
+    '''HTTPS connection that can resume a previous TLS session.
+    '''
+    def __init__(self, *args, session=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = session
+
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host, session=self.session)
+
+
+
+class Client(object):
+    def __init__(self, host, port, path, requests, keepalive, resume):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.requests = requests
+        self.keepalive = keepalive
+        self.resume = resume
+
+        self.ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.ctx.check_hostname = False
+        self.ctx.verify_mode = ssl.CERT_NONE
+
+        self.latencies = []
+        self.errors = 0
+        self.handshakes = 0
+        self.resumed = 0
+
+
+    def run(self):
+        conn = None
+        session = None
+        for _ in range(self.requests):
+            start = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = Connection(self.host, self.port, context=self.ctx, timeout=30,
+                                      session=session if self.resume else None)
+                    conn.connect()
+                    self.handshakes += 1
+                    if conn.sock.session_reused:
+                        self.resumed += 1
+
+                sock = conn.sock
+                conn.request('GET', self.path)
+                r = conn.getresponse()
+
+                # TLS 1.3 session tickets arrive after the handshake, so the
+                # session is only complete once the server has responded. Get
+                # it before the body is read, which closes the socket if the
+                # server does not keep the connection open.
+                session = sock.session
+                r.read()
+                if r.status != 200:
+                    self.errors += 1
+
+                if not self.keepalive or r.will_close:
+                    conn.close()
+                    conn = None
+            except Exception:
+                self.errors += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+            self.latencies.append(time.perf_counter() - start)
+
+        if conn is not None:
+            conn.close()
+
+
+
+def percentile(data, p):
+    if not data:
+        return None
+    return data[min(len(data) - 1, int(len(data) * p / 100))]
+
+
+def start_server(server, networks):
+    '''Start a local enrolled HTTPS server on a random port with a temporary
+    database containing the given number of networks. Return the port.
+    '''
+    tmp = tempfile.mkdtemp(prefix='enrolled-load')
+
+    import spinet.enrolled as enrolled
+    enrolled.db = sqlite3.connect(os.path.join(tmp, 'enrolled.db'), check_same_thread=False)
+
+    from spinet.enrolled import data, cert, api
+    from spinet.enrolled import server as srv
+    data.initialize_db()
+
+    c = enrolled.db.cursor()
+    for i in range(networks):
+        api.insert_network(c, {'ssid': 'network-%d' % i, 'type': 'WPA-PSK', 'psk': 'passphrase-%d' % i})
+    enrolled.db.commit()
+
+    key_path = os.path.join(tmp, 'key.pem')
+    crt_path = os.path.join(tmp, 'cert.pem')
+    cert.generate_privkey(key_path)
+    cert.generate_cert(crt_path, 'enrolled-load', key_path)
+
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    t = threading.Thread(target=srv.serve, args=(api.app, '127.0.0.1', port, crt_path, key_path),
+                         kwargs={'server': server})
+    t.daemon = True
+    t.start()
+
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return port
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main():
+    p = argparse.ArgumentParser(prog='enrolled_load', description='Load test for the enrolled HTTPS API')
+    p.add_argument('-u', '--url',          help='Base URL of a running enrolled, e.g., https://[fe80::1%%p2p0]:10000')
+    p.add_argument('-s', '--serve',        help='Start a local server of the given type instead', choices=['cheroot', 'flask'])
+    p.add_argument('-p', '--path',         help='Request path (/net)', default='/net')
+    p.add_argument('-c', '--clients',      help='Number of client threads (4)', type=int, default=4)
+    p.add_argument('-n', '--requests',     help='Number of requests per client (200)', type=int, default=200)
+    p.add_argument('-N', '--networks',     help='Number of networks in the local server database (10)', type=int, default=10)
+    p.add_argument('--no-keepalive',       help='Open a new connection for every request', action='store_true')
+    p.add_argument('--no-resume',          help='Do not resume TLS sessions', action='store_true')
+    args = p.parse_args()
+
+    # Keep stdout for the results; the Flask development server prints its
+    # banner there.
+    out, sys.stdout = sys.stdout, sys.stderr
+
+    if args.serve is not None:
+        host = '127.0.0.1'
+        port = start_server(args.serve, args.networks)
+    elif args.url is not None:
+        u = urlparse(args.url)
+        host, port = u.hostname, u.port or 443
+    else:
+        p.error('Either --url or --serve is required')
+
+    clients = [Client(host, port, args.path, args.requests, not args.no_keepalive, not args.no_resume)
+               for _ in range(args.clients)]
+    threads = [threading.Thread(target=c.run) for c in clients]
+
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted([l for c in clients for l in c.latencies])
+    total = len(latencies)
+    json.dump({
+        'server'      : args.serve or args.url,
+        'clients'     : args.clients,
+        'requests'    : total,
+        'keepalive'   : not args.no_keepalive,
+        'resume'      : not args.no_resume,
+        'errors'      : sum([c.errors for c in clients]),
+        'handshakes'  : sum([c.handshakes for c in clients]),
+        'resumed'     : sum([c.resumed for c in clients]),
+        'req_per_sec' : round(total / elapsed, 1),
+        'latency_ms'  : dict([('p%d' % q, round(1000 * percentile(latencies, q), 2)) for q in (50, 90, 99)])
+    }, out, indent=2)
+    print(file=out)
+
+
+if __name__ == '__main__':
+    main()
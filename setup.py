@@ -30,12 +30,14 @@ setup(
     extras_require={
         'enrolled': [
             'flask',
-            'proquint'
+            'proquint',
+            'cheroot',
+            'cbor'
         ],
         'commissioner': [
             'tabulate',
-            'netifaces',
-            'urllib3'
+            'urllib3',
+            'cbor'
         ],
         'label': [
             'pyopenssl',
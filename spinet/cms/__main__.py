@@ -12,13 +12,15 @@ p.add_argument('-i', '--ifname',  help='Interface name (%s)' % cms.ifname)
 p.add_argument('-v', '--verbose', help='Increase verbosity', action='store_true')
 p.add_argument('-d', '--db',      help='SQLite database file (%s)' % cms.db_path, default=cms.db_path)
 p.add_argument('-n', '--name',    help='Node name (%s)' % cms.name, default=cms.name)
+p.add_argument('-D', '--discovery', help='IP node discovery (%s)' % cms.discovery, choices=['ping', 'netlink'], default=cms.discovery)
 args = p.parse_args()
 
 cms.ifname  = args.ifname
 cms.name    = args.name
 cms.db_path = args.db
-cms.db      = sqlite3.connect(cms.db_path)
+cms.db      = sqlite3.connect(cms.db_path, check_same_thread=False)
 cms.verbose = args.verbose
+cms.discovery = args.discovery
 
 from .. import logger
 logger.setup()
@@ -61,7 +63,28 @@ data.initialize_db()
 cms.sup.start(cms.ifname)
 cms.sup.set('device_name', cms.name)
 
-from . import peer, ping
+from . import peer, ping, srv, tls, inventory
+if cms.discovery == 'netlink':
+    from . import neigh
+    ping.monitor = neigh.NeighborMonitor(notify=ping.notify)
+
+# Registered devices keep their pinned keys and last known addresses across
+# restarts, so they do not have to be discovered and trusted again.
+pins = data.device_pins()
+tls.pins.update(pins)
+for ip, fpr in pins.items():
+    inventory.devices.pin(ip, fpr)
+tls.trusted = data.is_registered
+
+
+@tls.pinned.connect
+def save_device(ip, fingerprint, **kwds):
+    d = inventory.devices.by_ip(ip)
+    data.device_seen(fingerprint, ip=ip, p2p_addr=d.p2p_addr if d is not None else None)
+
+srv.transactions.start()
+srv.services.start()
+srv.scheduler.start()
 
 log.debug('Enabling peer discovery')
 peer.start_discovery()
@@ -77,6 +100,11 @@ sh = Shell('Commissioner [%s,%s,%s]\nwpa_supplicant [%s,%s]' % (cms.name, cms.if
 
 def main():
     sh.cmdloop()
+    srv.scheduler.stop()
+    srv.services.stop()
+    srv.transactions.stop()
+    srv.transactions.cancel_all()
+    tls.close_pools()
     cms.sup.stop()
 
 
@@ -1,45 +1,515 @@
-import json
+import time
 import logging
 import urllib3
-from   .     import db
-from   .ping import ip_nodes
+from   concurrent.futures import ThreadPoolExecutor
+from   .     import tls
+from   .ping import ip_nodes, last_seen, probe
+from   .data import get_net, get_blob, device_provisioned
+from   spinet.netconf import net_hash, diff, blob_refs
+from   spinet import content
 
 log = logging.getLogger(__name__)
 
-http = urllib3.PoolManager()
+PORT        = 10000                                   # Port of the enrolled HTTP API
+CONCURRENCY = 32                                      # Max. number of nodes contacted in parallel
+RETRIES     = 2                                       # Number of retries after a failed request
+BACKOFF     = 0.5                                     # Delay before the first retry in seconds
+TIMEOUT     = urllib3.Timeout(connect=5.0, read=30.0) # Per-request timeout
+ENCODING    = content.TYPES[0]                        # Encoding of request bodies (CBOR if available)
+CHUNK       = 32 * 1024                               # Size of blob upload chunks in bytes
 
+# Methods that can be safely re-sent after the request may have reached the
+# node. Other methods are only retried if the connection could not be made.
+IDEMPOTENT = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+CONNECT_ERRORS = (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError)
 
-def post_net(id, ip=None):
-    c = db.cursor()
-    c.execute('SELECT ssid, attrs FROM net where id=?', (id,))
-    ssid, attrs = c.fetchone()
-    attrs = json.loads(attrs)
+
+class NodeResult(object):
+    '''Outcome of a request sent to one node.
+
+    Status is the HTTP status code of the last response (None if no response
+    was received) and error describes the failure (None on success).
+    '''
+    __slots__ = ('ip', 'status', 'error', 'attempts', 'elapsed', 'data', 'headers')
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.status = None
+        self.error = None
+        self.attempts = 0
+        self.elapsed = 0
+        self.data = None
+        self.headers = {}
+
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+    def __repr__(self):
+        return '%s(%s, %s, %s)' % (type(self).__name__, self.ip, self.status, repr(self.error))
+
+
+
+def encode(data):
+    '''Encode data for a request body. Return a dict with the keyword
+    arguments (headers and body) to pass to request() or fanout().
+    '''
+    return {
+        'headers' : {'Content-Type': ENCODING},
+        'body'    : content.dumps(data, ENCODING)
+    }
+
+
+def decode(rv):
+    '''Decode the body of the response in NodeResult rv according to its
+    Content-Type.
+    '''
+    return content.loads(rv.data, rv.headers.get('Content-Type', content.JSON))
+
+
+def request(ip, method, path, timeout=TIMEOUT, retries=RETRIES, headers=None, accept=(), **kwargs):
+    '''Send an HTTP request to the enrolled API on the node with the given IP
+    address and return a NodeResult.
+
+    The request is sent over HTTPS through the node's keep-alive connection
+    pool (see spinet.cms.tls). Connection errors and 5xx responses are
+    retried with exponential backoff. Requests with a method not in
+    IDEMPOTENT (e.g., POST) are only retried if the connection could not be
+    established, not after a timeout or error once the request may have been
+    sent. Other error responses are not retried. Responses with a status in
+    accept are not treated as errors. Responses are requested in CBOR if
+    available, use decode() to decode them.
+    '''
+    rv = NodeResult(ip)
+    url = 'https://[%s]:%d%s' % (ip, PORT, path)
+    pool = tls.pool(ip, PORT)
+    start = time.monotonic()
+
+    headers = dict(headers or {})
+    headers.setdefault('Accept', ', '.join(content.TYPES))
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(BACKOFF * 2 ** (attempt - 1))
+        rv.attempts = attempt + 1
+
+        try:
+            r = pool.request(method, path, timeout=timeout, retries=False, headers=headers, **kwargs)
+        except urllib3.exceptions.HTTPError as e:
+            rv.status = None
+            rv.error = str(e)
+            if method in IDEMPOTENT or isinstance(e, CONNECT_ERRORS):
+                continue
+            break
+
+        rv.status = r.status
+        rv.data = r.data
+        rv.headers = r.headers
+        if 200 <= r.status < 300 or r.status in accept:
+            rv.error = None
+            break
+
+        rv.error = 'HTTP error %d' % r.status
+        if r.status < 500:
+            break
+
+    rv.elapsed = time.monotonic() - start
+    if rv.error is not None:
+        log.warning('%s %s failed: %s' % (method, url, rv.error))
+    return rv
+
+
+def parallel(f, ips, concurrency=CONCURRENCY):
+    '''Call f(ip) for all nodes in ips in parallel, at most concurrency calls
+    at a time. Return the list of results in the same order as ips.
+    '''
+    ips = list(ips)
+    if len(ips) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(ips))) as pool:
+        return list(pool.map(f, ips))
+
+
+def fanout(ips, method, path, concurrency=CONCURRENCY, **kwargs):
+    '''Send the same HTTP request to all nodes in ips in parallel.
+
+    At most concurrency requests are in progress at any time. Return a list
+    of NodeResult objects in the same order as ips. The function does not
+    raise on per-node errors; check NodeResult.ok instead.
+    '''
+    return parallel(lambda ip: request(ip, method, path, **kwargs), ips, concurrency)
+
+
+def load_blobs(networks):
+    '''Return a dict mapping hash to data of all blobs referenced by the
+    given networks (attribute dicts).
+    '''
+    rv = {}
+    for attrs in networks:
+        for h in blob_refs(attrs):
+            if h not in rv:
+                data = get_blob(h)
+                if data is None:
+                    raise ValueError('Unknown blob %s' % h)
+                rv[h] = data
+    return rv
+
+
+def send_blob(ip, hash, data, chunk=CHUNK, **kwargs):
+    '''Upload a blob to the node unless the node already has it.
+
+    The blob is sent in chunks of chunk bytes. An interrupted upload resumes
+    at the offset reported by the node. Return the NodeResult of the last
+    request.
+    '''
+    path = '/blob/%s' % hash
+    rv = request(ip, 'HEAD', path, accept=(404,), **kwargs)
+    if rv.status != 404:
+        return rv
+
+    offset = int(rv.headers.get('Upload-Offset', 0))
+    resyncs = 0
+    while True:
+        end = min(offset + chunk, len(data))
+        headers = {'Content-Type': 'application/octet-stream'}
+        if len(data):
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (offset, end - 1, len(data))
+
+        rv = request(ip, 'PUT', path, headers=headers, body=data[offset:end], accept=(409,), **kwargs)
+        if rv.status == 409 and resyncs < RETRIES:
+            # The node has a different amount of data, e.g., because a
+            # response to a previous chunk got lost. Continue where it stopped.
+            resyncs += 1
+            offset = int(rv.headers['Upload-Offset'])
+            continue
+
+        if rv.status != 202:
+            if rv.status == 409:
+                rv.error = 'Blob upload out of sync'
+            return rv
+        offset = end
+
+
+def send_blobs(ip, blobs, **kwargs):
+    '''Upload the blobs (a dict mapping hash to data) to the node. Return the
+    NodeResult of the first failed upload, or a successful NodeResult.
+    '''
+    rv = NodeResult(ip)
+    for hash, data in blobs.items():
+        rv = send_blob(ip, hash, data, **kwargs)
+        if not rv.ok:
+            break
+    return rv
+
+
+def net_attrs(id):
+    net = get_net(id)
+    if net is None:
+        raise ValueError('Unknown network %s' % id)
+    ssid, type_, attrs = net
 
     if attrs.get('ssid', None) is None:
         attrs['ssid'] = ssid
 
+    # enrolled needs the network type to configure wpa_supplicant
+    if attrs.get('type', None) is None:
+        attrs['type'] = type_
+    return attrs
+
+
+def post_net(id, ip=None, concurrency=CONCURRENCY, **kwargs):
+    attrs = net_attrs(id)
+    blobs = load_blobs([attrs])
+    body = encode(attrs)
+
+    if ip is not None:
+        ips = [ip]
+    else:
+        ips = ip_nodes()
+
+    def post(ip):
+        rv = send_blobs(ip, blobs, **kwargs)
+        return request(ip, 'POST', '/net', **body, **kwargs) if rv.ok else rv
+
+    log.debug('Posting network configuration %d' % id)
+    return parallel(post, ips, concurrency)
+
+
+def put_net(ids, ip=None, apply=False, concurrency=CONCURRENCY, **kwargs):
+    '''Replace the network configuration of the nodes with the networks with
+    the given ids in a single request per node. If apply is True, the nodes
+    also apply the new configuration. Blobs referenced by the networks are
+    uploaded first to the nodes that do not have them yet.
+    '''
+    networks = [net_attrs(id) for id in ids]
+    blobs = load_blobs(networks)
+
+    # Encode the (possibly large) body once for all nodes
+    body = encode(networks)
+    path = '/net?apply=1' if apply else '/net'
+
+    if ip is not None:
+        ips = [ip]
+    else:
+        ips = ip_nodes()
+
+    def put(ip):
+        rv = send_blobs(ip, blobs, **kwargs)
+        return request(ip, 'PUT', path, **body, **kwargs) if rv.ok else rv
+
+    log.debug('Replacing network configuration with %s' % ', '.join([str(id) for id in ids]))
+    return parallel(put, ips, concurrency)
+
+
+def sync_node(ip, desired, blobs=None, **kwargs):
+    '''Bring the network configuration of one node in line with desired, a
+    dict mapping content hash to network attributes. Only the networks that
+    differ are sent, together with the blobs they reference. Blobs is a dict
+    mapping hash to data as returned by load_blobs(); the blobs are loaded
+    from the database if it is None. The node is left alone if it already
+    has the desired configuration.
+    '''
+    rv = request(ip, 'GET', '/net', **kwargs)
+    if not rv.ok:
+        return rv
+
+    try:
+        current = dict([(n['hash'], n) for n in decode(rv)])
+    except (ValueError, KeyError, TypeError) as e:
+        rv.error = 'Invalid response: %s' % e
+        return rv
+
+    add, remove = diff(current, desired)
+    if not add and not remove:
+        log.debug('Network configuration at %s is up to date' % ip)
+        return rv
+
+    log.debug('Updating network configuration at %s: %d added, %d removed' % (ip, len(add), len(remove)))
+    etag = rv.headers.get('ETag', None)
+
+    if blobs is None:
+        blobs = load_blobs(add)
+
+    rv = send_blobs(ip, dict([(h, blobs[h]) for attrs in add for h in blob_refs(attrs)]), **kwargs)
+    if not rv.ok:
+        return rv
+
+    body = encode({'add': add, 'remove': remove})
+    if etag is not None:
+        body['headers']['If-Match'] = etag
+    return request(ip, 'PATCH', '/net', **body, **kwargs)
+
+
+def sync_net(ids, ip=None, concurrency=CONCURRENCY, **kwargs):
+    '''Make the networks with the given ids the network configuration of
+    the nodes. Networks not in ids are removed from the nodes. Raises
+    ValueError if ids is empty.
+    '''
+    if not ids:
+        # The nodes would be left with no networks at all
+        raise ValueError('No networks to synchronize')
+
+    desired = {}
+    for id in ids:
+        attrs = net_attrs(id)
+        desired[net_hash(attrs)] = attrs
+
+    blobs = load_blobs(desired.values())
+
     if ip is not None:
         ips = [ip]
     else:
         ips = ip_nodes()
 
-    for ip in ips:
-        log.debug('Posting network configuration %d to %s' % (id, ip))
-        r = http.request('POST', 'http://[%s]:10000/net' % ip,
-                         headers={'Content-Type': 'application/json'},
-                         body=json.dumps(attrs))
-        if r.status != 200 and r.status != 204:
-            raise Exception('Error: %d', r.status)
+    return parallel(lambda ip: sync_node(ip, desired, blobs, **kwargs), ips, concurrency)
 
 
-def apply_netconfig(ip=None):
+def apply_netconfig(ip=None, **kwargs):
+    '''Ask the nodes to apply their network configuration. The nodes apply
+    the configuration in the background; the data of each successful
+    NodeResult is the JSON status of the node's apply job. Use wait_apply()
+    to collect the outcome.
+    '''
     if ip is not None:
         ips = [ip]
     else:
         ips = ip_nodes()
 
-    for ip in ips:
-        log.debug('Applying network configuration at %s' % ip)
-        r = http.request('POST', 'http://[%s]:10000/apply' % ip)
-        if r.status != 200 and r.status != 204:
-            raise Exception('Error: %d', r.status)
+    log.debug('Applying network configuration')
+    return fanout(ips, 'POST', '/apply', **kwargs)
+
+
+def wait_apply(results, timeout=60, interval=2, concurrency=CONCURRENCY, **kwargs):
+    '''Wait for the apply jobs started by apply_netconfig() to finish.
+
+    Polls the status of the job on every node in results that accepted the
+    request until the job is done or failed, or until timeout seconds have
+    elapsed. Returns a list of NodeResult objects whose data is the final
+    job status (a dict), in the same order as results.
+    '''
+    deadline = time.monotonic() + timeout
+
+    def wait(r):
+        if not r.ok:
+            return r
+        try:
+            job = decode(r)['id']
+        except (ValueError, KeyError, TypeError) as e:
+            r.error = 'Invalid response: %s' % e
+            return r
+
+        while True:
+            rv = request(r.ip, 'GET', '/apply/%s' % job, **kwargs)
+            if rv.status == 404:
+                # The node does not know the job, e.g., after a restart
+                rv.error = 'Unknown apply job %s' % job
+                return rv
+
+            if rv.ok:
+                try:
+                    rv.data = decode(rv)
+                    state = rv.data['state']
+                except (ValueError, KeyError, TypeError) as e:
+                    rv.error = 'Invalid response: %s' % e
+                    return rv
+
+                if state == 'failed':
+                    rv.error = rv.data.get('error', None) or 'Apply job %s failed' % job
+                    return rv
+                if state == 'done':
+                    fpr = tls.pins.get(r.ip, None)
+                    if fpr is not None:
+                        device_provisioned(fpr)
+                    return rv
+
+            if time.monotonic() + interval > deadline:
+                rv.error = rv.error or 'Apply job %s timed out' % job
+                return rv
+            time.sleep(interval)
+
+    return parallel(wait, results, concurrency)
+
+
+class Wave(object):
+    '''One wave of a staged rollout.
+
+    Results holds the NodeResult objects of the last request sent to each
+    node of the wave. Reappeared is the list of nodes that responded to
+    pings again after the new configuration had been applied.
+    '''
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.results = []
+        self.reappeared = []
+
+
+    @property
+    def missing(self):
+        r = set(self.reappeared)
+        return [ip for ip in self.nodes if ip not in r]
+
+
+    @property
+    def success_rate(self):
+        return len(self.reappeared) / len(self.nodes)
+
+
+    def __repr__(self):
+        return '%s(%d nodes, %.0f%%)' % (type(self).__name__, len(self.nodes), 100 * self.success_rate)
+
+
+
+class Rollout(object):
+    '''Report of a staged rollout. Skipped is the list of nodes that were not
+    touched because the rollout was aborted.
+    '''
+    def __init__(self):
+        self.waves = []
+        self.skipped = []
+        self.aborted = False
+        self.reason = None
+
+
+    def __repr__(self):
+        return '%s(%s, aborted=%s)' % (type(self).__name__, self.waves, self.aborted)
+
+
+
+def wait_for_nodes(ips, since, timeout, interval=0.5):
+    '''Wait until every node in ips has responded to a ping at or after time
+    since. Return the list of nodes that did so before the timeout.
+    '''
+    deadline = time.monotonic() + timeout
+    waiting = set(ips)
+    while True:
+        waiting = set([ip for ip in waiting if (last_seen(ip) or 0) < since])
+        if not waiting or time.monotonic() >= deadline:
+            break
+        probe()
+        time.sleep(interval)
+    return [ip for ip in ips if ip not in waiting]
+
+
+def rollout(ids, ips=None, canary=1, growth=2, min_success=1.0, settle=5,
+            reappear_timeout=60, apply_timeout=60, **kwargs):
+    '''Make the networks with the given ids the network configuration of the
+    nodes and apply the new configuration in waves.
+
+    The first wave (the canary) contains canary nodes. Each subsequent wave is
+    growth times larger than the previous one. Each node is synchronized with
+    sync_node(), so a rollout can be re-run or resumed after an abort without
+    duplicating networks on the nodes that already have them. A node counts
+    as successful if its apply job finished within apply_timeout seconds and
+    it responded to pings again at least settle seconds after that, within
+    reappear_timeout seconds. The rollout is aborted, leaving the remaining
+    nodes untouched, as soon as the success rate of a wave drops below
+    min_success. Raises ValueError if ids is empty.
+    '''
+    if not ids:
+        # The nodes would be left with no networks at all
+        raise ValueError('No networks to roll out')
+
+    if ips is None:
+        ips = ip_nodes()
+    pending = list(ips)
+
+    desired = {}
+    for id in ids:
+        attrs = net_attrs(id)
+        desired[net_hash(attrs)] = attrs
+    blobs = load_blobs(desired.values())
+
+    rv = Rollout()
+    size = max(1, canary)
+    while pending:
+        wave = Wave(pending[:size])
+        pending = pending[size:]
+        rv.waves.append(wave)
+        log.debug('Rolling out network configuration to %d node(s)' % len(wave.nodes))
+
+        results = dict([(ip, None) for ip in wave.nodes])
+        for r in parallel(lambda ip: sync_node(ip, desired, blobs, **kwargs), wave.nodes):
+            results[r.ip] = r
+        targets = [ip for ip in wave.nodes if results[ip].ok]
+
+        for r in wait_apply(fanout(targets, 'POST', '/apply', **kwargs), timeout=apply_timeout, **kwargs):
+            results[r.ip] = r
+        wave.results = list(results.values())
+
+        applied = [ip for ip in targets if results[ip].ok]
+        wave.reappeared = wait_for_nodes(applied, time.time() + settle, settle + reappear_timeout)
+
+        if wave.success_rate < min_success:
+            rv.aborted = True
+            rv.reason = 'Success rate %.0f%% below %.0f%%, missing nodes: %s' % \
+                (100 * wave.success_rate, 100 * min_success, ', '.join(wave.missing))
+            rv.skipped = pending
+            log.warning('Rollout aborted: %s' % rv.reason)
+            break
+
+        size *= growth
+
+    return rv
@@ -1,14 +1,43 @@
+import os
 import json
+import base64
 import logging
 import sqlite3
+import functools
+import threading
+from   concurrent.futures import ThreadPoolExecutor
 from   . import db
+from   spinet import content
+from   spinet.netconf import blob_hash
+from   spinet.wpas import derive_psk, is_raw_psk
 
 log = logging.getLogger(__name__)
 
+# The database connection is shared by the shell and the threads that talk to
+# devices (e.g., when a device's public key gets pinned). Every transaction
+# must be performed with the lock held.
+lock = threading.RLock()
 
+LABEL_VERSION = 1 # Version of the device label payload (see spinet.enrolled.label)
+
+
+def locked(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with lock:
+            return f(*args, **kwargs)
+    return wrapper
+
+
+@locked
 def initialize_db():
     c = db.cursor()
 
+    # Readers do not block the writer in WAL mode and commits need fewer
+    # fsyncs. The journal mode is persistent.
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=NORMAL')
+
     c.execute('''
     CREATE TABLE IF NOT EXISTS net
      (id      INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -20,18 +49,270 @@ def initialize_db():
     c.execute('''
     CREATE INDEX IF NOT EXISTS ssid_idx ON net (ssid)
     ''')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS blob
+     (hash    TEXT    PRIMARY KEY,
+      data    BLOB    NOT NULL,
+      created text    DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS device
+     (id          INTEGER PRIMARY KEY AUTOINCREMENT,
+      name        TEXT    NOT NULL,
+      fingerprint BLOB    NOT NULL,
+      p2p_addr    TEXT,
+      ip          TEXT,
+      state       TEXT    NOT NULL DEFAULT "new" CHECK (state IN ("new", "enrolled", "provisioned")),
+      last_seen   text,
+      created     text    DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    c.execute('''
+    CREATE INDEX IF NOT EXISTS device_name_idx ON device (name)
+    ''')
+    c.execute('''
+    CREATE INDEX IF NOT EXISTS device_p2p_addr_idx ON device (p2p_addr)
+    ''')
+    c.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS device_fingerprint_idx ON device (fingerprint)
+    ''')
+    c.execute('''
+    CREATE INDEX IF NOT EXISTS device_ip_idx ON device (ip)
+    ''')
 
     db.commit()
 
 
+# Networks added in batches of at least this size have their PSKs derived in
+# a pool of threads. PBKDF2 (hashlib.pbkdf2_hmac) releases the GIL, so the
+# threads run in parallel without the cost and the hazards of forking the
+# multithreaded commissioner.
+POOL_THRESHOLD = 16
+
+
+def needs_psk(type_, attrs):
+    psk = attrs.get('psk', None)
+    return type_ == 'WPA-PSK' and psk is not None and not is_raw_psk(psk)
+
+
+def add_nets(networks, threads=None):
+    '''Add networks given as a list of (ssid, type, attrs) tuples.
+
+    WPA-PSK passphrases are replaced with the raw 256-bit PSK derived from
+    the SSID and the passphrase, so that devices do not have to run the
+    expensive derivation themselves. Large batches are derived in parallel
+    in a pool of threads (by default one per CPU).
+    '''
+    networks = [(ssid, type_, dict(attrs)) for ssid, type_, attrs in networks]
+    # The PSK must be derived from the SSID sent to devices, which is the
+    # one in attrs if present (see net_attrs in spinet.cms.api)
+    todo = [(attrs.get('ssid', None) or ssid, attrs) for ssid, type_, attrs in networks if needs_psk(type_, attrs)]
+    ssids = [ssid for ssid, attrs in todo]
+    passphrases = [attrs['psk'] for ssid, attrs in todo]
+
+    if len(todo) >= POOL_THRESHOLD:
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as pool:
+            keys = list(pool.map(derive_psk, ssids, passphrases))
+    else:
+        keys = [derive_psk(*a) for a in zip(ssids, passphrases)]
+
+    for (ssid, attrs), key in zip(todo, keys):
+        attrs['psk'] = key
+
+    with lock:
+        c = db.cursor()
+        c.executemany('INSERT INTO net (ssid, type, attrs) VALUES (?,?,?)',
+                      [(ssid, type_, json.dumps(attrs)) for ssid, type_, attrs in networks])
+        db.commit()
+
+
 def add_net(ssid, type_='WPA-PSK', **kwargs):
+    add_nets([(ssid, type_, kwargs)])
+
+
+@locked
+def get_net(id):
+    '''Return the tuple (ssid, type, attrs) of the network with the given
+    id, with attrs decoded, or None if there is no such network.
+    '''
     c = db.cursor()
-    c.execute('INSERT INTO net (ssid, type, attrs) VALUES (?,?,?)',
-              (ssid, type_, json.dumps(kwargs)))
-    db.commit()
+    c.execute('SELECT ssid, type, attrs FROM net WHERE id=?', (id,))
+    row = c.fetchone()
+    return None if row is None else (row[0], row[1], json.loads(row[2]))
 
 
+@locked
+def list_nets():
+    c = db.cursor()
+    c.execute('SELECT id, ssid, type, attrs, created FROM net')
+    return c.fetchall()
+
+
+@locked
 def remove_net(id):
     c = db.cursor()
     c.execute('DELETE FROM net WHERE id=?', (id,))
     db.commit()
+
+
+@locked
+def add_blob(data):
+    '''Store a blob (a certificate, private key, etc.) and return its hash.
+    Network attributes can reference the blob with netconf.blob_ref(hash).
+    '''
+    hash = blob_hash(data)
+    c = db.cursor()
+    c.execute('INSERT OR IGNORE INTO blob (hash, data) VALUES (?,?)', (hash, data))
+    db.commit()
+    return hash
+
+
+@locked
+def get_blob(hash):
+    c = db.cursor()
+    c.execute('SELECT data FROM blob WHERE hash=?', (hash,))
+    row = c.fetchone()
+    return None if row is None else row[0]
+
+
+@locked
+def list_blobs():
+    '''Return a list of (hash, size, created) tuples of all stored blobs.
+    '''
+    c = db.cursor()
+    c.execute('SELECT hash, length(data), created FROM blob')
+    return c.fetchall()
+
+
+@locked
+def remove_blob(hash):
+    c = db.cursor()
+    c.execute('DELETE FROM blob WHERE hash=?', (hash,))
+    db.commit()
+
+
+def parse_label(payload):
+    '''Parse a device label payload, the base64-encoded CBOR array [version,
+    name, fingerprint] shown in the QR code of spinet.enrolled.label. Return a
+    tuple (name, fingerprint). Raises ValueError if the payload is malformed.
+    '''
+    try:
+        data = content.loads(base64.b64decode(payload, validate=True), content.CBOR)
+    except (ValueError, TypeError) as e:
+        raise ValueError('Invalid label: %s' % e)
+
+    if not isinstance(data, list) or len(data) < 3 or data[0] != LABEL_VERSION:
+        raise ValueError('Unsupported label format')
+
+    name, fpr = data[1], data[2]
+    if not isinstance(name, str) or not isinstance(fpr, bytes) or len(fpr) != 32:
+        raise ValueError('Invalid label contents')
+    return name, fpr
+
+
+def import_labels(payloads):
+    '''Register the devices described by the given label payloads in a
+    single transaction. Devices already registered with the same fingerprint
+    get the name from the label. Return the number of labels imported.
+
+    All payloads are parsed before the database is touched, so a malformed
+    payload (ValueError with the number of the payload) imports nothing. The
+    transaction is rolled back if the database rejects any of the devices.
+    '''
+    rows = []
+    for i, payload in enumerate(payloads, 1):
+        try:
+            rows.append(parse_label(payload))
+        except ValueError as e:
+            raise ValueError('Label %d: %s' % (i, e))
+
+    with lock:
+        c = db.cursor()
+        try:
+            c.executemany('''INSERT INTO device (name, fingerprint) VALUES (?,?)
+                             ON CONFLICT (fingerprint) DO UPDATE SET name=excluded.name''', rows)
+        except:
+            db.rollback()
+            raise
+        db.commit()
+    return len(rows)
+
+
+def import_label_file(filename):
+    '''Import a file with one label payload per line. Empty lines and lines
+    starting with # are ignored.
+    '''
+    with open(filename) as f:
+        return import_labels([l.strip() for l in f if l.strip() and not l.startswith('#')])
+
+
+DEVICE_COLUMNS = ('id', 'name', 'fingerprint', 'p2p_addr', 'ip', 'state', 'last_seen', 'created')
+
+
+@locked
+def _get_device(column, value):
+    c = db.cursor()
+    c.execute('SELECT %s FROM device WHERE %s=?' % (', '.join(DEVICE_COLUMNS), column), (value,))
+    row = c.fetchone()
+    return None if row is None else dict(zip(DEVICE_COLUMNS, row))
+
+
+def device_by_name(name):
+    return _get_device('name', name)
+
+
+def device_by_fingerprint(fingerprint):
+    return _get_device('fingerprint', fingerprint)
+
+
+def device_by_p2p_addr(addr):
+    return _get_device('p2p_addr', addr)
+
+
+def is_registered(fingerprint):
+    return device_by_fingerprint(fingerprint) is not None
+
+
+@locked
+def device_seen(fingerprint, ip=None, p2p_addr=None):
+    '''Record where the registered device with the given fingerprint was
+    last seen. A new device that has been seen is enrolled. Return False if
+    the device is not registered.
+    '''
+    c = db.cursor()
+    if ip is not None:
+        # Addresses get reused, the device that had this one has moved on
+        c.execute('UPDATE device SET ip=NULL WHERE ip=? AND fingerprint!=?', (ip, fingerprint))
+    c.execute('''UPDATE device SET ip=coalesce(?, ip), p2p_addr=coalesce(?, p2p_addr),
+                 state=CASE state WHEN "new" THEN "enrolled" ELSE state END,
+                 last_seen=CURRENT_TIMESTAMP WHERE fingerprint=?''',
+              (ip, p2p_addr, fingerprint))
+    db.commit()
+    return c.rowcount > 0
+
+
+@locked
+def device_provisioned(fingerprint):
+    c = db.cursor()
+    c.execute('''UPDATE device SET state="provisioned", last_seen=CURRENT_TIMESTAMP
+                 WHERE fingerprint=?''', (fingerprint,))
+    db.commit()
+    return c.rowcount > 0
+
+
+@locked
+def device_counts():
+    '''Return a list of (state, number of devices) tuples.
+    '''
+    c = db.cursor()
+    c.execute('SELECT state, count(*) FROM device GROUP BY state')
+    return c.fetchall()
+
+
+@locked
+def device_pins():
+    '''Return a dict mapping the last known IP address of each registered
+    device to its public key fingerprint.
+    '''
+    c = db.cursor()
+    c.execute('SELECT ip, fingerprint FROM device WHERE ip IS NOT NULL')
+    return dict(c.fetchall())
@@ -0,0 +1,269 @@
+import time
+import logging
+import threading
+import blinker
+from   spinet.dnssd import ANQPData
+from   spinet.timer import TimerWheel
+
+log = logging.getLogger(__name__)
+
+
+class Service(object):
+    '''A DNS-SD service discovered on a Wi-Fi P2P peer.
+
+    The attribute response holds the last ANQPResponse received from the
+    peer. Instance is the first label of the service instance name, e.g.,
+    lusab-babad for lusab-babad._spinet._tcp.local. The attribute last_seen
+    is in time.time() seconds.
+    '''
+    __slots__ = ('addr', 'response', 'instance', 'device_name', 'last_seen')
+
+    def __init__(self, addr, response, device_name=None):
+        self.addr = addr
+        self.response = response
+        self.device_name = device_name
+        self.last_seen = time.time()
+
+        data = response.data
+        if data is not None and data.type_ == ANQPData.TYPE_TXT and len(data.name.value):
+            self.instance = data.name.value[0]
+        else:
+            self.instance = None
+
+
+    @property
+    def txt(self):
+        return self.response.rdata
+
+
+    def __repr__(self):
+        return '%s(%s, %s)' % (type(self).__name__, self.addr, repr(self.instance))
+
+
+
+class ServiceDirectory(object):
+    '''Services discovered on Wi-Fi P2P peers, indexed by P2P device address.
+
+    Besides the P2P device address, services can be looked up by instance
+    name, by TXT attribute and by the peer's P2P device name. Each entry
+    expires ttl seconds after the last response from its peer unless it is
+    refreshed with touch(). Expiry is driven by a timer wheel, so its cost
+    does not depend on the number of entries.
+
+    All methods can be called from any thread. Readers that need to iterate
+    over the directory should use snapshot(), which returns an immutable
+    tuple of entries. The signal changed is sent with the entry as the sender
+    and present=True or False whenever an entry is added or removed, or its
+    instance name changes. Refreshing an entry with an unchanged instance
+    name does not send it.
+    '''
+    def __init__(self, ttl=120, tick=1.0):
+        self.ttl = ttl
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.device_names = {}
+        self.instances = {}
+        self.txt_index = {}
+        self.names = {}
+        self.wheel = TimerWheel(tick=tick)
+        self._snapshot = ()
+        self.changed = blinker.Signal()
+        self.running = False
+
+
+    def _index(self, e):
+        if e.instance is not None:
+            self.instances[e.instance.lower()] = e
+
+        if e.device_name is not None:
+            self.names[e.device_name] = e
+
+        txt = e.txt
+        if txt is not None and hasattr(txt, 'items'):
+            for k, v in txt.items():
+                self.txt_index.setdefault(k.lower(), {}).setdefault(v, set()).add(e.addr)
+
+
+    def _unindex(self, e):
+        if e.instance is not None and self.instances.get(e.instance.lower(), None) is e:
+            del self.instances[e.instance.lower()]
+
+        if e.device_name is not None and self.names.get(e.device_name, None) is e:
+            del self.names[e.device_name]
+
+        txt = e.txt
+        if txt is not None and hasattr(txt, 'items'):
+            for k, v in txt.items():
+                k = k.lower()
+                values = self.txt_index.get(k, None)
+                if values is None:
+                    continue
+                addrs = values.get(v, None)
+                if addrs is None:
+                    continue
+                addrs.discard(e.addr)
+                if not addrs:
+                    del values[v]
+                if not values:
+                    del self.txt_index[k]
+
+
+    def _remove(self, addr):
+        e = self.entries.pop(addr, None)
+        if e is not None:
+            self._unindex(e)
+            self._snapshot = None
+        self.wheel.cancel(addr)
+        return e
+
+
+    def update(self, addr, response):
+        '''Save the ANQPResponse received from the peer addr.
+        '''
+        with self.lock:
+            old = self._remove(addr)
+            e = Service(addr, response, self.device_names.get(addr, None))
+            self.entries[addr] = e
+            self._index(e)
+            self.wheel.schedule(addr, time.monotonic() + self.ttl)
+            self._snapshot = None
+        if old is None or old.instance != e.instance:
+            self.changed.send(e, present=True)
+        return e
+
+
+    def touch(self, addr):
+        '''Refresh the timestamp of the entry for the peer addr.
+        '''
+        with self.lock:
+            e = self.entries.get(addr, None)
+            if e is None:
+                return False
+            e.last_seen = time.time()
+            self.wheel.schedule(addr, time.monotonic() + self.ttl)
+            return True
+
+
+    def _removed(self, e):
+        if e is not None:
+            self.changed.send(e, present=False)
+        return e
+
+
+    def remove(self, addr):
+        with self.lock:
+            e = self._remove(addr)
+        return self._removed(e)
+
+
+    def forget(self, addr):
+        '''Remove the entry as well as the saved device name of the peer addr.
+        '''
+        with self.lock:
+            self.device_names.pop(addr, None)
+            e = self._remove(addr)
+        return self._removed(e)
+
+
+    def set_device_name(self, addr, name):
+        '''Save the P2P device name of the peer addr.
+        '''
+        with self.lock:
+            self.device_names[addr] = name
+            e = self.entries.get(addr, None)
+            if e is not None and e.device_name != name:
+                self._unindex(e)
+                e.device_name = name
+                self._index(e)
+
+
+    def expire(self, now=None):
+        '''Remove all entries whose TTL has elapsed. Return the removed entries.
+        '''
+        with self.lock:
+            rv = []
+            for addr in self.wheel.advance(now):
+                e = self._remove(addr)
+                if e is not None:
+                    rv.append(e)
+        for e in rv:
+            log.debug('Service %s expired' % repr(e))
+            self._removed(e)
+        return rv
+
+
+    def get(self, addr, default=None):
+        return self.entries.get(addr, default)
+
+
+    def __getitem__(self, addr):
+        return self.entries[addr]
+
+
+    def __contains__(self, addr):
+        return addr in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def by_instance(self, name):
+        return self.instances.get(name.lower(), None)
+
+
+    def by_device_name(self, name):
+        return self.names.get(name, None)
+
+
+    def by_txt(self, key, value=None):
+        '''Return a list of entries with the TXT attribute key. If value is
+        given, only entries where the attribute has that value are returned.
+        '''
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+
+        with self.lock:
+            values = self.txt_index.get(key.lower(), {})
+            if value is None:
+                addrs = set().union(*values.values())
+            else:
+                addrs = values.get(value, ())
+            return [self.entries[a] for a in addrs]
+
+
+    def snapshot(self):
+        '''Return a tuple of all entries in the directory.
+        '''
+        s = self._snapshot
+        if s is None:
+            with self.lock:
+                s = self._snapshot
+                if s is None:
+                    s = self._snapshot = tuple(self.entries.values())
+        return s
+
+
+    def start(self):
+        self.running = True
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        self.thread.join()
+        del self.thread
+
+
+    def run(self):
+        while self.running:
+            try:
+                self.expire()
+            except Exception:
+                log.exception('Error while expiring services')
+            self.stopped.wait(self.tick)
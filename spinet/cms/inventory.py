@@ -0,0 +1,280 @@
+import time
+import logging
+import ipaddress
+import threading
+from   spinet.wpas import parse_kv_line
+from   . import on, srv, ping, tls
+
+log = logging.getLogger(__name__)
+
+# What the commissioner knows about a physical device comes from several
+# sources that identify the device differently: Wi-Fi P2P discovery and DNS-SD
+# (P2P device address), the group's station list (interface address), IP node
+# discovery (IP address) and TLS (public key fingerprint of an IP address).
+# The inventory joins them as events arrive, so that a device can be looked up
+# by any of its identifiers without querying wpa_supplicant.
+
+
+class Device(object):
+    '''A physical device, identified by its P2P device address.
+
+    The attribute peer is True while the device is a discovered P2P peer,
+    iface_addr is its interface address while it is connected to one of our
+    groups, and instance is the DNS-SD instance name of its service, if any.
+    '''
+    __slots__ = ('p2p_addr', 'device_name', 'iface_addr', 'instance', 'peer', 'last_seen')
+
+    def __init__(self, p2p_addr):
+        self.p2p_addr = p2p_addr
+        self.device_name = None
+        self.iface_addr = None
+        self.instance = None
+        self.peer = False
+        self.last_seen = time.time()
+
+
+    def __repr__(self):
+        return '%s(%s, %s)' % (type(self).__name__, self.p2p_addr, repr(self.device_name))
+
+
+
+def eui64_lladdr(ip):
+    '''Return the link-layer address embedded in a modified EUI-64 interface
+    identifier of the IPv6 address ip, or None.
+    '''
+    try:
+        b = ipaddress.IPv6Address(ip.split('%', 1)[0]).packed
+    except ValueError:
+        return None
+    if b[11] != 0xff or b[12] != 0xfe:
+        return None
+    return ':'.join('%02x' % v for v in (b[8] ^ 0x02, b[9], b[10], b[13], b[14], b[15]))
+
+
+class Inventory(object):
+    '''Devices indexed by P2P device address, interface address, device name,
+    DNS-SD instance name, IP address and public key fingerprint.
+
+    IP addresses are mapped to link-layer addresses (the interface address of
+    a connected device) and fingerprints to IP addresses, so a lookup by IP
+    address or fingerprint takes two or three dict lookups. All lookups are
+    O(1) and do not lock. Updates can be called from any thread.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}      # P2P device address -> Device
+        self.iface_addrs = {}  # Interface address -> Device
+        self.names = {}        # Device name -> Device
+        self.instances = {}    # Lowercase instance name -> Device
+        self.ip_lladdr = {}    # IP address -> link-layer address
+        self.lladdr_ips = {}   # Link-layer address -> set of IP addresses
+        self.ip_fpr = {}       # IP address -> public key fingerprint
+        self.fpr_ip = {}       # Public key fingerprint -> IP address
+
+
+    def _device(self, p2p_addr):
+        d = self.devices.get(p2p_addr, None)
+        if d is None:
+            d = self.devices[p2p_addr] = Device(p2p_addr)
+        d.last_seen = time.time()
+        return d
+
+
+    def _set(self, index, key, d, old=None):
+        if old is not None and index.get(old, None) is d:
+            del index[old]
+        if key is not None:
+            index[key] = d
+
+
+    def _gc(self, d):
+        # Forget devices that are no longer known to any source
+        if d.peer or d.iface_addr is not None or d.instance is not None:
+            return
+        del self.devices[d.p2p_addr]
+        self._set(self.names, None, d, d.device_name)
+
+
+    def peer_found(self, p2p_addr, name=None):
+        with self.lock:
+            d = self._device(p2p_addr)
+            d.peer = True
+            if name is not None and name != d.device_name:
+                self._set(self.names, name, d, d.device_name)
+                d.device_name = name
+
+
+    def peer_lost(self, p2p_addr):
+        with self.lock:
+            d = self.devices.get(p2p_addr, None)
+            if d is not None:
+                d.peer = False
+                self._gc(d)
+
+
+    def station(self, iface_addr, p2p_addr, connected):
+        iface_addr = iface_addr.lower()
+        with self.lock:
+            if connected:
+                d = self._device(p2p_addr)
+                self._set(self.iface_addrs, iface_addr, d, d.iface_addr)
+                d.iface_addr = iface_addr
+            else:
+                d = self.devices.get(p2p_addr, None)
+                if d is not None and d.iface_addr == iface_addr:
+                    self._set(self.iface_addrs, None, d, iface_addr)
+                    d.iface_addr = None
+                    self._gc(d)
+
+
+    def service(self, p2p_addr, instance):
+        '''Save the DNS-SD instance name of the device, None if the device no
+        longer has a service.
+        '''
+        with self.lock:
+            d = self._device(p2p_addr) if instance is not None else self.devices.get(p2p_addr, None)
+            if d is None:
+                return
+            self._set(self.instances, instance and instance.lower(), d, d.instance and d.instance.lower())
+            d.instance = instance
+            self._gc(d)
+
+
+    def ip(self, ip, lladdr, present):
+        '''Map the IP address to the link-layer address lladdr, or remove the
+        IP address if present is False.
+        '''
+        with self.lock:
+            old = self.ip_lladdr.pop(ip, None)
+            if old is not None:
+                ips = self.lladdr_ips[old]
+                ips.discard(ip)
+                if not ips:
+                    del self.lladdr_ips[old]
+
+            if present and lladdr is not None:
+                lladdr = lladdr.lower()
+                self.ip_lladdr[ip] = lladdr
+                self.lladdr_ips.setdefault(lladdr, set()).add(ip)
+
+
+    def pin(self, ip, fingerprint):
+        with self.lock:
+            old = self.ip_fpr.get(ip, None)
+            if old is not None and self.fpr_ip.get(old, None) == ip:
+                del self.fpr_ip[old]
+            self.ip_fpr[ip] = fingerprint
+            self.fpr_ip[fingerprint] = ip
+
+
+    def get(self, p2p_addr, default=None):
+        return self.devices.get(p2p_addr, default)
+
+
+    def by_iface_addr(self, addr):
+        return self.iface_addrs.get(addr.lower(), None)
+
+
+    def by_name(self, name):
+        '''Return the device with the given P2P device name or DNS-SD instance
+        name.
+        '''
+        return self.names.get(name, None) or self.instances.get(name.lower(), None)
+
+
+    def by_instance(self, name):
+        return self.instances.get(name.lower(), None)
+
+
+    def by_ip(self, ip):
+        lladdr = self.ip_lladdr.get(ip, None)
+        return self.iface_addrs.get(lladdr, None) if lladdr is not None else None
+
+
+    def by_fingerprint(self, fingerprint):
+        ip = self.fpr_ip.get(fingerprint, None)
+        return self.by_ip(ip) if ip is not None else None
+
+
+    def ips(self, d):
+        '''Return the IP addresses of the device d.
+        '''
+        if d is None or d.iface_addr is None:
+            return ()
+        return tuple(self.lladdr_ips.get(d.iface_addr, ()))
+
+
+    def fingerprint(self, d):
+        '''Return the public key fingerprint pinned for any of the IP
+        addresses of the device d, or None.
+        '''
+        for ip in self.ips(d):
+            fpr = self.ip_fpr.get(ip, None)
+            if fpr is not None:
+                return fpr
+        return None
+
+
+    def snapshot(self):
+        '''Return a tuple of all devices.
+        '''
+        with self.lock:
+            return tuple(self.devices.values())
+
+
+    def __len__(self):
+        return len(self.devices)
+
+
+
+devices = Inventory()
+
+
+def ip_of(name):
+    '''Return an IP address of the device with the given P2P device name or
+    DNS-SD instance name, or None.
+    '''
+    ips = devices.ips(devices.by_name(name))
+    return ips[0] if ips else None
+
+
+@on('P2P-DEVICE-FOUND')
+def device_found(ifname, data, **kwds):
+    sep = data.find(' ')
+    d = parse_kv_line(data[sep:])
+    name = d.get('name', None)
+    devices.peer_found(d['p2p_dev_addr'], name.strip("'") if name is not None else None)
+
+
+@on('P2P-DEVICE-LOST')
+def device_lost(ifname, data, **kwds):
+    devices.peer_lost(parse_kv_line(data)['p2p_dev_addr'])
+
+
+@on('AP-STA-CONNECTED')
+@on('AP-STA-DISCONNECTED')
+def station_event(ifname, event, data, **kwds):
+    sep = data.find(' ')
+    if sep == -1:
+        return
+    p2p_addr = parse_kv_line(data[sep:]).get('p2p_dev_addr', None)
+    if p2p_addr is None:
+        return
+    devices.station(data[:sep], p2p_addr, event == 'AP-STA-CONNECTED')
+
+
+@srv.services.changed.connect
+def service_changed(e, present, **kwds):
+    devices.service(e.addr, e.instance if present else None)
+
+
+@ping.node_changed.connect
+def node_changed(addr, joined, **kwds):
+    node = ping.ip_nodes().get(addr, None)
+    lladdr = node.lladdr if node is not None else None
+    devices.ip(addr, lladdr or eui64_lladdr(addr), joined)
+
+
+@tls.pinned.connect
+def key_pinned(ip, fingerprint, **kwds):
+    devices.pin(ip, fingerprint)
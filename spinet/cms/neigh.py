@@ -0,0 +1,295 @@
+import os
+import socket
+import select
+import logging
+import ipaddress
+import threading
+import time
+from   pyroute2.netlink.rtnl import RTMGRP_NEIGH
+from   pyroute2.netlink.rtnl.marshal import MarshalRtnl
+from   pyroute2.netlink.rtnl.ndmsg import NUD_REACHABLE, NUD_STALE, NUD_DELAY, NUD_PROBE, NUD_FAILED
+from   spinet.timer import TimerWheel
+from   spinet.netlink import links
+from   .ping import Interface, Node
+
+log = logging.getLogger(__name__)
+
+# Neighbor states in which the kernel considers a node present
+NUD_VALID = NUD_REACHABLE | NUD_STALE | NUD_DELAY | NUD_PROBE
+
+
+class NeighborMonitor(object):
+    '''Discover IPv6 nodes on a set of interfaces passively from the kernel's
+    neighbor table.
+
+    The monitor subscribes to RTM_NEWNEIGH and RTM_DELNEIGH notifications. A
+    node joins when the kernel learns its link-layer address and leaves when
+    the entry is deleted or fails resolution. Nodes confirmed reachable by
+    the kernel are marked as seen. No packets are sent in the steady state.
+
+    The monitor probes actively only on demand: reset() sends a single
+    multicast echo request on each interface (at most once every
+    probe_interval seconds) and a node that has not been seen for probe_after
+    seconds gets a unicast echo request. The latter makes the kernel verify
+    the neighbor entry, so that nodes that have gone away fail resolution and
+    leave. Echo replies mark nodes as seen and provide RTT samples.
+
+    Nodes are published like in IPv6McastPinger: the attribute nodes is a
+    dict mapping the IP address of a node to its Node statistics that is
+    never resized, only replaced.
+    '''
+    def __init__(self, probe_after=60, probe_interval=1, tick=1, notify=None):
+        self.probe_after = probe_after
+        self.probe_interval = probe_interval
+        self.notify = notify
+
+        self.nodes = {}
+        self.probes = TimerWheel(tick=tick)
+        self.last_probe = None
+        self.interfaces = {}
+        self.indices = {}
+        self.fds = {}
+
+        self.lock = threading.Lock()
+        self.epoll = select.epoll()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.epoll.register(self.wakeup_r, select.EPOLLIN)
+
+        # A plain netlink socket subscribed to neighbor notifications. The
+        # messages are parsed with pyroute2, whose IPRoute objects cannot be
+        # used from another thread than the one that created them.
+        self.marshal = MarshalRtnl()
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_NEIGH))
+        self.sock.setblocking(False)
+        self.epoll.register(self.sock.fileno(), select.EPOLLIN)
+
+        self.thread = None
+        self.running = False
+
+
+    def _wakeup(self):
+        os.write(self.wakeup_w, b'\0')
+
+
+    def add_interface(self, ifname):
+        iface = Interface(ifname)
+
+        # Nodes already in the neighbor table
+        dump = links.neighbours(ifname)
+
+        with self.lock:
+            if ifname in self.interfaces:
+                iface.close()
+                return
+
+            self.interfaces[ifname] = iface
+            self.indices[iface.index] = iface
+            self.fds[iface.fileno()] = iface
+            self.epoll.register(iface.fileno(), select.EPOLLIN)
+
+            joined, left = {}, []
+            now, mono = time.time(), time.monotonic()
+            for msg in dump:
+                self._neighbor(msg, now, mono, joined, left)
+            self._publish(joined, left)
+        self._notify(joined, left)
+        self._wakeup()
+
+
+    def remove_interface(self, ifname):
+        with self.lock:
+            iface = self.interfaces.pop(ifname, None)
+            if iface is None:
+                return
+
+            del self.indices[iface.index]
+            del self.fds[iface.fileno()]
+            self.epoll.unregister(iface.fileno())
+            iface.close()
+
+            gone = [addr for addr, node in self.nodes.items() if node.ifname == ifname]
+            for addr in gone:
+                self.probes.cancel(addr)
+            self._publish({}, gone)
+        self._notify({}, gone)
+
+
+    def reset(self, ifname=None):
+        '''Probe the given interface (all interfaces if ifname is None) with a
+        multicast echo request, unless that has been done less than
+        probe_interval seconds ago.
+        '''
+        with self.lock:
+            mono = time.monotonic()
+            if self.last_probe is not None and mono - self.last_probe < self.probe_interval:
+                return
+            self.last_probe = mono
+            for iface in self.interfaces.values():
+                if ifname is None or iface.ifname == ifname:
+                    iface.ping(mono)
+
+
+    def snapshot(self):
+        '''Return the published dict of nodes. The dict must not be
+        modified.
+        '''
+        return self.nodes
+
+
+    def _publish(self, joined, left):
+        if not joined and not left:
+            return
+        nodes = dict(self.nodes)
+        nodes.update(joined)
+        for addr in left:
+            nodes.pop(addr, None)
+        self.nodes = nodes
+
+
+    def _notify(self, joined, left):
+        if self.notify is None:
+            return
+        for addr in joined:
+            self.notify(True, addr)
+        for addr in left:
+            self.notify(False, addr)
+
+
+    def _seen(self, iface, addr, now, mono, joined, rtt=None, lladdr=None):
+        node = self.nodes.get(addr, None) or joined.get(addr, None)
+        if node is None:
+            node = joined[addr] = Node(addr, iface.ifname)
+        if lladdr is not None:
+            node.lladdr = lladdr
+        node.update(now, rtt=rtt)
+        if self.probe_after is not None:
+            self.probes.schedule(addr, mono + self.probe_after)
+
+
+    def _gone(self, addr, joined, left):
+        self.probes.cancel(addr)
+        if joined.pop(addr, None) is None and addr in self.nodes and addr not in left:
+            left.append(addr)
+
+
+    def _neighbor(self, msg, now, mono, joined, left):
+        if msg['family'] != socket.AF_INET6:
+            return
+
+        iface = self.indices.get(msg['ifindex'], None)
+        dst = msg.get_attr('NDA_DST')
+        if iface is None or dst is None:
+            return
+
+        ip = ipaddress.ip_address(dst)
+        if ip.is_multicast or dst in links.addresses(iface.ifname):
+            return
+        addr = dst + iface.suffix if ip.is_link_local else dst
+
+        state = msg['state']
+        lladdr = msg.get_attr('NDA_LLADDR')
+        if msg['event'] == 'RTM_DELNEIGH' or state & NUD_FAILED:
+            self._gone(addr, joined, left)
+        elif state & NUD_REACHABLE:
+            self._seen(iface, addr, now, mono, joined, lladdr=lladdr)
+        elif state & NUD_VALID and addr not in self.nodes:
+            # A new stale entry means the node has just sent us something
+            self._seen(iface, addr, now, mono, joined, lladdr=lladdr)
+
+
+    def _probe(self, mono):
+        for addr in self.probes.advance(mono):
+            node = self.nodes.get(addr, None)
+            iface = self.interfaces.get(node.ifname, None) if node is not None else None
+            if iface is None:
+                continue
+            log.debug('Probing %s' % addr)
+            iface.ping(mono, addr)
+            self.probes.schedule(addr, mono + self.probe_after)
+
+
+    def _timeout(self, mono):
+        if len(self.probes):
+            return max(0, (self.probes.current + 1) * self.probes.tick - mono)
+        return None
+
+
+    def _netlink(self):
+        rv = []
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # ENOBUFS if notifications have been lost
+                log.warning('Could not receive neighbor notifications: %s' % e)
+                break
+            rv.extend(self.marshal.parse(data))
+        return rv
+
+
+    def _receive(self, fds, now, mono):
+        joined, left = {}, []
+        for fd in fds:
+            if fd == self.sock.fileno():
+                for msg in self._netlink():
+                    self._neighbor(msg, now, mono, joined, left)
+                continue
+
+            iface = self.fds.get(fd, None)
+            if iface is None:
+                continue
+            for addr, _, rtt in iface.receive(mono):
+                if addr not in left:
+                    self._seen(iface, addr, now, mono, joined, rtt)
+
+        self._publish(joined, left)
+        return joined, left
+
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+            self.running = False
+        if thread is not None:
+            self._wakeup()
+            thread.join()
+
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                self._probe(time.monotonic())
+                timeout = self._timeout(time.monotonic())
+
+            events = self.epoll.poll(timeout)
+            now, mono = time.time(), time.monotonic()
+
+            fds = []
+            for fd, _ in events:
+                if fd == self.wakeup_r:
+                    while True:
+                        try:
+                            if not os.read(self.wakeup_r, 4096):
+                                break
+                        except BlockingIOError:
+                            break
+                else:
+                    fds.append(fd)
+
+            with self.lock:
+                joined, left = self._receive(fds, now, mono)
+            self._notify(joined, left)
@@ -1,138 +1,484 @@
+import os
+import heapq
+import struct
+import random
 import logging
+import itertools
 import threading
-import netifaces
 import socket
 import select
 import time
+import blinker
 from   . import sup, on
+from   spinet.timer import TimerWheel
+from   spinet.netlink import links
 
 icmp = socket.getprotobyname('ipv6-icmp')
 
 log = logging.getLogger(__name__)
 
-pingers = {}
+ECHO_REQUEST = 128
+ECHO_REPLY   = 129
+ICMP6_FILTER = 1 # Socket option from <netinet/icmp6.h> (Linux)
 
+ECHO = struct.Struct('!BBHHH') # Type, code, checksum, identifier, sequence
+
+RTT_ALPHA  = 1 / 8 # Gain of the RTT moving average (as in RFC 6298)
+LOSS_ALPHA = 1 / 8 # Gain of the loss rate moving average
 
-class IPv6McastPinger(object):
-    DATA = '\x80\0\0\0\0\0\0\0'
-    ALL_NODES = 'ff02::1'
 
+class Node(object):
+    '''Ping statistics of one node.
 
-    def __init__(self, data, ifname, ping_interval=1, lifetime=5, purge_interval=1, notify=None):
-        self.data = data
+    rtt is the exponentially weighted moving average of the round-trip time
+    in seconds (None until the first matched reply) and loss the moving
+    average of the fraction of unanswered pings. A missed ping is only
+    accounted for when the next reply from the node arrives. Updates without
+    a sequence number (e.g., from the neighbor table) leave loss untouched.
+    The link-layer address lladdr is only known from the neighbor table.
+    '''
+    __slots__ = ('addr', 'ifname', 'lladdr', 'last_seen', 'last_seq', 'rtt', 'loss', 'replies')
+
+    def __init__(self, addr, ifname):
+        self.addr = addr
         self.ifname = ifname
-        self.ping_interval = ping_interval
-        self.lifetime = lifetime
-        self.purge_interval = purge_interval
-        self.notify = notify
+        self.lladdr = None
+        self.last_seen = None
+        self.last_seq = None
+        self.rtt = None
+        self.loss = 0.0
+        self.replies = 0
+
+
+    def update(self, now, seq=None, rtt=None):
+        self.last_seen = now
+        self.replies += 1
+
+        if seq is not None and self.last_seq is not None:
+            d = (seq - self.last_seq) & 0xffff
+            if d == 0 or d >= 0x8000:
+                # Duplicate or reordered reply
+                return
+            # d - 1 pings were lost, followed by one answered ping
+            self.loss = 1 - (1 - LOSS_ALPHA) ** (d - 1) * (1 - self.loss)
+            self.loss *= 1 - LOSS_ALPHA
+        if seq is not None:
+            self.last_seq = seq
+
+        if rtt is not None:
+            if self.rtt is None:
+                self.rtt = rtt
+            else:
+                self.rtt += RTT_ALPHA * (rtt - self.rtt)
+
+
+    def __repr__(self):
+        return '%s(%s, rtt=%s, loss=%.2f)' % (type(self).__name__, self.addr, self.rtt, self.loss)
+
 
-        self.last_ping = 0
-        self.last_purge = 0
 
-        self.my_addrs = [i['addr'] for i in netifaces.ifaddresses(ifname)[netifaces.AF_INET6]]
+class Interface(object):
+    '''Raw ICMPv6 socket used to ping the all-nodes multicast address on one
+    interface.
+
+    Echo requests carry an identifier unique to the interface and a sequence
+    number. The send times of the last WINDOW requests are kept to match the
+    replies and compute round-trip times.
+    '''
+    ALL_NODES = 'ff02::1'
+    WINDOW = 64
+
+    def __init__(self, ifname, interval=None):
+        self.ifname = ifname
+        self.index = links.index(ifname)
+        self.suffix = '%' + ifname
+
+        self.ident = random.getrandbits(16)
+        self.seq = 0
+        self.sent = {}
+        self.interval = interval
+        self.next = None
+        self.changed = True # Nothing is known about membership yet
 
         addrs = socket.getaddrinfo('%s%%%s' % (self.ALL_NODES, ifname), 0, socket.AF_INET6, 0, socket.SOL_IP)
         self.addr = addrs[0][4]
+
         self.sock = socket.socket(socket.AF_INET6, socket.SOCK_RAW, icmp)
+        self.sock.setblocking(False)
+        try:
+            # Only receive ICMPv6 packets from this interface
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, ifname.encode())
+        except OSError as e:
+            log.warning('Could not bind ICMPv6 socket to %s: %s' % (ifname, e))
+
+        try:
+            # Let the kernel drop all ICMPv6 messages except echo replies
+            data = [0xffffffff] * 8
+            data[ECHO_REPLY >> 5] &= ~(1 << (ECHO_REPLY & 31))
+            self.sock.setsockopt(socket.IPPROTO_ICMPV6, ICMP6_FILTER, struct.pack('8I', *data))
+        except OSError as e:
+            log.warning('Could not set ICMPv6 filter on %s: %s' % (ifname, e))
 
-        self.running = False
 
+    def fileno(self):
+        return self.sock.fileno()
 
-    def ping(self):
+
+    def ping(self, mono, addr=None):
+        '''Send an echo request to the all-nodes multicast address, or to the
+        given unicast address.
+        '''
+        self.seq = (self.seq + 1) & 0xffff
+        self.sent.pop((self.seq - self.WINDOW) & 0xffff, None)
+        self.sent[self.seq] = mono
+
+        dst = self.addr if addr is None else (addr.split('%', 1)[0], 0, 0, self.index)
+
+        # The kernel computes the checksum of ICMPv6 messages
         try:
-            self.sock.sendto(self.DATA, self.addr)
-        except Exception as e:
-            pass
+            self.sock.sendto(ECHO.pack(ECHO_REQUEST, 0, 0, self.ident, self.seq), dst)
+        except OSError as e:
+            log.debug('Could not send ping on %s: %s' % (self.ifname, e))
+
+
+    def receive(self, mono):
+        '''Return a list of (address, sequence number, round-trip time)
+        tuples for the echo replies to our requests received since the last
+        call. The round-trip time is None if the request is no longer known.
+        '''
+        rv = []
+        mine = links.addresses(self.ifname)
+        while True:
+            try:
+                msg, addrinfo = self.sock.recvfrom(4096)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                log.debug('Could not receive on %s: %s' % (self.ifname, e))
+                break
 
+            if len(msg) < ECHO.size:
+                continue
+            type_, _, _, ident, seq = ECHO.unpack_from(msg)
+            if type_ != ECHO_REPLY or ident != self.ident:
+                continue
 
-    def purge(self):
-        now = time.time()
-        for addr in list(self.data.keys()):
-            timestamp = self.data[addr]
-            if (timestamp + self.lifetime) < now:
-                del self.data[addr]
-                if self.notify:
-                    self.notify(False, addr)
+            addr, _, _, scope = addrinfo
+            if addr.split('%', 1)[0] in mine:
+                continue
 
+            # Link-local addresses need the interface name to be usable.
+            # Python (3.7+) includes it in the address string, but ignore
+            # replies that arrived on another interface and add the name in
+            # case the address string has no scope.
+            if scope:
+                if scope != self.index:
+                    continue
+                if '%' not in addr:
+                    addr += self.suffix
 
-    def process_response(self, msg, addrinfo):
-        addr = addrinfo[0]
+            sent = self.sent.get(seq, None)
+            rv.append((addr, seq, None if sent is None else mono - sent))
+        return rv
 
-        if not self.ifname in addr:
-            return
 
-        if addr in self.my_addrs:
-            return
+    def close(self):
+        self.sock.close()
+
+
+
+class IPv6McastPinger(object):
+    '''Periodically ping the all-nodes multicast address on a set of
+    interfaces and keep track of the nodes that respond.
+
+    A single thread serves all interfaces: it waits for echo replies on the
+    interfaces' sockets with epoll, keeps the times of the next ping on each
+    interface in a heap and expires nodes that have not responded with a
+    timer wheel. No step scans all nodes or all interfaces.
+
+    Each interface is pinged every min_interval seconds at first. While no
+    node joins or leaves, the interval grows by the factor backoff after each
+    ping up to max_interval. A change in membership (or a call to reset())
+    brings the interface back to min_interval. Every interval is randomized
+    by +/- jitter to avoid synchronized bursts. A node expires when it has
+    not responded for lifetime seconds or misses pings, whichever is longer.
+
+    The current set of nodes is published in the attribute nodes, a dict
+    mapping the IP address of a node to its Node statistics. A published dict
+    is never resized: when nodes join or leave, a new dict is published
+    instead. Readers can therefore use it without locking, but must not
+    modify it.
+    '''
+    def __init__(self, min_interval=1, max_interval=30, backoff=2, jitter=0.2,
+                 lifetime=5, misses=3, tick=0.5, notify=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.lifetime = lifetime
+        self.misses = misses
+        self.notify = notify
+
+        self.nodes = {}
+        self.expiry = TimerWheel(tick=tick)
+        self.interfaces = {}
+        self.fds = {}
+        self.schedule = []
+        self.seq = itertools.count()
+
+        self.lock = threading.Lock()
+        self.epoll = select.epoll()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.epoll.register(self.wakeup_r, select.EPOLLIN)
+
+        self.thread = None
+        self.running = False
+
+
+    def _wakeup(self):
+        os.write(self.wakeup_w, b'\0')
 
-        new = self.data.get(addr, None) is None
-        self.data[addr] = time.time()
-        if new and self.notify:
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+    def _reschedule(self, iface, t):
+        # Entries whose time differs from iface.next are stale and are
+        # dropped lazily by _ping
+        iface.next = t
+        heapq.heappush(self.schedule, (t, next(self.seq), iface))
+
+
+    def add_interface(self, ifname):
+        iface = Interface(ifname, self.min_interval)
+        with self.lock:
+            if ifname in self.interfaces:
+                iface.close()
+                return
+
+            self.interfaces[ifname] = iface
+            self.fds[iface.fileno()] = iface
+            self.epoll.register(iface.fileno(), select.EPOLLIN)
+            self._reschedule(iface, time.monotonic())
+        self._wakeup()
+
+
+    def remove_interface(self, ifname):
+        with self.lock:
+            iface = self.interfaces.pop(ifname, None)
+            if iface is None:
+                return
+
+            del self.fds[iface.fileno()]
+            self.epoll.unregister(iface.fileno())
+            iface.close()
+
+            gone = [addr for addr, node in self.nodes.items() if node.ifname == ifname]
+            for addr in gone:
+                self.expiry.cancel(addr)
+            self._publish({}, gone)
+        self._notify({}, gone)
+
+
+    def _reset(self, iface, mono):
+        iface.interval = self.min_interval
+        t = mono + self._jittered(self.min_interval)
+        if iface.next is None or iface.next > t:
+            self._reschedule(iface, t)
+
+
+    def reset(self, ifname=None):
+        '''Go back to pinging the given interface (all interfaces if ifname
+        is None) every min_interval seconds.
+        '''
+        with self.lock:
+            mono = time.monotonic()
+            for iface in self.interfaces.values():
+                if ifname is None or iface.ifname == ifname:
+                    self._reset(iface, mono)
+        self._wakeup()
+
+
+    def snapshot(self):
+        '''Return the published dict of nodes. The dict must not be
+        modified.
+        '''
+        return self.nodes
+
+
+    def _publish(self, joined, left):
+        nodes = dict(self.nodes)
+        nodes.update(joined)
+        for addr in left:
+            nodes.pop(addr, None)
+        self.nodes = nodes
+
+
+    def _notify(self, joined, left):
+        if self.notify is None:
+            return
+        for addr in joined:
             self.notify(True, addr)
+        for addr in left:
+            self.notify(False, addr)
+
+
+    def _ping(self, mono):
+        # Ping every interface whose time has come. Entries of interfaces
+        # that have been removed or rescheduled are dropped lazily.
+        while self.schedule and self.schedule[0][0] <= mono:
+            t, _, iface = heapq.heappop(self.schedule)
+            if self.interfaces.get(iface.ifname, None) is not iface or iface.next != t:
+                continue
+            iface.ping(mono)
+
+            if iface.changed:
+                iface.interval = self.min_interval
+                iface.changed = False
+            else:
+                iface.interval = min(iface.interval * self.backoff, self.max_interval)
+            self._reschedule(iface, max(t + self._jittered(iface.interval), mono))
+
+
+    def _timeout(self, mono):
+        t = []
+        if self.schedule:
+            t.append(self.schedule[0][0] - mono)
+        if len(self.expiry):
+            t.append((self.expiry.current + 1) * self.expiry.tick - mono)
+        return max(0, min(t)) if t else None
+
+
+    def _receive(self, fds, now, mono):
+        joined = {}
+        for fd in fds:
+            iface = self.fds.get(fd, None)
+            if iface is None:
+                continue
+
+            lifetime = max(self.lifetime, self.misses * iface.interval * (1 + self.jitter))
+            for addr, seq, rtt in iface.receive(mono):
+                # Existing nodes are updated in place, which does not resize
+                # the published dict
+                node = self.nodes.get(addr, None) or joined.get(addr, None)
+                if node is None:
+                    node = joined[addr] = Node(addr, iface.ifname)
+                node.update(now, seq, rtt)
+                self.expiry.schedule(addr, mono + lifetime)
+
+        left = [addr for addr in self.expiry.advance(mono) if addr in self.nodes]
+        if joined or left:
+            changed = set([n.ifname for n in joined.values()] + [self.nodes[addr].ifname for addr in left])
+            self._publish(joined, left)
+            for ifname in changed:
+                iface = self.interfaces.get(ifname, None)
+                if iface is not None and not iface.changed:
+                    iface.changed = True
+                    self._reset(iface, mono)
+        return joined, left
 
 
     def start(self):
-        self.thread = threading.Thread(target=self.run)
-        self.thread.daemon = True
-        self.thread.start()
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
 
 
     def stop(self):
-        self.running = False
-        del self.thread
+        with self.lock:
+            thread, self.thread = self.thread, None
+            self.running = False
+        if thread is not None:
+            self._wakeup()
+            thread.join()
 
 
     def run(self):
-        self.running = True
         while self.running:
-            now = time.time()
-            try:
-                t1 = self.last_ping + self.ping_interval - now
-                t2 = self.last_purge + self.purge_interval - now
-                tout = min(t1, t2)
-                if tout <= 0:
-                    tout = 0.01
+            with self.lock:
+                self._ping(time.monotonic())
+                timeout = self._timeout(time.monotonic())
 
-                self.sock.settimeout(tout)
-                msg, addrinfo = self.sock.recvfrom(4096)
-            except socket.timeout:
-                pass
-            else:
-                self.process_response(msg, addrinfo)
+            events = self.epoll.poll(timeout)
+            now, mono = time.time(), time.monotonic()
+
+            fds = []
+            for fd, _ in events:
+                if fd == self.wakeup_r:
+                    while True:
+                        try:
+                            if not os.read(self.wakeup_r, 4096):
+                                break
+                        except BlockingIOError:
+                            break
+                else:
+                    fds.append(fd)
+
+            with self.lock:
+                joined, left = self._receive(fds, now, mono)
+            self._notify(joined, left)
+
+
+# Sent with the IP address of a node as the sender and joined=True or False
+# whenever a node joins or leaves
+node_changed = blinker.Signal()
 
-            if (now - self.last_ping) > self.ping_interval:
-                self.ping()
-                self.last_ping = now
 
-            if (now - self.last_purge) > self.purge_interval:
-                self.purge()
-                self.last_purge = now
+def notify(joined, addr):
+    node_changed.send(addr, joined=joined)
+
+
+pinger = IPv6McastPinger(notify=notify)
+
+# The IP node discovery backend. Any object with the methods add_interface,
+# remove_interface, reset, snapshot and start of IPv6McastPinger can be used,
+# e.g., spinet.cms.neigh.NeighborMonitor. It should be created with
+# notify=notify.
+monitor = pinger
 
 
 def ip_nodes():
-    for _, p in pingers.items():
-        for k in p['data'].keys():
-            yield k
+    '''Return the published dict mapping the IP address of each discovered
+    node to its Node statistics. Iterating over it yields the IP addresses.
+    The dict must not be modified.
+    '''
+    return monitor.snapshot()
+
+
+def last_seen(ip):
+    '''Return the time (time.time()) when the node with the given IP address
+    was last seen alive, or None if the node is not known.
+    '''
+    node = monitor.snapshot().get(ip, None)
+    return None if node is None else node.last_seen
+
+
+def probe():
+    '''Look for nodes actively now, e.g., when nodes are expected to
+    reconnect. The pinger goes back to its minimum interval.
+    '''
+    monitor.reset()
 
 
 @on('P2P-GROUP-STARTED')
 def start_pinger(ifname, data, **kwds):
     d = data.split(' ')
     if len(d) < 2:
-        log.warn('Invalid P2P-GROUP-STARTED notification: %s' % event)
+        log.warn('Invalid P2P-GROUP-STARTED notification: %s' % data)
         return
 
     if d[1] != 'GO':
         return
 
-    ifn = d[0]
-    if pingers.get(ifn, None) is None:
-        log.debug('Starting IPv6 pinger for interface %s' % ifn)
-        pingers[ifn] = {
-            'data': {}
-        }
-        p = IPv6McastPinger(pingers[ifn]['data'], ifn)
-        pingers[ifn]['pinger'] = p
-        p.start()
+    log.debug('Starting IP node discovery on interface %s' % d[0])
+    monitor.add_interface(d[0])
+    monitor.start()
 
 
 @on('P2P-GROUP-REMOVED')
@@ -144,8 +490,13 @@ def stop_pinger(ifname, data, **kwds):
     if d[1] != 'GO':
         return
 
-    ifn = d[0]
-    if pingers.get(ifn, None) is not None:
-        log.debug('Stopping IPv6 pinger for interface %s' % ifn)
-        pingers[ifn]['pinger'].stop()
-        del pingers[ifn]
+    log.debug('Stopping IP node discovery on interface %s' % d[0])
+    monitor.remove_interface(d[0])
+
+
+@on('AP-STA-CONNECTED')
+@on('AP-STA-DISCONNECTED')
+def station_changed(ifname, data, **kwds):
+    # The event does not say which group the station belongs to. Probe all
+    # groups quickly so that the change is picked up soon.
+    monitor.reset()
@@ -0,0 +1,175 @@
+import time
+import heapq
+import logging
+import threading
+from   spinet.dnssd import ANQPResponse
+from   spinet.timer import TimerWheel
+
+log = logging.getLogger(__name__)
+
+
+class DiscoveryScheduler(object):
+    '''Schedule targeted (unicast) service discovery queries to P2P peers.
+
+    A peer is queried when it is found and then again every refresh seconds
+    for as long as it answers. At most max_inflight queries are outstanding
+    at any time. Peers that do not answer, or answer with an error, are
+    retried with exponential backoff. Peers that answer PROTO_UNAVAILABLE do
+    not run spinet and are put into a negative cache; they are not queried
+    again until the (exponentially growing) negative cache entry expires,
+    even if they are lost and found again in the meantime.
+
+    The function query(addr, timeout) sends a query and returns the
+    corresponding Transaction. Responses must be reported with responded().
+    '''
+    def __init__(self, query, transactions, max_inflight=4, refresh=60, timeout=5,
+                 backoff=30, max_backoff=3600, interval=0.5):
+        self.query = query
+        self.transactions = transactions
+        self.max_inflight = max_inflight
+        self.refresh = refresh
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.known = set()
+        self.peers = {}
+        self.heap = []
+        self.inflight = {}
+        self.failures = {}
+        self.negative = TimerWheel(tick=1.0, slots=256)
+        self.enabled = False
+        self.running = False
+
+
+    def _schedule(self, addr, t):
+        self.peers[addr] = t
+        heapq.heappush(self.heap, (t, addr))
+
+
+    def _backoff(self, addr):
+        n = self.failures.get(addr, 0) + 1
+        self.failures[addr] = n
+        return min(self.backoff * 2 ** (n - 1), self.max_backoff)
+
+
+    def found(self, addr):
+        '''Report a newly found P2P peer.
+        '''
+        with self.lock:
+            self.known.add(addr)
+            if addr in self.negative or addr in self.peers:
+                return
+            self._schedule(addr, time.monotonic())
+
+
+    def lost(self, addr):
+        '''Report a P2P peer that is no longer reachable.
+        '''
+        with self.lock:
+            self.known.discard(addr)
+            self.peers.pop(addr, None)
+            if addr not in self.negative:
+                self.failures.pop(addr, None)
+
+
+    def responded(self, addr, code):
+        '''Report a service discovery response with status code from addr.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            self.inflight.pop(addr, None)
+
+            if code == ANQPResponse.SUCCESS:
+                self.failures.pop(addr, None)
+                if addr in self.known:
+                    self._schedule(addr, now + self.refresh)
+            elif code == ANQPResponse.PROTO_UNAVAILABLE:
+                delay = self._backoff(addr)
+                log.debug('Peer %s does not support spinet, not querying for %d s' % (addr, delay))
+                self.peers.pop(addr, None)
+                self.negative.schedule(addr, now + delay)
+            elif addr in self.known:
+                self._schedule(addr, now + self._backoff(addr))
+
+
+    def is_negative(self, addr):
+        return addr in self.negative
+
+
+    def tick(self, now=None):
+        '''Process timeouts and send queries that are due. Called periodically
+        from the scheduler thread.
+        '''
+        if now is None:
+            now = time.monotonic()
+
+        with self.lock:
+            for addr in self.negative.advance(now):
+                if addr in self.known:
+                    self._schedule(addr, now)
+                else:
+                    self.failures.pop(addr, None)
+
+            for addr, txn in list(self.inflight.items()):
+                if txn is None or txn.deadline is None or txn.deadline > now:
+                    continue
+                if self.transactions.is_pending(txn):
+                    continue
+                log.debug('Service discovery query to %s timed out' % addr)
+                del self.inflight[addr]
+                if addr in self.known:
+                    self._schedule(addr, now + self._backoff(addr))
+
+            send = []
+            if self.enabled:
+                while self.heap and len(self.inflight) < self.max_inflight:
+                    t, addr = self.heap[0]
+                    if t > now:
+                        break
+                    heapq.heappop(self.heap)
+                    if self.peers.get(addr, None) != t or addr in self.inflight:
+                        continue
+                    del self.peers[addr]
+                    self.inflight[addr] = None
+                    send.append(addr)
+
+        for addr in send:
+            try:
+                txn = self.query(addr, timeout=self.timeout)
+            except Exception as e:
+                log.debug('Could not query %s: %s' % (addr, e))
+                with self.lock:
+                    self.inflight.pop(addr, None)
+                    if addr in self.known:
+                        self._schedule(addr, now + self._backoff(addr))
+            else:
+                with self.lock:
+                    if addr in self.inflight:
+                        self.inflight[addr] = txn
+
+
+    def start(self):
+        self.running = True
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        self.thread.join()
+        del self.thread
+
+
+    def run(self):
+        while self.running:
+            try:
+                self.tick()
+            except Exception:
+                log.exception('Error in service discovery scheduler')
+            self.stopped.wait(self.interval)
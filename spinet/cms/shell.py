@@ -2,13 +2,15 @@ import sys
 import cmd
 import code
 import json
+import time
+import base64
 import logging
 from   tabulate import tabulate
 
 from .. import logger
 
 import spinet.cms as cms
-from . import data, api, srv, peer, ping
+from . import data, api, srv, peer, ping, tls, inventory
 
 log = logging.getLogger(__name__)
 
@@ -64,10 +66,7 @@ debugging to the console.
 This command shows a table of all the network blocks configured in the
 commissioner.
         '''
-        c = cms.db.cursor()
-        c.execute('SELECT id, ssid, type, attrs, created FROM net')
-
-        print(tabulate(c.fetchall(),
+        print(tabulate(data.list_nets(),
             ['Id', 'SSID', 'Type', 'Attributes', 'Created'],
             tablefmt="psql"))
 
@@ -79,12 +78,48 @@ commissioner.
         print('OK')
 
 
+    def do_net_import(self, filename):
+        '''net_import <filename> - Import networks from a JSON file
+
+The file must contain a list of objects, each with the attributes ssid and
+type and any other network attributes. WPA-PSK passphrases are converted to
+raw PSKs in parallel.
+        '''
+        with open(filename) as f:
+            nets = json.load(f)
+        data.add_nets([(n.pop('ssid'), n.pop('type', 'WPA-PSK'), n) for n in nets])
+        print('Imported %d network(s)' % len(nets))
+
+
     def do_net_remove(self, id):
         'net_remove <id>'
         data.remove_net(id)
         print('OK')
 
 
+    def do_blob(self, *args):
+        '''Show stored blobs
+
+Blobs are files such as CA certificates, client certificates and private keys
+that networks reference by hash, e.g., {"ca_cert": {"blob": "<hash>"}}.
+        '''
+        print(tabulate(data.list_blobs(),
+            ['Hash', 'Size', 'Created'],
+            tablefmt="psql"))
+
+
+    def do_blob_add(self, filename):
+        'blob_add <filename>'
+        with open(filename, 'rb') as f:
+            print(data.add_blob(f.read()))
+
+
+    def do_blob_remove(self, hash):
+        'blob_remove <hash>'
+        data.remove_blob(hash)
+        print('OK')
+
+
     def do_interfaces(self, *args):
         tab = []
         for ifname in cms.sup.interfaces():
@@ -148,30 +183,167 @@ commissioner.
 
 
     def do_ip(self, *args):
+        '''Show discovered IP nodes
+
+The round-trip time and loss rate are moving averages over recent pings.
+        '''
+        now = time.time()
         data = []
-        for k in ping.ip_nodes():
-            data.append([k])
+        for ip, node in ping.ip_nodes().items():
+            data.append([ip, '' if node.rtt is None else '%.1f' % (1000 * node.rtt),
+                         '%.0f' % (100 * node.loss), int(now - node.last_seen)])
 
         print(tabulate(data,
-            ['IP'],
+            ['IP', 'RTT [ms]', 'Loss [%]', 'Age [s]'],
             tablefmt='psql'))
 
 
+    def do_devices(self, name):
+        '''devices [name] - Show known devices
+
+Shows every device known from P2P discovery, DNS-SD, the groups' stations, IP
+node discovery and pinned keys, joined by device. With a device or instance
+name, only that device is shown.
+        '''
+        inv = inventory.devices
+        if name:
+            d = inv.by_name(name)
+            devs = [d] if d is not None else []
+        else:
+            devs = inv.snapshot()
+
+        tab = []
+        for d in devs:
+            fpr = inv.fingerprint(d)
+            tab.append([d.p2p_addr, d.device_name or '', d.instance or '', d.iface_addr or '',
+                        '\n'.join(inv.ips(d)), base64.b64encode(fpr).decode() if fpr else ''])
+
+        print(tabulate(tab,
+            ['P2P Address', 'Name', 'Instance', 'Interface Address', 'IP', 'Public Key'],
+            tablefmt='psql'))
+
+
+    def do_registry(self, name):
+        '''registry [name] - Show registered devices
+
+Without arguments, the command shows the number of registered devices in each
+state. With a device name, it shows the registered device with that name.
+        '''
+        if not name:
+            print(tabulate(data.device_counts(), ['State', 'Devices'], tablefmt='psql'))
+            return
+
+        d = data.device_by_name(name)
+        if d is None:
+            print('Device %s is not registered' % name)
+            return
+        d['fingerprint'] = base64.b64encode(d['fingerprint']).decode()
+        print(tabulate(d.items(), ['Attribute', 'Value'], tablefmt='psql'))
+
+
+    def do_registry_import(self, filename):
+        '''registry_import <filename> - Register devices from their labels
+
+The file must contain one label payload (the base64 text of the QR code printed
+by device-label) per line. All devices are registered in a single transaction.
+        '''
+        print('Imported %d device(s)' % data.import_label_file(filename))
+
+
+    def do_pin(self, args):
+        '''pin [<ip> <fingerprint>] - Pin device public key
+
+Without arguments, the command shows the public key fingerprints pinned for
+HTTPS connections to devices. With arguments, it pins the base64 fingerprint
+(as printed on the device label) for the device with the given IP address.
+        '''
+        args = args.split()
+        if len(args) == 0:
+            print(tabulate([[ip, base64.b64encode(fpr).decode()] for ip, fpr in tls.pins.items()],
+                ['IP', 'Public Key'], tablefmt='psql'))
+        elif len(args) == 2:
+            tls.pin(args[0], args[1])
+            print('OK')
+        else:
+            print('Usage: pin [<ip> <fingerprint>]')
+
+
+    def print_results(self, results):
+        print(tabulate([
+            [r.ip, r.status, r.attempts, '%.2f' % r.elapsed, 'OK' if r.ok else r.error] for r in results
+        ], ['IP', 'Status', 'Attempts', 'Time [s]', 'Result'], tablefmt='psql'))
+
+
     def do_post_net(self, args):
-        id, ip = args.split(maxsplit=1)
-        api.post_net(int(id), ip=ip)
-        print('OK')
+        'post_net <id> [ip]'
+        args = args.split(maxsplit=1)
+        ip = args[1] if len(args) > 1 else None
+        self.print_results(api.post_net(int(args[0]), ip=ip))
+
+
+    def do_put_net(self, args):
+        '''put_net <id> [<id> ...] - Replace network configuration
+
+Replaces the network configuration on all discovered IP nodes with the given
+networks in a single request per node.
+        '''
+        self.print_results(api.put_net([int(id) for id in args.split()]))
+
+
+    def do_sync_net(self, args):
+        '''sync_net <id> [<id> ...] - Synchronize network configuration
+
+Makes the given networks the only networks configured on all discovered IP
+nodes. Only the differences are sent to each node.
+        '''
+        ids = [int(id) for id in args.split()]
+        if not ids:
+            print('Usage: sync_net <id> [<id> ...]')
+            return
+
+        self.print_results(api.sync_net(ids))
 
 
     def do_apply_netconfig(self, ip):
-        api.apply_netconfig(ip)
-        print('OK')
+        '''apply_netconfig [ip] - Apply network configuration
+
+Asks the nodes to apply their network configuration and waits for the outcome
+of the apply job on each node.
+        '''
+        results = api.wait_apply(api.apply_netconfig(ip or None))
+        print(tabulate([
+            [r.ip, r.data['state'] if r.ok else '', r.data['connected'] if r.ok else '', 'OK' if r.ok else r.error] for r in results
+        ], ['IP', 'State', 'Connected', 'Result'], tablefmt='psql'))
+
+
+    def do_rollout(self, args):
+        '''rollout <net id> [<net id> ...] - Apply network configuration in waves
+
+Makes the given networks the network configuration of all discovered IP nodes
+and applies it, starting with a single canary node and doubling the number of
+nodes in each subsequent wave. The rollout stops at the first wave in which a
+node fails to apply the configuration or does not come back.
+        '''
+        ids = [int(id) for id in args.split()]
+        if not ids:
+            print('Usage: rollout <net id> [<net id> ...]')
+            return
+
+        r = api.rollout(ids)
+        print(tabulate([
+            [i + 1, len(w.nodes), '%.0f%%' % (100 * w.success_rate), ', '.join(w.missing)] for i, w in enumerate(r.waves)
+        ], ['Wave', 'Nodes', 'Success', 'Missing'], tablefmt='psql'))
+        if r.aborted:
+            print('Aborted: %s (%d node(s) skipped)' % (r.reason, len(r.skipped)))
+        else:
+            print('OK')
 
 
     def do_services(self, *args):
+        now = time.time()
         print(tabulate([
-            [addr, repr(srv.services[addr].rdata.attrs)] for addr in srv.services.keys()
-        ], ['Address', 'Instance'], tablefmt='psql'))
+            [s.addr, s.instance, s.device_name, repr(s.txt.as_dict()), int(now - s.last_seen)] for s in srv.services.snapshot()
+        ], ['Address', 'Instance', 'Name', 'TXT', 'Age [s]'], tablefmt='psql'))
 
 
     def do_service_discovery(self, v):
@@ -1,58 +1,120 @@
+import time
+import hashlib
 import logging
 from tabulate       import tabulate
 from binascii       import unhexlify
 from spinet.dnssd   import ANQPQuery, ANQPData, ANQPResponse, DomainName
 from spinet.wpas    import parse_kv_line
+from .txn           import TransactionManager
+from .directory     import ServiceDirectory
+from .sched         import DiscoveryScheduler
 from . import sup, on
 
 log = logging.getLogger(__name__)
 
+SPINET_DOMAIN = '_spinet._tcp.local.'
+
 discovering = False
-request_id = None
 
-services = {}
+services = ServiceDirectory()
+transactions = TransactionManager(sup)
+
+# The last service response seen from each peer. Maps P2P device address to a
+# tuple (service update indicator, TLV digest, response code, timestamp).
+seen = {}
+
+
+def tlv_digest(tlv):
+    # The digest covers the hex-encoded TLV without the service transaction
+    # ID, which differs between requests (see ANQPResponse.hdr).
+    return hashlib.blake2b((tlv[:6] + tlv[8:]).encode('ascii'), digest_size=8).digest()
 
 
 @on('P2P-SERV-DISC-RESP')
 def save_srv(ifname, data, **kwds):
-    addr, update, tlv = data.split(' ')
+    try:
+        addr, update, tlv = data.split(' ')
+        if len(tlv) < 8:
+            raise ValueError('TLV too short')
+        tid = int(tlv[6:8], 16)
+    except ValueError as e:
+        log.debug('Ignoring malformed service discovery response "%s": %s' % (data, e))
+        return
+
+    txn = transactions.match(addr, tid)
+    if txn is None:
+        log.debug('Ignoring unsolicited service discovery response from %s (tid %d)' % (addr, tid))
+        return
+
+    # If neither the service update indicator nor the response itself has
+    # changed since the last response from the peer, there is nothing new to
+    # parse. Responses whose directory entry has expired in the meantime are
+    # parsed again.
+    digest = tlv_digest(tlv)
+    prev = seen.get(addr, None)
+    if prev is not None and prev[0] == update and prev[1] == digest:
+        if prev[2] != ANQPResponse.SUCCESS or services.touch(addr):
+            seen[addr] = (update, digest, prev[2], time.time())
+            scheduler.responded(addr, prev[2])
+            return
+
     res, _ = ANQPResponse.parse(unhexlify(tlv))
+    scheduler.responded(addr, res.code)
 
     if res.code == ANQPResponse.PROTO_UNAVAILABLE:
-        try:
-            del services[addr]
-        except KeyError:
-            pass
+        services.remove(addr)
+        seen[addr] = (update, digest, res.code, time.time())
         return
 
     if res.code != ANQPResponse.SUCCESS:
         raise Exception('ANQPResponse error: %d' % res.code)
 
-    services[addr] = res
+    services.update(addr, res)
+    seen[addr] = (update, digest, res.code, time.time())
+
+
+@on('P2P-DEVICE-FOUND')
+def found_device(ifname, data, **kwds):
+    sep = data.find(' ')
+    d = parse_kv_line(data[sep:])
+    name = d.get('name', None)
+    if name is not None:
+        services.set_device_name(d['p2p_dev_addr'], name.strip("'"))
+    scheduler.found(d['p2p_dev_addr'])
 
 
 @on('P2P-DEVICE-LOST')
 def delete_srv(ifname, data, **kwds):
     d = parse_kv_line(data)
-    try:
-        del services[d['p2p_dev_addr']]
-    except KeyError:
-        pass
+    transactions.cancel_peer(d['p2p_dev_addr'])
+    scheduler.lost(d['p2p_dev_addr'])
+    seen.pop(d['p2p_dev_addr'], None)
+    services.forget(d['p2p_dev_addr'])
+
+
+def query(addr, timeout=None):
+    '''Send a targeted service discovery query to the peer with the given P2P
+    device address. The request is canceled if the peer does not respond
+    within timeout seconds.
+    '''
+    data = ANQPData(DomainName(SPINET_DOMAIN), ANQPData.TYPE_TXT)
+    return transactions.request(data, addr=addr, timeout=timeout)
+
+
+scheduler = DiscoveryScheduler(query, transactions)
 
 
 def start_discovery():
-    global discovering, request_id
+    global discovering
     if not discovering:
-        query = ANQPQuery(ANQPData(DomainName('_spinet._tcp.local.'), ANQPData.TYPE_TXT))
-        request_id = sup.p2p_serv_disc_req(query)
+        for addr, _ in sup.p2p_peers():
+            scheduler.found(addr)
+        scheduler.enabled = True
         discovering = True
 
 
 def stop_discovery():
-    global discovering, request_id
+    global discovering
     if discovering:
-        try:
-            sup.p2p_serv_disc_cancel_req(request_id)
-        finally:
-            request_id = None
-            discovering = False
+        scheduler.enabled = False
+        discovering = False
@@ -0,0 +1,162 @@
+import ssl
+import base64
+import hashlib
+import logging
+import threading
+import urllib3
+import blinker
+from   OpenSSL import crypto
+
+log = logging.getLogger(__name__)
+
+# Devices serve the enrolled API over TLS with a self-signed certificate. The
+# commissioner authenticates a device by the SHA-256 fingerprint of its public
+# key (the fingerprint printed on the device label, see
+# spinet.enrolled.cert.PubkeyFingerprint) instead of a certificate chain.
+#
+# Each device gets its own connection pool and TLS context. The context
+# remembers the last TLS session established with the device so that new
+# connections can resume it and skip the expensive part of the handshake.
+
+TOFU = True # Trust devices without a pinned fingerprint on first use
+
+# Optional function that returns True for fingerprints of known devices (e.g.,
+# devices registered from their labels), which are pinned on first use even if
+# TOFU is disabled
+trusted = None
+
+pins  = {}  # Pinned public key fingerprints (bytes) keyed by IP address
+pools = {}  # Connection pools keyed by (IP address, port)
+lock  = threading.Lock()
+
+# Sent with the IP address as the sender and the fingerprint (bytes) whenever
+# a public key is pinned
+pinned = blinker.Signal()
+
+
+class FingerprintMismatch(ssl.SSLError):
+    pass
+
+
+def pubkey_fingerprint(der):
+    '''Return the SHA-256 fingerprint of the public key in the DER-encoded
+    certificate der.
+    '''
+    crt = crypto.load_certificate(crypto.FILETYPE_ASN1, der)
+    return hashlib.sha256(crypto.dump_publickey(crypto.FILETYPE_ASN1, crt.get_pubkey())).digest()
+
+
+def pin(ip, fingerprint):
+    '''Pin the public key fingerprint (bytes or base64) of the device with
+    the given IP address. Existing connections to the device are closed.
+    '''
+    if isinstance(fingerprint, str):
+        fingerprint = base64.b64decode(fingerprint)
+
+    with lock:
+        pins[ip] = fingerprint
+        stale = [pools.pop(k) for k in list(pools.keys()) if k[0] == ip]
+    for p in stale:
+        p.close()
+    pinned.send(ip, fingerprint=fingerprint)
+
+
+class SessionSocket(ssl.SSLSocket):
+    '''A TLS socket that saves its session in the context once the first
+    data has been received. TLS 1.3 servers send session tickets after the
+    handshake, so the session is not resumable before that.
+    '''
+    def recv_into(self, *args, **kwargs):
+        n = super().recv_into(*args, **kwargs)
+        if not getattr(self, 'session_saved', False):
+            self.session_saved = True
+            self.context.session = self.session
+        return n
+
+
+
+class DeviceContext(ssl.SSLContext):
+    '''TLS context for the connections to one device.
+
+    Connections resume the last saved TLS session, if any. After the
+    handshake, the public key fingerprint of the device's certificate is
+    checked against pins.
+    '''
+    sslsocket_class = SessionSocket
+
+    def __new__(cls, ip):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.session = None
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+
+
+    def verify(self, sock):
+        fpr = pubkey_fingerprint(sock.getpeercert(binary_form=True))
+        known = trusted is not None and trusted(fpr)
+        new = False
+        with lock:
+            expected = pins.get(self.ip, None)
+            # A known device may have taken over the address of another one
+            if (expected is None and TOFU) or (expected != fpr and known):
+                log.info('Pinning public key %s of %s' % (base64.b64encode(fpr).decode(), self.ip))
+                pins[self.ip] = expected = fpr
+                new = True
+        if new:
+            pinned.send(self.ip, fingerprint=fpr)
+
+        if expected is None:
+            raise FingerprintMismatch('No pinned fingerprint for %s' % self.ip)
+        if fpr != expected:
+            raise FingerprintMismatch('Public key of %s does not match its pinned fingerprint' % self.ip)
+
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.session is not None:
+            kwargs.setdefault('session', self.session)
+
+        s = super().wrap_socket(sock, *args, **kwargs)
+        try:
+            self.verify(s)
+        except:
+            s.close()
+            raise
+        return s
+
+
+
+class PinnedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        super().connect()
+        # DeviceContext has verified the device's public key fingerprint
+        self.is_verified = True
+
+
+
+class DevicePool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = PinnedHTTPSConnection
+
+
+
+def pool(ip, port, maxsize=2):
+    '''Return the keep-alive connection pool for the device with the given IP
+    address and port, creating it if necessary.
+    '''
+    with lock:
+        p = pools.get((ip, port), None)
+        if p is None:
+            p = DevicePool(ip, port, maxsize=maxsize, cert_reqs='CERT_NONE', ssl_context=DeviceContext(ip))
+            pools[ip, port] = p
+        return p
+
+
+def close_pools():
+    with lock:
+        stale = list(pools.values())
+        pools.clear()
+    for p in stale:
+        p.close()
@@ -0,0 +1,202 @@
+import time
+import logging
+import threading
+from   spinet.dnssd import ANQPQuery
+from   spinet.wpas  import WPAError
+
+log = logging.getLogger(__name__)
+
+BROADCAST = '00:00:00:00:00:00'
+
+
+class Transaction(object):
+    '''An outstanding service discovery request.
+
+    The attribute request_id holds the identifier returned by
+    wpa_supplicant for P2P_SERV_DISC_REQ. Deadline is None for requests that
+    stay active until they are canceled (broadcast discovery).
+    '''
+    __slots__ = ('addr', 'tid', 'query', 'request_id', 'deadline')
+
+    def __init__(self, addr, tid, query, request_id=None, deadline=None):
+        self.addr = addr
+        self.tid = tid
+        self.query = query
+        self.request_id = request_id
+        self.deadline = deadline
+
+
+    def __repr__(self):
+        return '%s(%s, %d, %s)' % (type(self).__name__, self.addr, self.tid, self.request_id)
+
+
+
+class TransactionManager(object):
+    '''Keep track of outstanding ANQP service discovery requests.
+
+    Service transaction IDs are allocated per peer so that up to 255
+    requests can be outstanding for each peer. Responses are matched to
+    requests by the P2P device address of the peer and the transaction ID.
+    Requests sent to a single peer are canceled in wpa_supplicant when no
+    response arrives before their deadline. Broadcast requests are matched,
+    but not removed, on every response since any number of peers can answer
+    them.
+    '''
+    def __init__(self, sup, timeout=10):
+        self.sup = sup
+        self.timeout = timeout
+        self.lock = threading.Condition()
+        self.pending = {}
+        self.last_tid = {}
+        self.running = False
+        self.changed = False
+
+
+    def _allocate_tid(self, addr):
+        # Transaction IDs of broadcast requests are reserved for all peers,
+        # otherwise responses could not be told apart.
+        last = self.last_tid.get(addr, 0)
+        for i in range(1, 256):
+            tid = (last + i - 1) % 255 + 1
+            if (addr, tid) not in self.pending and (BROADCAST, tid) not in self.pending:
+                self.last_tid[addr] = tid
+                return tid
+        raise WPAError('Too many outstanding requests for peer %s' % addr)
+
+
+    def request(self, data, addr=BROADCAST, timeout=None):
+        '''Send a service discovery query for ANQPData data to the given peer.
+
+        The timeout defaults to the timeout given to the constructor for
+        requests sent to a single peer. Broadcast requests never expire
+        unless a timeout is given explicitly.
+        '''
+        if timeout is None and addr != BROADCAST:
+            timeout = self.timeout
+
+        with self.lock:
+            tid = self._allocate_tid(addr)
+            txn = Transaction(addr, tid, ANQPQuery(data, tid))
+            if timeout is not None:
+                txn.deadline = time.monotonic() + timeout
+            # Reserve the tid before the lock is released
+            self.pending[(addr, tid)] = txn
+
+        try:
+            txn.request_id = self.sup.p2p_serv_disc_req(txn.query, addr=addr)
+        except:
+            with self.lock:
+                self.pending.pop((addr, tid), None)
+            raise
+
+        log.debug('Sent service discovery request %s' % txn)
+        with self.lock:
+            self.changed = True
+            self.lock.notify()
+        return txn
+
+
+    def match(self, addr, tid):
+        '''Return the transaction that a response with transaction ID tid
+        received from addr belongs to, or None if there is no such outstanding
+        transaction.
+        '''
+        with self.lock:
+            txn = self.pending.pop((addr, tid), None)
+            if txn is not None:
+                return txn
+            return self.pending.get((BROADCAST, tid), None)
+
+
+    def is_pending(self, txn):
+        with self.lock:
+            return self.pending.get((txn.addr, txn.tid), None) is txn
+
+
+    def _cancel(self, txn):
+        if txn.request_id is None:
+            return
+        try:
+            self.sup.p2p_serv_disc_cancel_req(txn.request_id)
+        except WPAError as e:
+            # The request may have already been completed by wpa_supplicant
+            log.debug('Could not cancel %s: %s' % (txn, e))
+
+
+    def cancel(self, txn):
+        with self.lock:
+            if self.pending.get((txn.addr, txn.tid), None) is not txn:
+                return
+            del self.pending[(txn.addr, txn.tid)]
+        self._cancel(txn)
+
+
+    def cancel_peer(self, addr):
+        '''Cancel all outstanding requests sent to the given peer.
+        '''
+        with self.lock:
+            txns = [t for k, t in self.pending.items() if k[0] == addr]
+            for t in txns:
+                del self.pending[(t.addr, t.tid)]
+        for t in txns:
+            self._cancel(t)
+
+
+    def cancel_all(self):
+        with self.lock:
+            txns = list(self.pending.values())
+            self.pending.clear()
+        for t in txns:
+            self._cancel(t)
+
+
+    def expire(self, now=None):
+        '''Cancel all requests whose deadline has passed. Return the number
+        of seconds until the next deadline or None if there is none.
+        '''
+        if now is None:
+            now = time.monotonic()
+
+        expired = []
+        next_deadline = None
+        with self.lock:
+            for k, t in list(self.pending.items()):
+                if t.deadline is None:
+                    continue
+                if t.deadline <= now:
+                    expired.append(t)
+                    del self.pending[k]
+                elif next_deadline is None or t.deadline < next_deadline:
+                    next_deadline = t.deadline
+
+        for t in expired:
+            log.debug('Service discovery request %s timed out' % t)
+            self._cancel(t)
+
+        if next_deadline is None:
+            return None
+        return next_deadline - now
+
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        self.thread.join()
+        del self.thread
+
+
+    def run(self):
+        while self.running:
+            tout = self.expire()
+            with self.lock:
+                if self.running and not self.changed:
+                    self.lock.wait(tout)
+                self.changed = False
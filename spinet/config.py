@@ -16,7 +16,7 @@ class Config(object):
 
     def __setitem__(self, key, value):
         c = self.db.cursor();
-        c.execute('INSERT INTO config (name, value) VALUES (?, ?)', (key, value))
+        c.execute('INSERT OR REPLACE INTO config (name, value) VALUES (?, ?)', (key, value))
         self.db.commit()
 
 
@@ -0,0 +1,47 @@
+import json
+
+# Encoding of the bodies exchanged between the commissioner and enrolled. JSON
+# is always supported. CBOR is supported if the cbor package is installed on
+# both sides. It produces smaller bodies that are faster to parse on the
+# device. Both encodings carry the same data.
+
+JSON = 'application/json'
+CBOR = 'application/cbor'
+
+try:
+    import cbor
+except ImportError:
+    cbor = None
+
+# Supported media types in the order of preference
+TYPES = (CBOR, JSON) if cbor is not None else (JSON,)
+
+
+def media_type(value):
+    '''Strip parameters from a Content-Type header value.
+    '''
+    return (value or JSON).split(';', 1)[0].strip().lower()
+
+
+def dumps(data, content_type=JSON):
+    t = media_type(content_type)
+    if t not in TYPES:
+        raise ValueError('Unsupported content type %s' % t)
+
+    if t == CBOR:
+        return cbor.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def loads(body, content_type=JSON):
+    t = media_type(content_type)
+    if t not in TYPES:
+        raise ValueError('Unsupported content type %s' % t)
+
+    if t == CBOR:
+        try:
+            return cbor.loads(body)
+        except LookupError as e:
+            # The cbor package reports truncated input as an index error
+            raise ValueError('Truncated CBOR data') from e
+    return json.loads(body.decode('utf-8'))
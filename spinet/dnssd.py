@@ -1,6 +1,6 @@
+import threading
 from binascii    import hexlify
 from struct      import Struct, pack, unpack_from
-from collections import OrderedDict
 
 __all__ = [
     'SDError',
@@ -17,20 +17,34 @@ class SDError(Exception):
     pass
 
 
+# Domain name labels that appear in (almost) every DNS-SD record we send or
+# receive. DomainName objects reuse the string objects from this table rather
+# than keeping a private copy of each label.
+#
+LABELS = {}
+for l in ('_spinet', '_tcp', '_udp', 'local'):
+    LABELS[l] = LABELS[l.encode('ascii')] = l
+del l
+
+
+def intern_label(label):
+    return LABELS.get(label, label)
+
+
 class Compressor(object):
     PREFIX = b'\xc0'
 
     DECOMPRESS = {
-        b'\xc0\x11': ['local'],
-        b'\xc0\x0c': ['_tcp', 'local'],
-        b'\xc0\x1c': ['_udp', 'local']
+        b'\xc0\x11': ('local',),
+        b'\xc0\x0c': ('_tcp', 'local'),
+        b'\xc0\x1c': ('_udp', 'local')
     }
 
 
     COMPRESS = [
-        (['_tcp', 'local'], b'\xc0\x0c'),
-        (['_udp', 'local'], b'\xc0\x1c'),
-        (['local'],         b'\xc0\x11')
+        (('_tcp', 'local'), b'\xc0\x0c'),
+        (('_udp', 'local'), b'\xc0\x1c'),
+        (('local',),        b'\xc0\x11')
     ]
 
     ref_ptr = b'\xc0\x27'
@@ -43,7 +57,7 @@ class Compressor(object):
         if not isinstance(_ref, DomainName):
             raise SDError('Invalid parameter ref')
 
-        ref = _ref.as_list
+        ref = _ref.value
 
         self.DECOMPRESS = dict(type(self).DECOMPRESS)
         self.DECOMPRESS[self.ref_ptr] = ref
@@ -62,8 +76,16 @@ class Compressor(object):
         return self.DECOMPRESS[bits]
 
 
+# Compressor without a reference name. It is stateless and shared by all
+# DomainName objects created without an explicit compressor.
+#
+default_compressor = Compressor()
+
+
 
 class HexPack(object):
+    __slots__ = ()
+
     def __str__(self):
         packs = self.pack()
         if not isinstance(packs, tuple):
@@ -74,6 +96,8 @@ class HexPack(object):
 
 
 class DomainName(HexPack):
+    __slots__ = ('value', 'compressor')
+
     def __init__(self, value, compressor=None):
         # If we get a bytes object, convert it to string
         if isinstance(value, bytes):
@@ -86,10 +110,10 @@ class DomainName(HexPack):
             if value[-1] == '':
                 value = value[:-1]
 
-        self.value = value
+        self.value = tuple([intern_label(v) for v in value])
 
         if compressor is None:
-            self.compressor = Compressor()
+            self.compressor = default_compressor
         else:
             self.compressor = compressor
 
@@ -97,7 +121,7 @@ class DomainName(HexPack):
     @classmethod
     def parse(cls, data, offset=0, compressor=None):
         if compressor is None:
-            compressor = Compressor()
+            compressor = default_compressor
 
         v = []
         while True:
@@ -112,7 +136,8 @@ class DomainName(HexPack):
                 break
             else:
                 l = ord(l)
-                v.append(unpack_from('%ds' % l, data, offset)[0].decode('ascii'))
+                b = unpack_from('%ds' % l, data, offset)[0]
+                v.append(LABELS.get(b) or b.decode('ascii'))
                 offset += l
         return cls(v, compressor=compressor), offset
 
@@ -159,17 +184,30 @@ class DomainName(HexPack):
 
 
 class ANQP(HexPack):
+    __slots__ = ('data', 'tid')
+
     PROTO = 1
+
+    # Fallback transaction ID counter for objects created without an explicit
+    # tid. Service transaction IDs are one byte long and must not be zero.
     tid_counter = 1
+    tid_lock = threading.Lock()
 
     def __init__(self, data, tid=None):
         self.data = data
         if tid is None:
-            cls = type(self)
-            tid = cls.tid_counter
-            cls.tid_counter = (cls.tid_counter + 1) % 256
+            tid = self.next_tid()
         self.tid = tid
 
+
+    @staticmethod
+    def next_tid():
+        with ANQP.tid_lock:
+            tid = ANQP.tid_counter
+            ANQP.tid_counter = tid % 255 + 1
+        return tid
+
+
     def parse_rdata(self, *args, **kwargs):
         return self.data.parse_rdata(*args, **kwargs)
 
@@ -180,6 +218,8 @@ class ANQP(HexPack):
 
 
 class ANQPData(HexPack):
+    __slots__ = ('name', 'type_')
+
     VERSION = 1
     TYPE_PTR = 12
     TYPE_TXT = 16
@@ -248,6 +288,8 @@ class ANQPData(HexPack):
 
 
 class ANQPQuery(ANQP):
+    __slots__ = ()
+
     hdr = Struct('<HBB')
 
     @classmethod
@@ -274,6 +316,8 @@ class ANQPQuery(ANQP):
 
 
 class ANQPResponse(ANQP):
+    __slots__ = ('code', 'rdata')
+
     SUCCESS           = 0
     PROTO_UNAVAILABLE = 1
     INFO_UNAVAILABLE  = 2
@@ -324,44 +368,158 @@ class ANQPResponse(ANQP):
 
 
 class PTRData(DomainName):
-    pass
+    __slots__ = ()
 
 
 class TXTData(HexPack):
+    '''DNS-SD TXT record data (RFC 6763, section 6).
+
+    The object keeps the TXT record in its wire format (a sequence of
+    length-prefixed strings) and only looks at individual strings when an
+    attribute is looked up. Keys are matched case-insensitively and only the
+    first occurrence of a key is taken into account. Values are returned as
+    bytes objects. Boolean attributes (a key without "=") have the value None.
+
+    The constructor accepts a dict or any other iterable of (key, value)
+    pairs. Values can be bytes, str (encoded as UTF-8), or None for boolean
+    attributes.
+    '''
+    __slots__ = ('raw',)
+
     def __init__(self, attrs):
-        self.attrs = OrderedDict(attrs)
+        if hasattr(attrs, 'items'):
+            attrs = attrs.items()
+
+        parts = []
+        for k, v in attrs:
+            if isinstance(k, str):
+                k = k.encode('ascii')
+            if len(k) == 0 or b'=' in k:
+                raise SDError('Invalid TXT attribute name %s' % repr(k))
+
+            if v is None:
+                s = k
+            else:
+                if not isinstance(v, bytes):
+                    v = str(v).encode('utf-8')
+                s = k + b'=' + v
+
+            if len(s) > 255:
+                raise SDError('TXT attribute %s too long' % repr(k))
+            parts.append(bytes((len(s),)))
+            parts.append(s)
+
+        self.raw = bytes(bytearray().join(parts))
+
+
+    @classmethod
+    def from_raw(cls, raw):
+        obj = cls.__new__(cls)
+        obj.raw = raw
+        return obj
 
 
     @classmethod
     def parse(cls, data, offset=0):
+        start = end = offset
         dlen = len(data)
-        rv = OrderedDict()
-        while (dlen - offset) > 0:
-            l = unpack_from('s', data, offset)[0]
-            offset += 1
-            if l == b'\0':
+        while end < dlen:
+            l = data[end]
+            if l == 0:
+                offset = end + 1
                 break
-            else:
-                l = ord(l)
-                kv = unpack_from('%ds' % l, data, offset)[0].decode('ascii')
-                k, v = kv.split('=')
-                rv[k] = v
-                offset += l
+            end += 1 + l
+            if end > dlen:
+                raise SDError('Truncated TXT record')
+            offset = end
 
-        return cls(rv), offset
+        return cls.from_raw(bytes(data[start:end])), offset
 
 
     def pack(self):
-        if not self.attrs:
+        if not self.raw:
             return b'\x00'
+        return self.raw
+
+
+    def strings(self):
+        '''Iterate over the (undecoded) strings of the TXT record.
+        '''
+        raw = self.raw
+        i = 0
+        while i < len(raw):
+            l = raw[i]
+            yield raw[i+1:i+1+l]
+            i += 1 + l
+
+
+    def _items(self):
+        seen = set()
+        for s in self.strings():
+            sep = s.find(b'=')
+            if sep == -1:
+                k, v = s, None
+            else:
+                k, v = s[:sep], s[sep+1:]
 
-        rv = b''
-        for k,v in self.attrs.items():
-            k = k.encode('ascii')
-            v = str(v).encode('ascii')
-            rv += pack('%dp' % (len(k)+len(v)+2), k + b'=' + v)
-        return rv
+            # Strings with an empty key are ignored and so is every but the
+            # first occurrence of a key.
+            if len(k) == 0:
+                continue
+            lk = k.lower()
+            if lk in seen:
+                continue
+            seen.add(lk)
+            yield k, v
+
+
+    def items(self):
+        for k, v in self._items():
+            yield k.decode('ascii', errors='replace'), v
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def __getitem__(self, key):
+        k = key.encode('ascii') if isinstance(key, str) else key
+        k = k.lower()
+        if len(k) == 0:
+            raise KeyError(key)
+
+        for s in self.strings():
+            if s[:len(k)].lower() != k:
+                continue
+            if len(s) == len(k):
+                return None
+            if s[len(k)] == 0x3d:
+                return s[len(k)+1:]
+        raise KeyError(key)
+
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+
+    def __eq__(self, other):
+        return isinstance(other, TXTData) and self.raw == other.raw
+
+
+    def __hash__(self):
+        return hash(self.raw)
+
+
+    def as_dict(self):
+        return dict(self.items())
 
 
     def __repr__(self):
-        return '%s(%s)' % (type(self).__name__, repr(self.attrs))
+        return '%s(%s)' % (type(self).__name__, repr(self.as_dict()))
@@ -14,4 +14,5 @@ sup       = wpas.P2PWPASupplicant() # Global WPASupplicant instance
 on        = sup.on                  # Decorator for event receivers from the main WPASupplicant object
 crt_path  = '/data/cert.pem'        # Path to the file with the device's certificate
 key_path  = '/data/key.pem'         # Path to the file with the device's private key
+blob_dir  = '/data/blobs'           # Directory with certificate and key blobs
 ip        = None                    # IP address
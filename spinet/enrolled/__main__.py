@@ -16,17 +16,20 @@ p.add_argument('-n', '--name',    help='Node name (%s)' % enrolled.name, default
 p.add_argument('-p', '--port',    help='HTTP API listen port (%d)' % enrolled.port, type=int, default=enrolled.port)
 p.add_argument('-c', '--cert',    help='Device certificate file (%s)' % enrolled.crt_path, default=enrolled.crt_path)
 p.add_argument('-k', '--key',     help='Device private key file (%s)' % enrolled.key_path, default=enrolled.key_path)
+p.add_argument('-b', '--blobs',   help='Blob directory (%s)' % enrolled.blob_dir, default=enrolled.blob_dir)
 p.add_argument('-I', '--ip',      help='IP address', default=enrolled.ip)
+p.add_argument('-s', '--server',  help='HTTP server (cheroot if installed, flask otherwise)', choices=['cheroot', 'flask'])
 args = p.parse_args()
 
 enrolled.ifname   = args.ifname
 enrolled.name     = args.name
 enrolled.db_path  = args.db
-enrolled.db       = sqlite3.connect(enrolled.db_path)
+enrolled.db       = sqlite3.connect(enrolled.db_path, check_same_thread=False)
 enrolled.port     = args.port
 enrolled.verbose  = args.verbose
 enrolled.crt_path = args.cert
 enrolled.key_path = args.key
+enrolled.blob_dir = args.blobs
 enrolled.ip       = args.ip
 
 if enrolled.ip != None:
@@ -112,7 +115,7 @@ log.info('Device public key: %s' % fpr.as_base64())
 
 from .. import ipv6
 log.debug('Adding address %s to interface %s' % (enrolled.addr[0], enrolled.ifname))
-ipv6.add_addr(enrolled.ifname, enrolled.addr)
+ipv6.add_addr(enrolled.ifname, enrolled.addr, nodad=True)
 
 enrolled.sup.start(enrolled.ifname)
 enrolled.sup.set('device_name', enrolled.name)
@@ -134,8 +137,10 @@ enrolled.sup.p2p_find()
 
 
 
+from . import server
+
 def main():
-    api.app.run(host='0.0.0.0', port=enrolled.port, ssl_context=(enrolled.crt_path, enrolled.key_path))
+    server.serve(api.app, '0.0.0.0', enrolled.port, enrolled.crt_path, enrolled.key_path, server=args.server)
     ipv6.del_addr(enrolled.ifname, enrolled.addr)
 
 
@@ -1,9 +1,15 @@
 import logging
 import sqlite3
 import json
-from   flask import Flask, jsonify, request
-from time import sleep
-from . import sup, db
+from   flask import Flask, request, abort
+from   werkzeug.http import parse_content_range_header
+from . import sup, db, on, blob_dir
+from .data import config, lock, locked
+from .jobs import ApplyQueue
+from .blob import BlobStore, BlobError, OffsetMismatch, DigestMismatch, is_valid_hash
+from spinet.wpas import WPAError, quoted
+from spinet.netconf import net_hash, version, LOCAL_ATTRS, BLOB, is_blob_ref, blob_refs
+from spinet import content
 
 log = logging.getLogger(__name__)
 
@@ -11,22 +17,106 @@ log = logging.getLogger(__name__)
 app = Flask(__name__)
 
 
-# Intelligently apply new network configuration. Rollback to previous network
-# configuration on errors.
-def apply_network_configuration():
-    prev = sup.list_networks()[0]
+# Networks created by enrolled in wpa_supplicant carry the content hash of the
+# network configuration in id_str, prefixed with ID_PREFIX.
+ID_PREFIX = 'spinet-'
 
-    ids = []
+blobs = BlobStore(blob_dir)
+
+
+def wpa_attrs(attrs):
+    attrs = dict(attrs)
+    if attrs['type'] == 'Open':
+        attrs['key_mgmt'] = attrs.get('key_mgmt', 'NONE')
+    del attrs['type']
+
+    # Blob references are replaced with the path to the blob's file
+    for k, v in attrs.items():
+        if is_blob_ref(v):
+            attrs[k] = quoted(blobs.path(v[BLOB]))
+    return attrs
+
+
+def current_networks():
+    '''Return a dict mapping wpa_supplicant network id to the content hash of
+    the network (None for networks not configured by enrolled).
+    '''
+    rv = {}
+    for row in sup.list_networks()[0]:
+        id = int(row[0])
+        try:
+            id_str = sup.get_network(id, 'id_str')
+        except WPAError:
+            id_str = ''
+        rv[id] = id_str[len(ID_PREFIX):] if id_str.startswith(ID_PREFIX) else None
+    return rv
+
+
+def load_applied():
     try:
-        for data in db.cursor().execute('SELECT attrs FROM net').fetchall():
-            attrs = json.loads(data[0])
+        return json.loads(config['applied'])
+    except KeyError:
+        return {}
+
 
-            if attrs['type'] == 'Open':
-                attrs['key_mgmt'] = attrs.get('key_mgmt', 'NONE')
+def find_updatable(attrs, candidates, current, applied):
+    '''Find a network among candidates (wpa_supplicant ids) that can be
+    turned into the network attrs by updating some of its fields, i.e., a
+    network with the same SSID and no fields that attrs does not have.
+    '''
+    for id in candidates:
+        old = applied.get(current[id], None)
+        if old is None:
+            continue
+        old = wpa_attrs(old)
+        if old.get('ssid', None) == attrs.get('ssid', None) and set(old.keys()) <= set(attrs.keys()):
+            return id, old
+    return None, None
 
-            del attrs['type']
-            log.debug('Configuring network %s' % attrs['ssid'])
-            ids.append(sup.create_network(attrs))
+
+# Intelligently apply new network configuration. Only networks that differ
+# from wpa_supplicant's current configuration are touched and nothing is done
+# if the configurations match. Rollback newly created networks on errors.
+# Returns False if the configuration was up to date, True otherwise.
+def apply_network_configuration():
+    with lock:
+        desired = dict([(h, json.loads(attrs)) for attrs, h in
+                        db.cursor().execute('SELECT attrs, hash FROM net').fetchall()])
+    current = current_networks()
+
+    have = {}
+    for id, h in current.items():
+        if h in desired and h not in have:
+            have[h] = id
+    remove = [id for id, h in current.items() if have.get(h, None) != id]
+    add = [h for h in desired.keys() if h not in have]
+
+    if not add and not remove:
+        log.debug('Network configuration is up to date')
+        return False
+
+    missing = [b for h in add for b in blob_refs(desired[h]) if not blobs.exists(b)]
+    if missing:
+        raise BlobError('Missing blob(s): %s' % ', '.join(missing))
+
+    with lock:
+        applied = load_applied()
+    ids = []
+    try:
+        for h in add:
+            attrs = wpa_attrs(desired[h])
+            id, old = find_updatable(attrs, remove, current, applied)
+            if id is not None:
+                log.debug('Updating network %s' % attrs['ssid'])
+                for k, v in attrs.items():
+                    if old.get(k, None) != v:
+                        sup.set_network(id, k, v)
+                sup.set_network(id, 'id_str', quoted(ID_PREFIX + h))
+                remove.remove(id)
+            else:
+                log.debug('Configuring network %s' % attrs['ssid'])
+                attrs['id_str'] = quoted(ID_PREFIX + h)
+                ids.append(sup.create_network(attrs))
 
         log.debug('Enabling all newly configured networks')
         for id in ids:
@@ -38,59 +128,313 @@ def apply_network_configuration():
         raise
 
     log.debug('Deleting previous network configuration')
-    for row in prev:
-        id = int(row[0])
+    for id in remove:
         sup.remove_network(id)
 
+    with lock:
+        config['applied'] = json.dumps(desired)
+    return True
+
+
+def is_connected():
+    return sup.status().get('wpa_state', None) == 'COMPLETED'
+
+
+applier = ApplyQueue(apply_network_configuration, is_connected)
+
+
+@on('CTRL-EVENT-CONNECTED')
+@on('CTRL-EVENT-DISCONNECTED')
+@on('CTRL-EVENT-SSID-TEMP-DISABLED')
+@on('CTRL-EVENT-NETWORK-NOT-FOUND')
+def connection_event(ifname, event, data, **kwds):
+    applier.event(event, data)
+
+
+def start_apply(resp, job):
+    # Start the job only once the response has been sent. Applying the
+    # configuration may take down the link the client talks to us over.
+    resp.call_on_close(lambda: applier.start(job))
+    return resp
+
 
 @app.route('/')
 def hello_world():
     return 'Enrolled'
 
 
+def rows_version(rows):
+    # The version (and ETag) of the list of networks covers the ids of the
+    # networks, which are part of the representation and change when the
+    # same networks are added again, as well as their content hashes.
+    return version(['%d:%s' % (id, hash) for id, hash in rows])
+
+
+@locked
+def config_version():
+    c = db.cursor()
+    c.execute('SELECT id, hash FROM net')
+    return rows_version(c.fetchall())
+
+
+def insert_network(c, data):
+    for k in LOCAL_ATTRS:
+        data.pop(k, None)
+    c.execute('INSERT INTO net (attrs, hash) VALUES (?, ?)', (json.dumps(data), net_hash(data)))
+    return c.lastrowid
+
+
+# Request and response bodies are encoded in JSON or CBOR. The encoding of the
+# request body is given by its Content-Type. The response is encoded in the
+# type preferred by the client's Accept header, JSON by default.
+def request_data():
+    t = request.mimetype or content.JSON
+    if t not in content.TYPES:
+        abort(415)
+    try:
+        return content.loads(request.get_data(), t)
+    except ValueError:
+        abort(400)
+
+
+def response_type():
+    return request.accept_mimetypes.best_match(content.TYPES, content.JSON)
+
+
+def respond(data, status=200):
+    t = response_type()
+    resp = app.response_class(content.dumps(data, t), status=status, mimetype=t)
+    resp.vary.add('Accept')
+    return resp
+
+
+# Serialized GET /net and GET /net/<id> responses as (body, etag) tuples keyed
+# by network id (None for the list of all networks) and media type. Handlers
+# that modify the net table must call invalidate_cache() after committing. All
+# representations of a resource share the same ETag so that it can be used in
+# If-Match regardless of the encoding.
+cache = {}
+
+
+def invalidate_cache():
+    cache.clear()
+
+
+def cached_response(key, build):
+    # Return the cached response for key, calling build() to create it if
+    # necessary. Build returns a tuple (data, etag), or None if there is no
+    # such resource. Conditional requests with a matching If-None-Match header
+    # get a 304 response.
+    t = response_type()
+    try:
+        body, etag = cache[key, t]
+    except KeyError:
+        rv = build()
+        if rv is None:
+            return respond({'error': 'Unknown network %s' % key}, 404)
+        data, etag = rv
+        body = content.dumps(data, t)
+        cache[key, t] = body, etag
+
+    resp = app.response_class(body, mimetype=t)
+    resp.vary.add('Accept')
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+
 @app.route('/net', methods=['GET'])
+@locked
 def list_networks():
-    c = db.cursor()
-    c.execute('SELECT id, attrs FROM net')
-    data = [{**json.loads(attrs), **{'id': id}} for id, attrs in c.fetchall()]
-    return jsonify(data)
+    def build():
+        c = db.cursor()
+        c.execute('SELECT id, attrs, hash FROM net')
+        rows = c.fetchall()
+        data = [{**json.loads(attrs), **{'id': id, 'hash': hash}} for id, attrs, hash in rows]
+        return data, rows_version([(id, hash) for id, _, hash in rows])
+    return cached_response(None, build)
 
 
 @app.route('/net/<int:id>', methods=['GET'])
+@locked
 def get_network(id):
-    c = db.cursor()
-    c.execute('SELECT attrs FROM net WHERE id=?', (id,))
-    attrs = json.loads(c.fetchone()[0])
-    return jsonify({**attrs, **{'id': id}})
+    def build():
+        c = db.cursor()
+        c.execute('SELECT attrs, hash FROM net WHERE id=?', (id,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        attrs, hash = row
+        return {**json.loads(attrs), **{'id': id, 'hash': hash}}, hash
+    return cached_response(id, build)
 
 
 @app.route('/net/<int:id>', methods=['DELETE'])
+@locked
 def delete_network(id):
     c = db.cursor()
     c.execute('DELETE from net WHERE id=?', (id,))
     db.commit()
+    invalidate_cache()
     return '', 204
 
 
 @app.route('/net', methods=['POST'])
+@locked
 def add_network():
-    data = request.get_json()
+    data = request_data()
 
-    try:
-        del data['id']
-    except KeyError:
-        pass
+    c = db.cursor()
+    id = insert_network(c, data)
+    db.commit()
+    invalidate_cache()
+
+    return get_network(id)
+
+
+# Apply a configuration delta computed by the commissioner. The body is a JSON
+# object {"add": [<network>, ...], "remove": [<hash>, ...]}. Networks are
+# removed by content hash and networks that are already present are not added
+# again. If the request has an If-Match header, the delta is only applied if
+# the current configuration version matches.
+@app.route('/net', methods=['PATCH'])
+@locked
+def patch_networks():
+    data = request_data()
+    if not isinstance(data, dict):
+        return respond({'error': 'Expected an object'}, 400)
+
+    add, remove = data.get('add', []), data.get('remove', [])
+    if not isinstance(add, list) or not all(isinstance(v, dict) for v in add):
+        return respond({'error': 'Expected a list of networks in add'}, 400)
+    if not isinstance(remove, list) or not all(isinstance(v, str) for v in remove):
+        return respond({'error': 'Expected a list of hashes in remove'}, 400)
 
     c = db.cursor()
-    c.execute('INSERT INTO net (attrs) VALUES (?)', (json.dumps(data),))
+    try:
+        if request.if_match and not request.if_match.contains(config_version()):
+            return '', 412
+
+        for h in remove:
+            c.execute('DELETE FROM net WHERE hash=?', (h,))
+
+        for attrs in add:
+            c.execute('SELECT 1 FROM net WHERE hash=?', (net_hash(attrs),))
+            if c.fetchone() is None:
+                insert_network(c, attrs)
+    except:
+        db.rollback()
+        raise
     db.commit()
+    invalidate_cache()
+
+    return list_networks()
 
-    return get_network(c.lastrowid)
 
 
+# Replace the entire network configuration with the list of networks in the
+# request body within a single database transaction. With the query parameter
+# apply=1, the new configuration is also applied. Returns the version of the
+# new configuration.
+@app.route('/net', methods=['PUT'])
+@locked
+def replace_networks():
+    data = request_data()
+    if not isinstance(data, list):
+        return respond({'error': 'Expected a list of networks'}, 400)
 
+    rows = []
+    for attrs in data:
+        for k in LOCAL_ATTRS:
+            attrs.pop(k, None)
+        rows.append((json.dumps(attrs), net_hash(attrs)))
+
+    c = db.cursor()
+    try:
+        if request.if_match and not request.if_match.contains(config_version()):
+            return '', 412
+
+        c.execute('DELETE FROM net')
+        c.executemany('INSERT INTO net (attrs, hash) VALUES (?, ?)', rows)
+    except:
+        db.rollback()
+        raise
+    db.commit()
+    invalidate_cache()
+
+    v = config_version()
+    if request.args.get('apply', '0') not in ('0', ''):
+        job = applier.create()
+        resp = respond({'version': v, 'job': job.id}, 202)
+        resp.headers['Location'] = '/apply/%s' % job.id
+        start_apply(resp, job)
+    else:
+        resp = respond({'version': v})
+    resp.set_etag(v)
+    return resp
+
+
+# Apply the network configuration asynchronously. The response contains the
+# id of the apply job which can be used to poll its status at /apply/<id>.
 @app.route('/apply', methods=['POST'])
 def apply():
-    sleep(2)
-    apply_network_configuration()
-    return '', 204
+    job = applier.create()
+    resp = respond(job.as_dict(), 202)
+    resp.headers['Location'] = '/apply/%s' % job.id
+    return start_apply(resp, job)
+
+
+@app.route('/apply/<id>', methods=['GET'])
+def apply_status(id):
+    job = applier.get(id)
+    if job is None:
+        return respond({'error': 'Unknown job %s' % id}, 404)
+    return respond(job.as_dict())
+
+
+# Blobs referenced by network configurations. HEAD returns 200 if the blob is
+# stored and 404 otherwise. In both cases, the Upload-Offset header contains
+# the number of bytes received so far. PUT uploads the blob, or a chunk of it
+# given by the Content-Range header, in which case the upload continues where
+# the last chunk ended. PUT returns 201 once the blob is complete and 202 if
+# more data is expected.
+@app.route('/blob/<hash>', methods=['HEAD'])
+def head_blob(hash):
+    if not is_valid_hash(hash):
+        return '', 400
+
+    resp = app.response_class(status=200 if blobs.exists(hash) else 404)
+    resp.headers['Upload-Offset'] = str(blobs.size(hash) if resp.status_code == 200 else blobs.offset(hash))
+    return resp
+
+
+@app.route('/blob/<hash>', methods=['PUT'])
+def put_blob(hash):
+    if not is_valid_hash(hash):
+        return respond({'error': 'Invalid blob hash %s' % hash}, 400)
+
+    data = request.get_data()
+    if 'Content-Range' not in request.headers:
+        start, total = 0, len(data)
+    else:
+        r = parse_content_range_header(request.headers['Content-Range'])
+        if r is None or r.length is None or r.stop - r.start != len(data):
+            return respond({'error': 'Invalid Content-Range'}, 400)
+        start, total = r.start, r.length
+
+    if total > blobs.max_size:
+        return respond({'error': 'Blob too large'}, 413)
+
+    try:
+        done = blobs.write(hash, start, data, total)
+    except OffsetMismatch as e:
+        resp = respond({'error': str(e)}, 409)
+        resp.headers['Upload-Offset'] = str(e.offset)
+        return resp
+    except DigestMismatch as e:
+        return respond({'error': str(e)}, 422)
+    except BlobError as e:
+        return respond({'error': str(e)}, 400)
+
+    resp = app.response_class(status=201 if done else 202)
+    resp.headers['Upload-Offset'] = str(total if done else start + len(data))
+    return resp
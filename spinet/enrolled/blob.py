@@ -0,0 +1,116 @@
+import os
+import re
+import hashlib
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BlobError(Exception):
+    pass
+
+
+class OffsetMismatch(BlobError):
+    def __init__(self, offset):
+        super().__init__('Upload must continue at offset %d' % offset)
+        self.offset = offset
+
+
+class DigestMismatch(BlobError):
+    pass
+
+
+def is_valid_hash(hash):
+    return HASH_RE.match(hash) is not None
+
+
+class BlobStore(object):
+    '''Content-addressed store of files (certificates, private keys, etc.)
+    referenced by network configurations.
+
+    Blobs are stored in directory path in files named after the SHA-256 hash
+    (hex) of their content, so that wpa_supplicant can load them directly.
+    Blobs are uploaded in chunks that must be written in order. Data received
+    so far is kept in a .part file so that an interrupted upload can be
+    resumed at the offset returned by offset(). Once all data has been
+    received, the content is checked against the hash and the blob becomes
+    available.
+    '''
+    def __init__(self, path, max_size=1024 * 1024):
+        self.dir = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+
+    def path(self, hash):
+        return os.path.join(self.dir, hash)
+
+
+    def _part_path(self, hash):
+        return os.path.join(self.dir, '%s.part' % hash)
+
+
+    def exists(self, hash):
+        return os.path.isfile(self.path(hash))
+
+
+    def size(self, hash):
+        return os.path.getsize(self.path(hash))
+
+
+    def offset(self, hash):
+        '''Return the number of bytes of the blob received so far.
+        '''
+        try:
+            return os.path.getsize(self._part_path(hash))
+        except FileNotFoundError:
+            return 0
+
+
+    def write(self, hash, offset, data, total):
+        '''Write a chunk of data at offset of the blob with the given hash
+        and total size. Return True if the blob is complete, False if more
+        data is expected.
+
+        Raises OffsetMismatch if offset is not where the upload stopped and
+        DigestMismatch if the complete data does not match the hash. The
+        partial data is discarded in the latter case.
+        '''
+        if total > self.max_size:
+            raise BlobError('Blob too large (%d bytes, maximum %d)' % (total, self.max_size))
+        if offset + len(data) > total:
+            raise BlobError('Chunk exceeds the total size of the blob')
+
+        with self.lock:
+            if self.exists(hash):
+                return True
+
+            current = self.offset(hash)
+            if offset != current:
+                raise OffsetMismatch(current)
+
+            # Blobs include private keys, only the owner may read them. The
+            # final blob is the renamed .part file and keeps its mode.
+            os.makedirs(self.dir, mode=0o700, exist_ok=True)
+            part = self._part_path(hash)
+            with os.fdopen(os.open(part, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), 'ab') as f:
+                f.write(data)
+
+            if offset + len(data) < total:
+                return False
+
+            h = hashlib.sha256()
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    h.update(chunk)
+
+            if h.hexdigest() != hash:
+                os.unlink(part)
+                raise DigestMismatch('Blob content does not match hash %s' % hash)
+
+            os.rename(part, self.path(hash))
+            log.debug('Stored blob %s (%d bytes)' % (hash, total))
+            return True
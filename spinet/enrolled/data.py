@@ -1,8 +1,24 @@
+import json
 import logging
+import functools
+import threading
 from . import db
+from spinet.netconf import net_hash
 
 log = logging.getLogger(__name__)
 
+# The database connection is shared by all threads of the HTTP server and the
+# apply job thread. Every transaction must be performed with the lock held.
+lock = threading.RLock()
+
+
+def locked(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with lock:
+            return f(*args, **kwargs)
+    return wrapper
+
 
 def initialize_db():
     c = db.cursor()
@@ -10,8 +26,22 @@ def initialize_db():
     CREATE TABLE IF NOT EXISTS net
      (id      INTEGER PRIMARY KEY AUTOINCREMENT,
       attrs   TEXT,
+      hash    TEXT,
       created text    DEFAULT CURRENT_TIMESTAMP)
     ''')
+
+    # Databases created by older versions have no hash column. Add it and
+    # compute the hash of existing networks.
+    columns = [row[1] for row in c.execute('PRAGMA table_info(net)').fetchall()]
+    if 'hash' not in columns:
+        log.debug('Adding content hash column to table net')
+        c.execute('ALTER TABLE net ADD COLUMN hash TEXT')
+    for id, attrs in c.execute('SELECT id, attrs FROM net WHERE hash IS NULL').fetchall():
+        c.execute('UPDATE net SET hash=? WHERE id=?', (net_hash(json.loads(attrs)), id))
+
+    c.execute('''
+    CREATE INDEX IF NOT EXISTS hash_idx ON net (hash)
+    ''')
     db.commit()
 
 from spinet.config import Config
@@ -0,0 +1,158 @@
+import time
+import uuid
+import logging
+import threading
+from   collections import OrderedDict, deque
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+    '''A network configuration apply job.
+
+    State is one of queued, running, connecting, done and failed. Once the
+    job is done, connected tells whether wpa_supplicant connected to a
+    network after the configuration had been applied and event holds the
+    last connection event seen while waiting.
+    '''
+    __slots__ = ('id', 'state', 'created', 'started', 'finished', 'changed', 'connected', 'event', 'error')
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:16]
+        self.state = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.changed = None
+        self.connected = None
+        self.event = None
+        self.error = None
+
+
+    def as_dict(self):
+        return dict([(k, getattr(self, k)) for k in self.__slots__])
+
+
+    def __repr__(self):
+        return '%s(%s, %s)' % (type(self).__name__, self.id, self.state)
+
+
+
+class ApplyQueue(object):
+    '''Run network configuration apply jobs in a background thread.
+
+    Jobs are executed one at a time in the order in which they were
+    started. The function apply is called to apply the configuration. It
+    returns False if there was nothing to change. After a change, the job
+    waits for a CTRL-EVENT-CONNECTED event (reported through event()) for up
+    to connect_timeout seconds. All unfinished jobs and the last history
+    finished jobs are kept for status queries.
+    '''
+    CONNECTED = 'CTRL-EVENT-CONNECTED'
+    FINISHED = ('done', 'failed')
+
+    def __init__(self, apply, is_connected, connect_timeout=30, history=16):
+        self.apply = apply
+        self.is_connected = is_connected
+        self.connect_timeout = connect_timeout
+        self.history = history
+
+        self.lock = threading.Condition()
+        self.queue = deque()
+        self.jobs = OrderedDict()
+        self.connects = 0
+        self.last_event = None
+        self.thread = None
+
+
+    def _expire(self):
+        # Forget the oldest finished jobs. Jobs that have not finished yet
+        # are kept regardless of their number so that they can be polled.
+        finished = [id for id, job in self.jobs.items() if job.state in self.FINISHED]
+        for id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[id]
+
+
+    def create(self):
+        '''Create a new job. The job does not run until it is started with
+        start().
+        '''
+        job = Job()
+        with self.lock:
+            self.jobs[job.id] = job
+            self._expire()
+        return job
+
+
+    def start(self, job):
+        with self.lock:
+            self.queue.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify_all()
+
+
+    def get(self, id):
+        with self.lock:
+            return self.jobs.get(id, None)
+
+
+    def event(self, name, data):
+        '''Report a wpa_supplicant connection event.
+        '''
+        with self.lock:
+            self.last_event = '%s %s' % (name, data)
+            if name == self.CONNECTED:
+                self.connects += 1
+            self.lock.notify_all()
+
+
+    def _run_job(self, job):
+        with self.lock:
+            job.state = 'running'
+            job.started = time.time()
+            connects = self.connects
+
+        try:
+            job.changed = self.apply() is not False
+        except Exception as e:
+            log.exception('Apply job %s failed' % job.id)
+            with self.lock:
+                job.state = 'failed'
+                job.error = str(e)
+                job.finished = time.time()
+            return
+
+        with self.lock:
+            if job.changed:
+                job.state = 'connecting'
+                deadline = time.monotonic() + self.connect_timeout
+                while self.connects == connects:
+                    t = deadline - time.monotonic()
+                    if t <= 0:
+                        break
+                    self.lock.wait(t)
+                job.connected = self.connects != connects
+                job.event = self.last_event
+
+        if not job.connected:
+            try:
+                job.connected = self.is_connected()
+            except Exception:
+                log.exception('Could not obtain connection status')
+
+        with self.lock:
+            job.state = 'done'
+            job.finished = time.time()
+        log.debug('Apply job %s done (connected: %s)' % (job.id, job.connected))
+
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.lock.wait()
+                job = self.queue.popleft()
+            self._run_job(job)
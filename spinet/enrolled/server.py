@@ -0,0 +1,86 @@
+import ssl
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def ssl_context(crt_path, key_path):
+    '''Create the TLS context for the HTTP API.
+
+    Session tickets are enabled explicitly so that clients can resume TLS
+    sessions and skip the expensive (RSA) part of the handshake on
+    subsequent connections.
+    '''
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(crt_path, key_path)
+    ctx.options &= ~ssl.OP_NO_TICKET
+    if hasattr(ctx, 'num_tickets'):
+        ctx.num_tickets = 2
+    return ctx
+
+
+def serve_flask(app, host, port, ctx, crt_path, key_path, **kwds):
+    '''Serve the API with the Flask development server.
+
+    The server starts a new thread for every connection. Recent versions of
+    Werkzeug close the connection after every response regardless of the
+    HTTP version, so clients only benefit from TLS session resumption here.
+    Use cheroot for keep-alive connections.
+    '''
+    from werkzeug.serving import WSGIRequestHandler
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    app.run(host=host, port=port, ssl_context=ctx, threaded=True)
+
+
+def serve_cheroot(app, host, port, ctx, crt_path, key_path, threads=4, max_threads=8, timeout=30, **kwds):
+    '''Serve the API with the cheroot WSGI server.
+
+    Requests are handled by a bounded pool of threads (threads to
+    max_threads). Idle keep-alive connections are closed after timeout
+    seconds.
+    '''
+    from cheroot import wsgi
+    from cheroot.ssl.builtin import BuiltinSSLAdapter
+
+    server = wsgi.Server((host, port), app, numthreads=threads, max=max_threads, timeout=timeout)
+
+    # The adapter requires the certificate and key files, but we replace its
+    # context with ours to control session resumption.
+    adapter = BuiltinSSLAdapter(crt_path, key_path)
+    adapter.context = ctx
+    server.ssl_adapter = adapter
+
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+SERVERS = {
+    'flask'   : serve_flask,
+    'cheroot' : serve_cheroot
+}
+
+
+def default_server():
+    try:
+        import cheroot
+    except ImportError:
+        return 'flask'
+    return 'cheroot'
+
+
+def serve(app, host, port, crt_path, key_path, server=None, **kwds):
+    '''Serve the WSGI application app over HTTPS until interrupted.
+
+    Server selects one of SERVERS. By default cheroot is used if installed,
+    with the Flask development server as fallback.
+    '''
+    if server is None:
+        server = default_server()
+
+    log.debug('Starting %s HTTPS server on %s:%d' % (server, host, port))
+    ctx = ssl_context(crt_path, key_path)
+    SERVERS[server](app, host, port, ctx, crt_path, key_path, **kwds)
@@ -1,6 +1,6 @@
 import os
 import binascii
-from pyroute2 import IPRoute
+from .netlink import links
 import random
 
 
@@ -15,15 +15,13 @@ def random_addr_ipv4():
     return (('192.168.49.%s' % random.randint(2,253)), 24)
 
 
-def add_addr(ifname, addr):
-    ip = IPRoute()
-    i = ip.link_lookup(ifname=ifname)[0]
-    ip.addr('add', index=i, address=addr[0], scope=253, prefixlen=addr[1])
-    ip.close()
+def add_addr(ifname, addr, nodad=False):
+    '''Add the address, an (address, prefix length) tuple, to the interface.
+    With nodad, an IPv6 address is usable immediately, without duplicate
+    address detection.
+    '''
+    links.add_addrs(ifname, [addr], scope=253, nodad=nodad)
 
 
 def del_addr(ifname, addr):
-    ip = IPRoute()
-    i = ip.link_lookup(ifname=ifname)[0]
-    ip.addr('del', index=i, address=addr[0], prefixlen=addr[1])
-    ip.close()
+    links.del_addrs(ifname, [addr])
@@ -0,0 +1,66 @@
+import json
+import hashlib
+
+# Network configuration hashing shared by the commissioner and enrolled. Both
+# sides must compute the same hash for the same network, so the hash is taken
+# over a canonical JSON representation of the network's attributes without
+# the local (database) attributes listed in LOCAL_ATTRS.
+
+LOCAL_ATTRS = ('id', 'hash')
+
+# Network attributes that name files, e.g., certificates and private keys for
+# 802.1X, can reference a blob instead: {"ca_cert": {"blob": "<hash>"}}. The
+# blob is transferred separately and identified by the SHA-256 hash (hex) of
+# its content, so a blob shared by many networks is only sent once.
+BLOB = 'blob'
+
+
+def canonical(attrs):
+    attrs = dict([(k, v) for k, v in attrs.items() if k not in LOCAL_ATTRS])
+    return json.dumps(attrs, sort_keys=True, separators=(',', ':'))
+
+
+def net_hash(attrs):
+    '''Return the content hash (hex string) of a network configuration.
+    '''
+    return hashlib.sha256(canonical(attrs).encode('utf-8')).hexdigest()
+
+
+def version(hashes):
+    '''Return the version of a configuration made of networks with the given
+    content hashes. The version does not depend on the order of networks.
+    '''
+    h = hashlib.sha256()
+    for v in sorted(hashes):
+        h.update(v.encode('ascii'))
+    return h.hexdigest()[:32]
+
+
+def diff(current, desired):
+    '''Compare two configurations, each given as a dict mapping content hash
+    to network attributes. Return a tuple (add, remove) with the list of
+    networks from desired that are missing in current and the list of hashes
+    from current that are not in desired.
+    '''
+    add = [attrs for h, attrs in desired.items() if h not in current]
+    remove = [h for h in current.keys() if h not in desired]
+    return add, remove
+
+
+def blob_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def blob_ref(hash):
+    return {BLOB: hash}
+
+
+def is_blob_ref(value):
+    return isinstance(value, dict) and len(value) == 1 and isinstance(value.get(BLOB, None), str)
+
+
+def blob_refs(attrs):
+    '''Return the list of hashes of all blobs referenced by the network
+    attrs.
+    '''
+    return [v[BLOB] for v in attrs.values() if is_blob_ref(v)]
@@ -0,0 +1,297 @@
+import os
+import errno
+import socket
+import select
+import logging
+import itertools
+import threading
+from   pyroute2.netlink import NLM_F_REQUEST, NLM_F_ACK, NLM_F_CREATE, NLM_F_EXCL, NLM_F_DUMP, NLMSG_ERROR, NLMSG_DONE
+from   pyroute2.netlink.rtnl import RTM_NEWLINK, RTM_DELLINK, RTM_GETLINK, RTM_NEWADDR, RTM_DELADDR, RTM_GETADDR, RTM_GETNEIGH
+from   pyroute2.netlink.rtnl import RTMGRP_LINK, RTMGRP_IPV4_IFADDR, RTMGRP_IPV6_IFADDR
+from   pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+from   pyroute2.netlink.rtnl.ifaddrmsg import ifaddrmsg, IFA_F_NODAD
+from   pyroute2.netlink.rtnl.ndmsg import ndmsg
+from   pyroute2.netlink.rtnl.marshal import MarshalRtnl
+
+log = logging.getLogger(__name__)
+
+# We talk to the kernel over plain netlink sockets and use pyroute2 only to
+# encode and parse messages. pyroute2's IPRoute objects cannot be used from
+# another thread than the one that created them.
+
+
+class NetlinkError(OSError):
+    pass
+
+
+
+def addr_family(addr):
+    return socket.AF_INET6 if ':' in addr else socket.AF_INET
+
+
+class LinkMonitor(object):
+    '''Cached view of the network interfaces and their addresses.
+
+    The cache is filled with a dump when the monitor starts and is kept up to
+    date by a thread that listens to rtnetlink link and address
+    notifications, so lookups do not talk to the kernel. The published dicts
+    indices (interface name to index) and addrs (interface index to a
+    frozenset of addresses) are replaced, never modified, on changes. If
+    notifications are lost (ENOBUFS), the cache is reloaded with a new dump.
+
+    Requests (dumps and address changes) are sent over a second long-lived
+    netlink socket. Address changes for one interface are sent to the kernel
+    in a single batch.
+    '''
+    def __init__(self):
+        self.indices = {}
+        self.addrs = {}
+
+        self.marshal = MarshalRtnl()
+        self.seq = itertools.count(1)
+        self.lock = threading.Lock()     # Protects the cache
+        self.req_lock = threading.Lock() # Serializes requests
+        self.events = None
+        self.requests = None
+
+        self.thread = None
+        self.running = False
+
+
+    def start(self):
+        with self.req_lock:
+            if self.thread is not None:
+                return
+
+            # Subscribe before the dump so that no change is missed. The
+            # notifications received meanwhile are applied after the dump.
+            self.events = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            self.events.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+            self.events.setblocking(False)
+
+            self.requests = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            self.requests.bind((0, 0))
+
+            self.wakeup_r, self.wakeup_w = os.pipe()
+            os.set_blocking(self.wakeup_r, False)
+            self.epoll = select.epoll()
+            self.epoll.register(self.wakeup_r, select.EPOLLIN)
+            self.epoll.register(self.events.fileno(), select.EPOLLIN)
+
+            self._sync()
+
+            self.running = True
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def stop(self):
+        with self.req_lock:
+            thread, self.thread = self.thread, None
+            self.running = False
+        if thread is not None:
+            os.write(self.wakeup_w, b'\0')
+            thread.join()
+            self.epoll.close()
+            self.events.close()
+            self.requests.close()
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+
+
+    def _request(self, msgs):
+        # Send all messages in one batch and collect the responses. Return a
+        # list of (messages, errno) tuples, one for each request.
+        seqs = {}
+        data = b''
+        for msg, type_, flags in msgs:
+            seq = next(self.seq)
+            seqs[seq] = len(seqs)
+            msg['header']['type'] = type_
+            msg['header']['flags'] = NLM_F_REQUEST | flags
+            msg['header']['sequence_number'] = seq
+            msg.encode()
+            data += msg.data
+
+        rv = [([], 0) for _ in msgs]
+        self.requests.send(data)
+        while seqs:
+            for msg in self.marshal.parse(self.requests.recv(1 << 16)):
+                i = seqs.get(msg['header']['sequence_number'], None)
+                if i is None:
+                    continue
+                type_ = msg['header']['type']
+                if type_ == NLMSG_ERROR:
+                    rv[i] = (rv[i][0], -(msg['error'] or 0))
+                    del seqs[msg['header']['sequence_number']]
+                elif type_ == NLMSG_DONE:
+                    del seqs[msg['header']['sequence_number']]
+                else:
+                    rv[i][0].append(msg)
+        return rv
+
+
+    def _dump(self, msg, type_):
+        [(rv, err)] = self._request([(msg, type_, NLM_F_DUMP)])
+        if err != 0:
+            raise NetlinkError(err, os.strerror(err))
+        return rv
+
+
+    def _sync(self):
+        # Replace the cache with a dump of all links and addresses. Must be
+        # called with req_lock held. The kernel runs only one dump at a time
+        # per socket.
+        msgs = self._dump(ifinfmsg(), RTM_GETLINK)
+        msgs.extend(self._dump(ifaddrmsg(), RTM_GETADDR))
+        self._update(msgs, reset=True)
+
+
+    def _update(self, msgs, reset=False):
+        with self.lock:
+            indices, addrs = ({}, {}) if reset else (None, None)
+            for msg in msgs:
+                type_ = msg['header']['type']
+                if type_ in (RTM_NEWLINK, RTM_DELLINK):
+                    indices = dict(self.indices) if indices is None else indices
+                    name = msg.get_attr('IFLA_IFNAME')
+                    if type_ == RTM_NEWLINK:
+                        indices[name] = msg['index']
+                    else:
+                        if indices.get(name, None) == msg['index']:
+                            del indices[name]
+                        addrs = dict(self.addrs) if addrs is None else addrs
+                        addrs.pop(msg['index'], None)
+                elif type_ in (RTM_NEWADDR, RTM_DELADDR):
+                    addrs = dict(self.addrs) if addrs is None else addrs
+                    addr = msg.get_attr('IFA_LOCAL') or msg.get_attr('IFA_ADDRESS')
+                    current = addrs.get(msg['index'], frozenset())
+                    if type_ == RTM_NEWADDR:
+                        addrs[msg['index']] = current | set([addr])
+                    else:
+                        addrs[msg['index']] = current - set([addr])
+
+            if indices is not None:
+                self.indices = indices
+            if addrs is not None:
+                self.addrs = addrs
+
+
+    def run(self):
+        while self.running:
+            msgs = []
+            overrun = False
+            for fd, _ in self.epoll.poll():
+                if fd == self.wakeup_r:
+                    continue
+                while True:
+                    try:
+                        msgs.extend(self.marshal.parse(self.events.recv(1 << 16)))
+                    except BlockingIOError:
+                        break
+                    except OSError as e:
+                        if e.errno != errno.ENOBUFS:
+                            log.warning('Could not receive link notifications: %s' % e)
+                            break
+                        # Notifications have been lost
+                        overrun = True
+
+            if overrun:
+                # The notifications read so far may be followed by lost ones
+                # and are superseded by the dump. Those that arrive from now
+                # on are applied after the dump in the next round.
+                log.warning('Link notifications lost, reloading links and addresses')
+                msgs = []
+                try:
+                    with self.req_lock:
+                        if not self.running:
+                            break
+                        self._sync()
+                except OSError as e:
+                    log.error('Could not reload links and addresses: %s' % e)
+            self._update(msgs)
+
+
+    def index(self, ifname):
+        '''Return the index of the interface with the given name.
+        '''
+        if self.thread is None:
+            self.start()
+        i = self.indices.get(ifname, None)
+        if i is None:
+            # The notification about a new interface may not have been
+            # processed yet
+            i = socket.if_nametoindex(ifname)
+        return i
+
+
+    def addresses(self, ifname):
+        '''Return a frozenset of the IPv4 and IPv6 addresses (without prefix
+        length) of the interface with the given name.
+        '''
+        return self.addrs.get(self.index(ifname), frozenset())
+
+
+    def _addr_msg(self, index, addr, scope=None, flags=0):
+        msg = ifaddrmsg()
+        msg['family'] = addr_family(addr[0])
+        msg['prefixlen'] = addr[1]
+        msg['index'] = index
+        msg['flags'] = flags & 0xff
+        if scope is not None:
+            msg['scope'] = scope
+        msg['attrs'] = [('IFA_LOCAL', addr[0]), ('IFA_ADDRESS', addr[0]), ('IFA_FLAGS', flags)]
+        return msg
+
+
+    def _change_addrs(self, ifname, addrs, type_, flags, make):
+        index = self.index(ifname)
+        msgs = [(make(index, addr), type_, NLM_F_ACK | flags) for addr in addrs]
+        with self.req_lock:
+            rv = self._request(msgs)
+
+        # Update the cache right away so that the caller sees its changes
+        # even before the notifications arrive
+        self._update([msg for (msg, _, _), (_, err) in zip(msgs, rv) if err == 0])
+
+        failed = [(addr, err) for addr, (_, err) in zip(addrs, rv) if err != 0]
+        if failed:
+            addr, err = failed[0]
+            raise NetlinkError(err, '%s: %s/%d on %s' % (os.strerror(err), addr[0], addr[1], ifname))
+
+
+    def add_addrs(self, ifname, addrs, scope=None, nodad=False):
+        '''Add the addresses, a list of (address, prefix length) tuples, to
+        the interface in one batch. With nodad, IPv6 addresses skip duplicate
+        address detection and are usable immediately.
+
+        Raises NetlinkError for the first address that could not be added.
+        The other addresses are added regardless.
+        '''
+        def make(index, addr):
+            nd = nodad and addr_family(addr[0]) == socket.AF_INET6
+            return self._addr_msg(index, addr, scope, IFA_F_NODAD if nd else 0)
+
+        self._change_addrs(ifname, addrs, RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, make)
+
+
+    def del_addrs(self, ifname, addrs):
+        '''Remove the addresses, a list of (address, prefix length) tuples,
+        from the interface in one batch.
+        '''
+        self._change_addrs(ifname, addrs, RTM_DELADDR, 0, self._addr_msg)
+
+
+    def neighbours(self, ifname, family=socket.AF_INET6):
+        '''Return the neighbor table entries (ndmsg) of the interface.
+        '''
+        index = self.index(ifname)
+        msg = ndmsg()
+        msg['family'] = family
+        with self.req_lock:
+            rv = self._dump(msg, RTM_GETNEIGH)
+        return [m for m in rv if m['ifindex'] == index]
+
+
+links = LinkMonitor()
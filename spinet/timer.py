@@ -0,0 +1,78 @@
+import time
+
+
+class TimerWheel(object):
+    '''Hashed timing wheel.
+
+    Keeps deadlines for a large number of keys with constant cost per
+    schedule, cancel and tick, regardless of the number of keys. Deadlines
+    are given in time.monotonic() seconds and are rounded up to the tick
+    resolution. Rescheduling and canceling are lazy: a key is only removed
+    from its old slot when the wheel reaches the slot.
+    '''
+    def __init__(self, tick=1.0, slots=64, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}
+        self.current = self._tick(now)
+
+
+    def _tick(self, t):
+        return int(t // self.tick)
+
+
+    def schedule(self, key, deadline):
+        '''Schedule (or reschedule) the given key to expire at deadline.
+        '''
+        # Round the deadline up to the next tick. Deadlines in the past expire
+        # on the next tick.
+        t = -int(-deadline // self.tick)
+        t = max(t, self.current + 1)
+        self.deadlines[key] = t
+        self.slots[t % len(self.slots)].add(key)
+
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+
+    def __len__(self):
+        return len(self.deadlines)
+
+
+    def advance(self, now=None):
+        '''Advance the wheel to time now and return a list of keys whose
+        deadline has passed.
+        '''
+        if now is None:
+            now = time.monotonic()
+
+        end = self._tick(now)
+        n = len(self.slots)
+        # There is no need to visit any slot more than once
+        start = max(self.current + 1, end - n + 1)
+
+        expired = []
+        for t in range(start, end + 1):
+            idx = t % n
+            slot = self.slots[idx]
+            for key in list(slot):
+                deadline = self.deadlines.get(key, None)
+                if deadline is None:
+                    slot.discard(key)
+                elif deadline <= t:
+                    slot.discard(key)
+                    del self.deadlines[key]
+                    expired.append(key)
+                elif deadline % n != idx:
+                    # The key has been rescheduled into another slot
+                    slot.discard(key)
+
+        self.current = max(self.current, end)
+        return expired
@@ -1,6 +1,8 @@
 import os
+import re
 import sys
 import errno
+import hashlib
 import time
 import socket
 import blinker
@@ -55,6 +57,28 @@ def quoted(val):
     return '"%s"' % val
 
 
+RAW_PSK_RE = re.compile(r'^[0-9a-fA-F]{64}$')
+
+
+def is_raw_psk(val):
+    return RAW_PSK_RE.match(val) is not None
+
+
+def derive_psk(ssid, passphrase):
+    '''Derive the 256-bit WPA pre-shared key from an SSID and a passphrase
+    (PBKDF2-SHA1 with 4096 iterations, IEEE 802.11i). Return the key as 64
+    hex digits, the form wpa_supplicant accepts as a raw PSK.
+    '''
+    if not 8 <= len(passphrase) <= 63:
+        raise ValueError('WPA passphrase must be 8 to 63 characters long')
+    return hashlib.pbkdf2_hmac('sha1', passphrase.encode('utf-8'), ssid.encode('utf-8'), 4096, 32).hex()
+
+
+def psk(val):
+    # wpa_supplicant expects a passphrase in quotes and a raw PSK without
+    return val if is_raw_psk(val) else quoted(val)
+
+
 def parse_dict(data):
     rv = {}
     for l in data.splitlines():
@@ -369,7 +393,7 @@ class WPASupplicant(object):
         'private_key_passwd': True,
         'proactive_key_caching': True,
         'proto': True,
-        'psk': quoted,
+        'psk': psk,
         'psk_list': True,
         'scan_freq': True,
         'scan_ssid': True,
@@ -0,0 +1,52 @@
+import sqlite3
+import pytest
+
+
+@pytest.fixture(scope='session')
+def enrolled_api(tmp_path_factory):
+    '''The enrolled API module with a temporary database and blob directory.
+
+    The enrolled modules bind the database and the blob directory when they
+    are imported, so the globals must be set before the first import.
+    '''
+    import spinet.enrolled as enrolled
+    tmp = tmp_path_factory.mktemp('enrolled')
+    enrolled.db = sqlite3.connect(str(tmp / 'enrolled.db'), check_same_thread=False)
+    enrolled.blob_dir = str(tmp / 'blobs')
+
+    from spinet.enrolled import data, api
+    data.initialize_db()
+    return api
+
+
+@pytest.fixture
+def client(enrolled_api):
+    '''A Flask test client for the enrolled API with no networks configured.
+    '''
+    import spinet.enrolled as enrolled
+    enrolled.db.execute('DELETE FROM net')
+    enrolled.db.commit()
+    enrolled_api.invalidate_cache()
+    return enrolled_api.app.test_client()
+
+
+@pytest.fixture(scope='session')
+def cms_db():
+    '''The commissioner database module with an in-memory database.
+    '''
+    import spinet.cms as cms
+    cms.db = sqlite3.connect(':memory:', check_same_thread=False)
+
+    from spinet.cms import data
+    data.initialize_db()
+    return data
+
+
+@pytest.fixture
+def registry(cms_db):
+    '''The commissioner database module with an empty device registry.
+    '''
+    import spinet.cms as cms
+    cms.db.execute('DELETE FROM device')
+    cms.db.commit()
+    return cms_db
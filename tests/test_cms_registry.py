@@ -0,0 +1,104 @@
+import base64
+import sqlite3
+import pytest
+from   spinet import content
+
+
+def label(name, fpr, version=1):
+    return base64.b64encode(content.dumps([version, name, fpr], content.CBOR))
+
+
+def fpr(n):
+    return bytes([n]) * 32
+
+
+def names(registry):
+    import spinet.cms as cms
+    return sorted(cms.db.execute('SELECT name, fingerprint FROM device').fetchall())
+
+
+def test_import(registry):
+    assert registry.import_labels([label('dev1', fpr(1)), label('dev2', fpr(2))]) == 2
+    d = registry.device_by_name('dev1')
+    assert d['fingerprint'] == fpr(1)
+    assert d['state'] == 'new'
+    assert registry.is_registered(fpr(2))
+    assert not registry.is_registered(fpr(3))
+
+
+def test_import_upserts_by_fingerprint(registry):
+    registry.import_labels([label('dev1', fpr(1)), label('dev2', fpr(2))])
+    registry.device_seen(fpr(1), ip='fe80::1%wlan0')
+
+    # Re-importing renames the device but keeps what is known about it
+    registry.import_labels([label('renamed', fpr(1)), label('dev3', fpr(3)), label('dev3b', fpr(3))])
+    assert names(registry) == [('dev2', fpr(2)), ('dev3b', fpr(3)), ('renamed', fpr(1))]
+
+    d = registry.device_by_fingerprint(fpr(1))
+    assert d['state'] == 'enrolled'
+    assert d['ip'] == 'fe80::1%wlan0'
+
+
+def test_malformed_label_imports_nothing(registry):
+    for bad in [b'not base64!', base64.b64encode(b'\xff'), label('dev', fpr(2), version=2),
+                label('dev', b'short'), label(None, fpr(2))]:
+        with pytest.raises(ValueError, match='Label 2'):
+            registry.import_labels([label('dev1', fpr(1)), bad])
+    assert names(registry) == []
+
+
+def test_import_rolls_back_on_database_error(registry):
+    import spinet.cms as cms
+    cms.db.execute('''CREATE TEMP TRIGGER reject BEFORE INSERT ON device WHEN NEW.name = "bad"
+                      BEGIN SELECT RAISE(ABORT, "rejected"); END''')
+    try:
+        with pytest.raises(sqlite3.IntegrityError):
+            registry.import_labels([label('dev1', fpr(1)), label('dev2', fpr(2)), label('bad', fpr(3))])
+    finally:
+        cms.db.execute('DROP TRIGGER reject')
+
+    # The devices inserted before the error must not be committed later
+    cms.db.commit()
+    assert names(registry) == []
+
+
+def test_import_label_file(registry, tmp_path):
+    f = tmp_path / 'labels.txt'
+    f.write_text('# Batch 1\n%s\n\n%s\n' % (label('dev1', fpr(1)).decode(), label('dev2', fpr(2)).decode()))
+    assert registry.import_label_file(str(f)) == 2
+    assert names(registry) == [('dev1', fpr(1)), ('dev2', fpr(2))]
+
+
+def test_device_seen(registry):
+    registry.import_labels([label('dev1', fpr(1)), label('dev2', fpr(2))])
+    assert registry.device_seen(fpr(1), ip='fd00::1', p2p_addr='02:00:00:00:00:01')
+    assert not registry.device_seen(fpr(9), ip='fd00::9')
+
+    d = registry.device_by_p2p_addr('02:00:00:00:00:01')
+    assert d['name'] == 'dev1'
+    assert d['ip'] == 'fd00::1'
+    assert d['state'] == 'enrolled'
+    assert d['last_seen'] is not None
+
+    # The address has been reused by another device
+    registry.device_seen(fpr(2), ip='fd00::1')
+    assert registry.device_by_name('dev1')['ip'] is None
+    assert registry.device_pins() == {'fd00::1': fpr(2)}
+
+    # Seeing a provisioned device does not change its state
+    assert registry.device_provisioned(fpr(2))
+    registry.device_seen(fpr(2))
+    d = registry.device_by_name('dev2')
+    assert d['state'] == 'provisioned'
+    assert d['ip'] == 'fd00::1'
+    assert sorted(registry.device_counts()) == [('enrolled', 1), ('provisioned', 1)]
+
+
+def test_network_queries(cms_db):
+    cms_db.add_net('ssid1', type_='Open', hidden=True)
+    id = cms_db.list_nets()[-1][0]
+    assert cms_db.get_net(id) == ('ssid1', 'Open', {'hidden': True})
+    assert cms_db.get_net(id + 1) is None
+
+    hash = cms_db.add_blob(b'certificate')
+    assert (hash, len(b'certificate')) in [row[:2] for row in cms_db.list_blobs()]
@@ -0,0 +1,99 @@
+import os
+import pytest
+from   spinet.netconf import blob_hash
+
+DATA = bytes(range(256)) * 40
+
+
+def put(client, hash, data, start=None, total=None):
+    headers = {}
+    if start is not None:
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, start + len(data) - 1, total)
+    return client.put('/blob/%s' % hash, data=data, headers=headers, content_type='application/octet-stream')
+
+
+@pytest.fixture
+def blob(request):
+    # Use a different blob in every test so that uploads do not interfere
+    data = DATA + request.node.name.encode('ascii')
+    return blob_hash(data), data
+
+
+def test_single_request(client, blob):
+    hash, data = blob
+    assert client.head('/blob/%s' % hash).status_code == 404
+
+    r = put(client, hash, data)
+    assert r.status_code == 201
+
+    r = client.head('/blob/%s' % hash)
+    assert r.status_code == 200
+    assert r.headers['Upload-Offset'] == str(len(data))
+
+
+def test_resume(client, blob, enrolled_api):
+    hash, data = blob
+    r = put(client, hash, data[:4000], 0, len(data))
+    assert r.status_code == 202
+    assert r.headers['Upload-Offset'] == '4000'
+
+    # The upload is interrupted; the client asks where to continue
+    r = client.head('/blob/%s' % hash)
+    assert r.status_code == 404
+    assert r.headers['Upload-Offset'] == '4000'
+
+    assert put(client, hash, data[4000:8000], 4000, len(data)).status_code == 202
+    assert put(client, hash, data[8000:], 8000, len(data)).status_code == 201
+    with open(enrolled_api.blobs.path(hash), 'rb') as f:
+        assert f.read() == data
+
+
+def test_offset_mismatch(client, blob):
+    hash, data = blob
+    put(client, hash, data[:4000], 0, len(data))
+
+    # A retransmitted chunk and a chunk beyond the current offset
+    for start in (0, 6000):
+        r = put(client, hash, data[start:start + 1000], start, len(data))
+        assert r.status_code == 409
+        assert r.headers['Upload-Offset'] == '4000'
+
+    assert put(client, hash, data[4000:], 4000, len(data)).status_code == 201
+
+
+def test_digest_mismatch(client, blob, enrolled_api):
+    hash, data = blob
+    corrupted = data[:-1] + b'x'
+    assert put(client, hash, corrupted[:4000], 0, len(data)).status_code == 202
+    assert put(client, hash, corrupted[4000:], 4000, len(data)).status_code == 422
+
+    # The partial data is discarded and the upload starts over
+    r = client.head('/blob/%s' % hash)
+    assert r.status_code == 404
+    assert r.headers['Upload-Offset'] == '0'
+    assert not os.path.exists(enrolled_api.blobs.path(hash))
+    assert put(client, hash, data).status_code == 201
+
+
+def test_invalid_requests(client, blob, enrolled_api):
+    hash, data = blob
+    assert put(client, 'not-a-hash', data).status_code == 400
+
+    # The Content-Range does not match the length of the body
+    assert put(client, hash, data[:100], 0, len(data)).headers['Upload-Offset'] == '100'
+    r = client.put('/blob/%s' % hash, data=data[100:200], headers={'Content-Range': 'bytes 100-299/%d' % len(data)})
+    assert r.status_code == 400
+
+    big = enrolled_api.blobs.max_size + 1
+    r = client.put('/blob/%s' % hash, data=b'x', headers={'Content-Range': 'bytes 0-0/%d' % big})
+    assert r.status_code == 413
+
+
+def test_permissions(client, blob, enrolled_api):
+    hash, data = blob
+    assert put(client, hash, data[:100], 0, len(data)).status_code == 202
+    assert os.stat(enrolled_api.blobs._part_path(hash)).st_mode & 0o777 == 0o600
+
+    assert put(client, hash, data[100:], 100, len(data)).status_code == 201
+    assert os.stat(enrolled_api.blobs.path(hash)).st_mode & 0o777 == 0o600
+    assert os.stat(enrolled_api.blobs.dir).st_mode & 0o777 == 0o700
@@ -0,0 +1,122 @@
+from spinet.netconf import net_hash
+
+NET1 = {'ssid': 'net1', 'type': 'WPA-PSK', 'psk': 'a' * 64}
+NET2 = {'ssid': 'net2', 'type': 'Open'}
+NET3 = {'ssid': 'net3', 'type': 'WPA-PSK', 'psk': 'b' * 64}
+
+
+def hashes(client):
+    return sorted([n['hash'] for n in client.get('/net').get_json()])
+
+
+def test_patch_applies_delta(client):
+    client.post('/net', json=NET1)
+    client.post('/net', json=NET2)
+
+    r = client.patch('/net', json={'add': [NET3, NET2], 'remove': [net_hash(NET1)]})
+    assert r.status_code == 200
+    assert hashes(client) == sorted([net_hash(NET2), net_hash(NET3)])
+
+
+def test_patch_if_match(client):
+    client.post('/net', json=NET1)
+    etag = client.get('/net').headers['ETag'].strip('"')
+
+    r = client.patch('/net', json={'add': [NET2]}, headers={'If-Match': '"%s"' % etag})
+    assert r.status_code == 200
+    assert hashes(client) == sorted([net_hash(NET1), net_hash(NET2)])
+
+    # The configuration has changed since the ETag was obtained
+    r = client.patch('/net', json={'add': [NET3], 'remove': [net_hash(NET1)]}, headers={'If-Match': '"%s"' % etag})
+    assert r.status_code == 412
+    assert hashes(client) == sorted([net_hash(NET1), net_hash(NET2)])
+
+
+def test_patch_rejects_invalid_body(client):
+    client.post('/net', json=NET1)
+    for body in ([NET2], 'add', {'add': NET2}, {'add': ['x']}, {'remove': net_hash(NET1)}, {'remove': [1]}):
+        assert client.patch('/net', json=body).status_code == 400
+    assert hashes(client) == [net_hash(NET1)]
+
+
+def test_put_replaces_configuration(client):
+    client.post('/net', json=NET1)
+
+    r = client.put('/net', json=[NET2, NET3])
+    assert r.status_code == 200
+    v = r.get_json()['version']
+    assert r.headers['ETag'].strip('"') == v
+    assert client.get('/net').headers['ETag'].strip('"') == v
+    assert hashes(client) == sorted([net_hash(NET2), net_hash(NET3)])
+
+    # Replacing with the same configuration is idempotent
+    client.put('/net', json=[NET2, NET3])
+    assert hashes(client) == sorted([net_hash(NET2), net_hash(NET3)])
+
+
+def test_put_if_match(client):
+    client.put('/net', json=[NET1])
+    stale = client.get('/net').headers['ETag']
+    client.put('/net', json=[NET2])
+
+    r = client.put('/net', json=[NET3], headers={'If-Match': stale})
+    assert r.status_code == 412
+    assert hashes(client) == [net_hash(NET2)]
+
+
+def test_put_rejects_invalid_body(client):
+    client.put('/net', json=[NET1])
+    assert client.put('/net', json={'add': [NET2]}).status_code == 400
+    assert client.put('/net', data=b'{', content_type='application/json').status_code == 400
+    assert hashes(client) == [net_hash(NET1)]
+
+
+def test_etag_not_modified(client):
+    client.post('/net', json=NET1)
+
+    r = client.get('/net')
+    etag = r.headers['ETag']
+    assert client.get('/net', headers={'If-None-Match': etag}).status_code == 304
+
+    # Representations in other encodings share the ETag
+    r = client.get('/net', headers={'Accept': 'application/cbor', 'If-None-Match': etag})
+    assert r.status_code == 304
+
+    id = client.get('/net').get_json()[0]['id']
+    r = client.get('/net/%d' % id)
+    assert r.headers['ETag'].strip('"') == net_hash(NET1)
+    assert client.get('/net/%d' % id, headers={'If-None-Match': r.headers['ETag']}).status_code == 304
+
+
+def test_etag_changes_with_configuration(client):
+    client.post('/net', json=NET1)
+    etag = client.get('/net').headers['ETag']
+
+    # Every modification invalidates the cached responses
+    client.post('/net', json=NET2)
+    r = client.get('/net', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert len(r.get_json()) == 2
+
+    etag = r.headers['ETag']
+    client.delete('/net/%d' % r.get_json()[0]['id'])
+    r = client.get('/net', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert len(r.get_json()) == 1
+
+
+def test_etag_changes_with_ids(client):
+    # Adding the same networks again changes their ids, the cached
+    # representation must not be reused
+    client.put('/net', json=[NET1, NET2])
+    r = client.get('/net')
+    etag, ids = r.headers['ETag'], [n['id'] for n in r.get_json()]
+
+    client.put('/net', json=[NET1, NET2])
+    r = client.get('/net', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert [n['id'] for n in r.get_json()] != ids
+
+    # An If-Match with the old ids fails as well
+    r = client.patch('/net', json={'remove': [net_hash(NET1)]}, headers={'If-Match': etag})
+    assert r.status_code == 412
@@ -0,0 +1,106 @@
+import time
+import threading
+from   spinet.enrolled.jobs import ApplyQueue
+
+
+def wait(job, states=ApplyQueue.FINISHED, timeout=5):
+    deadline = time.monotonic() + timeout
+    while job.state not in states:
+        assert time.monotonic() < deadline, 'Job %s stuck in state %s' % (job.id, job.state)
+        time.sleep(0.01)
+
+
+def test_unchanged_configuration():
+    q = ApplyQueue(lambda: False, lambda: True)
+    job = q.create()
+    assert job.state == 'queued'
+    assert q.get(job.id) is job
+
+    q.start(job)
+    wait(job)
+    assert job.state == 'done'
+    assert job.changed is False
+    assert job.connected is True
+    assert job.started is not None and job.finished >= job.started
+
+
+def test_connected_event():
+    q = ApplyQueue(lambda: True, lambda: False, connect_timeout=5)
+    job = q.create()
+    q.start(job)
+    wait(job, ('connecting',))
+
+    q.event(ApplyQueue.CONNECTED, 'bssid=02:00:00:00:00:01')
+    wait(job)
+    assert job.state == 'done'
+    assert job.changed is True
+    assert job.connected is True
+    assert job.event == '%s bssid=02:00:00:00:00:01' % ApplyQueue.CONNECTED
+
+
+def test_connect_timeout():
+    q = ApplyQueue(lambda: True, lambda: False, connect_timeout=0.05)
+    job = q.create()
+    q.start(job)
+    wait(job)
+    assert job.state == 'done'
+    assert job.connected is False
+
+
+def test_failed_job():
+    def apply():
+        raise RuntimeError('wpa_supplicant is gone')
+
+    q = ApplyQueue(apply, lambda: True)
+    job = q.create()
+    q.start(job)
+    wait(job)
+    assert job.state == 'failed'
+    assert job.error == 'wpa_supplicant is gone'
+    assert job.as_dict()['error'] == job.error
+
+
+def test_jobs_run_in_order():
+    release = threading.Event()
+
+    def apply():
+        release.wait(5)
+        return False
+
+    q = ApplyQueue(apply, lambda: True)
+    jobs = [q.create() for _ in range(3)]
+    for job in jobs:
+        q.start(job)
+
+    wait(jobs[0], ('running',))
+    assert [j.state for j in jobs[1:]] == ['queued', 'queued']
+
+    release.set()
+    for job in jobs:
+        wait(job)
+    assert jobs[0].finished <= jobs[1].started and jobs[1].finished <= jobs[2].started
+
+
+def test_history_keeps_unfinished_jobs():
+    release = threading.Event()
+    q = ApplyQueue(lambda: release.wait(5) and False, lambda: True, history=2)
+
+    running = q.create()
+    q.start(running)
+    wait(running, ('running',))
+
+    # More queued jobs than history; none of them may be evicted
+    queued = [q.create() for _ in range(4)]
+    assert q.get(running.id) is running
+    assert all(q.get(j.id) is j for j in queued)
+
+    for job in queued:
+        q.start(job)
+    release.set()
+    for job in queued:
+        wait(job)
+
+    # Only the last history finished jobs are kept
+    q.create()
+    assert q.get(running.id) is None
+    assert [q.get(j.id) for j in queued] == [None, None] + queued[2:]
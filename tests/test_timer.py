@@ -0,0 +1,67 @@
+from spinet.timer import TimerWheel
+
+
+def wheel(**kwargs):
+    return TimerWheel(now=0, **kwargs)
+
+
+def test_expires_at_deadline():
+    w = wheel(tick=1.0)
+    w.schedule('a', 3)
+    w.schedule('b', 5)
+    assert w.advance(2.9) == []
+    assert w.advance(3) == ['a']
+    assert 'a' not in w and 'b' in w
+    assert w.advance(10) == ['b']
+    assert len(w) == 0
+
+
+def test_deadline_rounded_up_to_tick():
+    w = wheel(tick=0.5)
+    w.schedule('a', 1.2)
+    assert w.advance(1.4) == []
+    assert w.advance(1.5) == ['a']
+
+
+def test_past_deadline_expires_on_next_tick():
+    w = wheel(tick=1.0)
+    w.advance(10)
+    w.schedule('a', 3)
+    assert w.advance(10.5) == []
+    assert w.advance(11) == ['a']
+
+
+def test_reschedule():
+    w = wheel(tick=1.0)
+    w.schedule('a', 3)
+    w.schedule('a', 6)
+    assert w.advance(5) == []
+    assert w.advance(6) == ['a']
+    assert w.advance(100) == []
+
+
+def test_cancel():
+    w = wheel(tick=1.0)
+    w.schedule('a', 3)
+    w.cancel('a')
+    assert 'a' not in w
+    assert w.advance(10) == []
+    assert all(len(s) == 0 for s in w.slots)
+
+
+def test_deadline_beyond_one_rotation():
+    w = wheel(tick=1.0, slots=8)
+    w.schedule('a', 20)
+    # The wheel passes the key's slot twice before its deadline
+    for t in range(1, 20):
+        assert w.advance(t) == []
+    assert w.advance(20) == ['a']
+
+
+def test_large_jump_visits_each_slot_once():
+    w = wheel(tick=1.0, slots=8)
+    keys = ['k%d' % i for i in range(100)]
+    for i, k in enumerate(keys):
+        w.schedule(k, i + 1)
+    assert sorted(w.advance(1000)) == sorted(keys)
+    assert len(w) == 0
@@ -0,0 +1,114 @@
+import pytest
+from   spinet.wpas    import WPAError
+from   spinet.cms.txn import TransactionManager, BROADCAST
+
+PEER = '02:00:00:00:00:01'
+OTHER = '02:00:00:00:00:02'
+
+
+class FakeSupplicant(object):
+    def __init__(self):
+        self.requests = []
+        self.canceled = []
+
+
+    def p2p_serv_disc_req(self, query, addr=BROADCAST):
+        self.requests.append((addr, query))
+        return str(len(self.requests))
+
+
+    def p2p_serv_disc_cancel_req(self, id):
+        self.canceled.append(id)
+
+
+
+@pytest.fixture
+def sup():
+    return FakeSupplicant()
+
+
+@pytest.fixture
+def txns(sup):
+    return TransactionManager(sup, timeout=10)
+
+
+def test_match_by_peer_and_tid(txns):
+    t1 = txns.request(None, addr=PEER)
+    t2 = txns.request(None, addr=OTHER)
+    assert t1.tid == t2.tid == 1
+
+    assert txns.match(OTHER, t1.tid) is t2
+    assert txns.match(PEER, t1.tid + 1) is None
+    assert txns.match(PEER, t1.tid) is t1
+
+    # A response completes a unicast transaction
+    assert txns.match(PEER, t1.tid) is None
+    assert not txns.is_pending(t1)
+
+
+def test_broadcast_matches_every_peer(txns):
+    b = txns.request(None)
+    assert txns.match(PEER, b.tid) is b
+    assert txns.match(OTHER, b.tid) is b
+    assert txns.is_pending(b)
+
+
+def test_broadcast_tid_is_reserved(txns):
+    b = txns.request(None)
+    t = txns.request(None, addr=PEER)
+    assert t.tid != b.tid
+
+
+def test_tid_wraparound(txns):
+    tids = [txns.request(None, addr=PEER).tid for _ in range(255)]
+    assert tids == list(range(1, 256))
+
+    with pytest.raises(WPAError):
+        txns.request(None, addr=PEER)
+
+    # Freed tids are reused after 255, skipping 0
+    assert txns.match(PEER, 7) is not None
+    assert txns.match(PEER, 3) is not None
+    assert txns.request(None, addr=PEER).tid == 3
+    assert txns.request(None, addr=PEER).tid == 7
+
+
+def test_tids_advance_after_match(txns):
+    t = txns.request(None, addr=PEER)
+    txns.match(PEER, t.tid)
+    assert txns.request(None, addr=PEER).tid == t.tid + 1
+
+
+def test_expire(sup, txns):
+    t = txns.request(None, addr=PEER, timeout=5)
+    b = txns.request(None)
+    now = t.deadline - 5
+
+    assert txns.expire(now) == pytest.approx(5)
+    assert txns.expire(now + 5) is None
+    assert not txns.is_pending(t)
+    assert sup.canceled == [t.request_id]
+
+    # Broadcast requests do not expire by default
+    assert txns.is_pending(b)
+
+
+def test_failed_request_releases_tid(sup, txns):
+    def fail(query, addr=BROADCAST):
+        raise WPAError('FAIL')
+    sup.p2p_serv_disc_req = fail
+
+    with pytest.raises(WPAError):
+        txns.request(None, addr=PEER)
+    assert txns.pending == {}
+
+
+def test_cancel_peer(sup, txns):
+    t1 = txns.request(None, addr=PEER)
+    t2 = txns.request(None, addr=PEER)
+    t3 = txns.request(None, addr=OTHER)
+    txns.cancel_peer(PEER)
+
+    assert sorted(sup.canceled) == sorted([t1.request_id, t2.request_id])
+    assert not txns.is_pending(t1) and not txns.is_pending(t2)
+    assert txns.is_pending(t3)